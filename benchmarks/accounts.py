@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+'''
+Memory and throughput of large configs, in process, no sshd needed.
+
+    python benchmarks/accounts.py -n 50000 -o accounts.json
+
+The slotted Account is compared with the dict backed one of previous
+versions (DictAccount below) on:
+
+    memory   bytes allocated to hold the accounts (tracemalloc)
+    load     constructing the accounts from the dicts of a config
+    dump     serializing them by json_dump()
+    compare  comparing every account with an equal copy
+    valid    is_valid() of every account
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sshx import utils
+from sshx.account import Account
+
+
+class DictAccount(object):
+    '''Account before __slots__, kept for comparison.'''
+
+    def __init__(self, name, user='root', host='', port='22', password='',
+                 identity='', via='', passphrase=''):
+        self.name = name
+        self.user = user
+        self.host = host
+        self.port = port
+        self.password = password
+        self.identity = identity
+        self.passphrase = passphrase
+        self.via = via
+
+    def is_valid(self):
+        return all(map(utils.is_str, self.__dict__.values())) and (self.name != self.via)
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.__dict__ == other.__dict__
+        return False
+
+
+def make_dicts(count):
+    return [{'name': f'host{i}', 'user': 'root', 'host': f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}',
+             'port': '22', 'password': f'token{i}', 'identity': '', 'passphrase': '',
+             'via': f'host{i - 1}' if i % 10 else ''} for i in range(count)]
+
+
+def measure_memory(cls, dicts):
+    tracemalloc.start()
+    accounts = [cls(**d) for d in dicts]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del accounts
+    return size
+
+
+def timed(func, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return round(min(samples) * 1000, 3)
+
+
+def bench(cls, dicts, runs):
+    accounts = [cls(**d) for d in dicts]
+    copies = [cls(**d) for d in dicts]
+    return {
+        'memory_bytes': measure_memory(cls, dicts),
+        'load_ms': timed(lambda: [cls(**d) for d in dicts], runs),
+        'dump_ms': timed(lambda: utils.json_dump({'accounts': accounts}), runs),
+        'compare_ms': timed(lambda: all(a == b for a, b in zip(accounts, copies)), runs),
+        'valid_ms': timed(lambda: all(a.is_valid() for a in accounts), runs),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark accounts of large configs.')
+    parser.add_argument('-n', '--count', type=int, default=50000, help='Number of accounts.')
+    parser.add_argument('-r', '--runs', type=int, default=5, help='Timed runs, the fastest is kept.')
+    parser.add_argument('-o', '--output', help='Write json results to the file, stdout if omitted.')
+    args = parser.parse_args(argv)
+
+    dicts = make_dicts(args.count)
+    results = {'count': args.count}
+    for name, cls in [('dict', DictAccount), ('slots', Account)]:
+        results[name] = bench(cls, dicts, args.runs)
+        print(name, json.dumps(results[name]), file=sys.stderr)
+    results['memory_saved'] = round(1 - results['slots']['memory_bytes'] / results['dict']['memory_bytes'], 3)
+
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+'''
+End-to-end benchmarks of sshwrap against throwaway local sshd instances.
+
+    python benchmarks/bench.py -o results.json
+    python benchmarks/compare.py old.json results.json
+
+Scenarios are run for every auth method (password, key, encrypted key) and
+every jump chain length (0, 1, 2, 4 hops):
+
+    exec     ExecPexpect round-trip of `echo ok`
+    ssh      sshwrap.ssh() running `echo ok`, including the tty relay
+    stream   sshwrap.ssh() printing --scp-size MB through the tty relay, with throughput
+    scp      sshwrap.scp() uploading a file, with throughput
+    forward  sshwrap.SSHPexpect local forwarding, until the forwarded port answers
+
+Password accounts need root and the password of the current user in
+SSHX_BENCH_PASSWORD, they are skipped otherwise.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import threading
+import contextlib
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lazy_object_proxy as lazy
+
+from sshx import __version__, cfg, sshwrap, trace
+from sshx.account import Account
+from sshx.sshx_forward import Forwards
+from sshx.sshx_scp import TargetPair
+from sshx.const import STATUS_SUCCESS
+
+from sshd import SSHDFarm, KEY_PASSPHRASE, free_port, wait_banner
+
+
+SCENARIOS = ['exec', 'ssh', 'stream', 'scp', 'forward']
+AUTHS = ['password', 'key', 'enckey']
+HOPS = [0, 1, 2, 4]
+
+
+@contextlib.contextmanager
+def pty_stdio():
+    '''
+    Run with a pty as stdin and stdout, which interactive sessions require,
+    and discard the output.
+    '''
+    master, slave = os.openpty()
+    saved = [os.dup(0), os.dup(1)]
+
+    def _drain():
+        try:
+            while os.read(master, 65536):
+                pass
+        except OSError:
+            pass
+
+    t = threading.Thread(target=_drain, daemon=True)
+    t.start()
+    sys.stdout.flush()
+    os.dup2(slave, 0)
+    os.dup2(slave, 1)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved[0], 0)
+        os.dup2(saved[1], 1)
+        for fd in saved + [slave]:
+            os.close(fd)
+        t.join(timeout=5)
+        os.close(master)
+
+
+def setup_accounts(farm, hops):
+    '''Add a target and the jump hosts for every auth method, return names by auth.'''
+    cfg.set_config_dir(os.path.join(farm.dir, 'sshx'))
+    cfg.init_config()
+    config = cfg.read_config()
+
+    credentials = {
+        'password': {'password': farm.password or ''},
+        'key': {'identity': farm.key},
+        'enckey': {'identity': farm.encrypted_key, 'passphrase': KEY_PASSPHRASE},
+    }
+    names = {}
+    for auth, credential in credentials.items():
+        names[auth] = [f'{auth}{i}' for i in range(max(hops) + 1)]
+        for name, server in zip(names[auth], farm.servers):
+            config.add_account(Account(name, user=farm.user, host='127.0.0.1',
+                                       port=str(server.port), **credential))
+    cfg.write_config(config)
+    cfg.config = lazy.Proxy(cfg.get_config)
+    return names
+
+
+def _account(name):
+    return cfg.config.get_account(name, decrypt=True)
+
+
+def run_exec(target, vias, args):
+    p = sshwrap.ExecPexpect(_account(target), 'echo ok', vias=vias,
+                            output=lambda account, line: None, timeout=30)
+    start = time.perf_counter()
+    ok = p.run() == STATUS_SUCCESS and p.exitstatus == 0
+    return ok, time.perf_counter() - start, {}
+
+
+def run_ssh(target, vias, args):
+    with pty_stdio():
+        start = time.perf_counter()
+        ok = sshwrap.ssh(_account(target), vias=vias, tty=False, cmd='echo ok') == STATUS_SUCCESS
+        elapsed = time.perf_counter() - start
+    return ok, elapsed, {}
+
+
+def run_stream(target, vias, args):
+    cmd = f'head -c {args.scp_size} /dev/zero'
+    with pty_stdio():
+        start = time.perf_counter()
+        ok = sshwrap.ssh(_account(target), vias=vias, tty=False, cmd=cmd) == STATUS_SUCCESS
+        elapsed = time.perf_counter() - start
+    return ok, elapsed, {'MBps': args.scp_size / 1e6 / elapsed}
+
+
+def run_scp(target, vias, args):
+    dst = os.path.join(args.workdir, 'scp.dst')
+    targets = TargetPair(args.scp_file, f'{target}:{dst}')
+    with pty_stdio():
+        start = time.perf_counter()
+        ok = sshwrap.scp(_account(target), targets, vias=vias) == STATUS_SUCCESS
+        elapsed = time.perf_counter() - start
+    ok = ok and os.path.getsize(dst) == args.scp_size
+    os.remove(dst)
+    return ok, elapsed, {'MBps': args.scp_size / 1e6 / elapsed}
+
+
+def run_forward(target, vias, args):
+    # forward to the sshd of the target itself, whose banner proves the tunnel works
+    account = _account(target)
+    port = free_port()
+    forwards = Forwards(f'127.0.0.1:{port}:127.0.0.1:{account.port}', '')
+    p = sshwrap.SSHPexpect(account, vias=vias, forwards=forwards, tty=False,
+                           background=True, execute=False, keepalive=False)
+
+    start = time.perf_counter()
+    t = threading.Thread(target=p.run, daemon=True)
+    t.start()
+    ok = wait_banner(port, timeout=30)
+    elapsed = time.perf_counter() - start
+
+    if p.p:
+        p.kill()
+    t.join(timeout=5)
+    return ok, elapsed, {}
+
+
+RUNNERS = {
+    'exec': run_exec,
+    'ssh': run_ssh,
+    'stream': run_stream,
+    'scp': run_scp,
+    'forward': run_forward,
+}
+
+
+def summarize(samples):
+    ms = sorted(s * 1000 for s in samples)
+    return {
+        'min_ms': round(ms[0], 3),
+        'median_ms': round(statistics.median(ms), 3),
+        'mean_ms': round(statistics.mean(ms), 3),
+        'p90_ms': round(ms[min(len(ms) - 1, int(len(ms) * 0.9))], 3),
+        'max_ms': round(ms[-1], 3),
+        'stdev_ms': round(statistics.stdev(ms), 3) if len(ms) > 1 else 0.0,
+    }
+
+
+def bench(scenario, auth, hops, names, args):
+    target = names[auth][0]
+    vias = ','.join(names[auth][1:hops + 1])
+    runner = RUNNERS[scenario]
+
+    for _ in range(args.warmup):
+        runner(target, vias, args)
+
+    samples, extras, failures = [], [], 0
+    for _ in range(args.runs):
+        ok, elapsed, extra = runner(target, vias, args)
+        if ok:
+            samples.append(elapsed)
+            extras.append(extra)
+        else:
+            failures += 1
+
+    result = {'scenario': scenario, 'auth': auth, 'hops': hops,
+              'runs': len(samples), 'failures': failures}
+    if samples:
+        result.update(summarize(samples))
+        for key in extras[0]:
+            result[key] = round(statistics.median(e[key] for e in extras), 3)
+    return result
+
+
+def environment():
+    ssh = subprocess.run(['ssh', '-V'], stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        rev = ''
+    return {
+        'sshx': __version__,
+        'git': rev,
+        'python': platform.python_version(),
+        'openssh': ssh.stderr.strip(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark sshx against local sshd instances.')
+    parser.add_argument('-o', '--output', help='Write json results to the file, stdout if omitted.')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='Timed runs per case.')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed runs per case.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--auths', default=','.join(AUTHS))
+    parser.add_argument('--hops', default=','.join(map(str, HOPS)))
+    parser.add_argument('--scp-size', type=int, default=16, help='Size of the scp file in MB.')
+    parser.add_argument('--mux', action='store_true', help='Run with connection multiplexing.')
+    parser.add_argument('--trace', help='Write sshx timing spans to the file.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    auths = [a for a in args.auths.split(',') if a]
+    hops = sorted(int(h) for h in args.hops.split(','))
+    args.scp_size *= 1000 * 1000
+
+    if args.trace:
+        trace.set_trace(args.trace)
+    sshwrap.set_multiplex(args.mux)
+    # never let an ssh-agent answer for the keys
+    os.environ.pop('SSH_AUTH_SOCK', None)
+
+    password = os.environ.get('SSHX_BENCH_PASSWORD')
+    results = []
+    with SSHDFarm(max(hops) + 1, password=password) as farm:
+        if 'password' in auths and not farm.password_auth:
+            print('skip password accounts: requires root and SSHX_BENCH_PASSWORD.', file=sys.stderr)
+            auths.remove('password')
+
+        names = setup_accounts(farm, hops)
+        args.workdir = tempfile.mkdtemp(dir=farm.dir)
+        args.scp_file = os.path.join(args.workdir, 'scp.src')
+        with open(args.scp_file, 'wb') as f:
+            f.write(os.urandom(args.scp_size))
+
+        for scenario in scenarios:
+            for auth in auths:
+                for h in hops:
+                    result = bench(scenario, auth, h, names, args)
+                    print(json.dumps(result), file=sys.stderr)
+                    results.append(result)
+
+        if args.mux:
+            for name, _ in sshwrap.mux_list():
+                sshwrap.mux_stop(name)
+
+    report = {'env': environment(), 'mux': args.mux, 'runs': args.runs, 'results': results}
+    s = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(s + '\n')
+    else:
+        print(s)
+    return 0 if all(r['failures'] == 0 for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+'''
+Compare two results of bench.py by median latency.
+
+    python benchmarks/compare.py old.json new.json --threshold 10
+
+Exit with 1 if any case got slower than the threshold (in percent).
+'''
+
+import sys
+import json
+import argparse
+
+
+def _key(result):
+    return result['scenario'], result['auth'], result['hops']
+
+
+def load(filename):
+    with open(filename) as f:
+        report = json.load(f)
+    return report, {_key(r): r for r in report['results']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark results.')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Regression threshold of median latency in percent.')
+    args = parser.parse_args(argv)
+
+    old_report, old = load(args.old)
+    new_report, new = load(args.new)
+    print(f"old: {old_report['env']['sshx']} {old_report['env'].get('git', '')}")
+    print(f"new: {new_report['env']['sshx']} {new_report['env'].get('git', '')}")
+    print()
+
+    print('%-10s%-10s%-6s%-14s%-14s%-10s' % ('scenario', 'auth', 'hops', 'old(ms)', 'new(ms)', 'change'))
+    print('%-10s%-10s%-6s%-14s%-14s%-10s' % ('-----', '-----', '-----', '-----', '-----', '-----'))
+    regressions = 0
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key].get('median_ms'), new[key].get('median_ms')
+        if a is None or b is None:
+            a, b, change = a or '-', b or '-', 'failed'
+        else:
+            percent = (b - a) / a * 100
+            change = '%+.1f%%' % percent
+            if percent > args.threshold:
+                change += ' !'
+                regressions += 1
+        print('%-10s%-10s%-6s%-14s%-14s%-10s' % (key + (a, b, change)))
+
+    for key in sorted(set(old) ^ set(new)):
+        print('%-10s%-10s%-6s only in %s' % (key + ('old' if key in old else 'new',)))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+'''
+Throwaway sshd instances listening on loopback, for benchmarks.
+
+Every instance runs `sshd -D` as the current user with its own host key and
+config in a temporary directory, and accepts the keys generated by the farm.
+Password authentication only works when running as root, because an
+unprivileged sshd can't verify passwords.
+'''
+
+import os
+import time
+import shutil
+import socket
+import getpass
+import tempfile
+import subprocess
+
+
+_SSHD_CONFIG = '''Port {port}
+ListenAddress 127.0.0.1
+HostKey {hostkey}
+PidFile {dir}/sshd.pid
+AuthorizedKeysFile {authorized_keys}
+PubkeyAuthentication yes
+PasswordAuthentication {password}
+KbdInteractiveAuthentication no
+PermitRootLogin yes
+UsePAM no
+StrictModes no
+AllowTcpForwarding yes
+MaxStartups 100
+MaxSessions 100
+LogLevel ERROR
+Subsystem sftp internal-sftp
+'''
+
+KEY_PASSPHRASE = 'sshx-bench'
+
+
+def find_sshd():
+    for path in (shutil.which('sshd'), '/usr/sbin/sshd', '/usr/local/sbin/sshd'):
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_banner(port, timeout=10):
+    '''Wait until something speaks ssh on the port.'''
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1) as sock:
+                if sock.recv(32).startswith(b'SSH-'):
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return False
+
+
+def keygen(path, passphrase=''):
+    subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', passphrase, '-f', path],
+                   check=True, stdout=subprocess.DEVNULL)
+    return path
+
+
+class SSHD(object):
+    def __init__(self, farm, index):
+        self.farm = farm
+        self.dir = os.path.join(farm.dir, f'sshd{index}')
+        self.port = free_port()
+        self.proc = None
+
+    def start(self):
+        os.makedirs(self.dir)
+        hostkey = keygen(os.path.join(self.dir, 'host_key'))
+        config = os.path.join(self.dir, 'sshd_config')
+        with open(config, 'w') as f:
+            f.write(_SSHD_CONFIG.format(
+                port=self.port, hostkey=hostkey, dir=self.dir,
+                authorized_keys=self.farm.authorized_keys,
+                password='yes' if self.farm.password_auth else 'no'))
+
+        self.proc = subprocess.Popen([self.farm.sshd, '-D', '-e', '-f', config],
+                                     stderr=open(os.path.join(self.dir, 'sshd.log'), 'w'))
+        if not wait_banner(self.port):
+            raise RuntimeError(f'sshd on port {self.port} failed, see {self.dir}/sshd.log')
+
+    def stop(self):
+        if self.proc:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+
+class SSHDFarm(object):
+    '''
+    with SSHDFarm(5) as farm:
+        farm.servers[0].port
+    '''
+
+    def __init__(self, count, password=None):
+        self.sshd = find_sshd()
+        if not self.sshd:
+            raise RuntimeError('sshd not found, please install openssh-server.')
+
+        self.user = getpass.getuser()
+        self.password = password
+        self.password_auth = bool(password) and os.geteuid() == 0
+        self.dir = tempfile.mkdtemp(prefix='sshx-bench-')
+        self.authorized_keys = os.path.join(self.dir, 'authorized_keys')
+        self.key = os.path.join(self.dir, 'id_plain')
+        self.encrypted_key = os.path.join(self.dir, 'id_encrypted')
+        self.servers = [SSHD(self, i) for i in range(count)]
+
+    def start(self):
+        keygen(self.key)
+        keygen(self.encrypted_key, KEY_PASSPHRASE)
+        with open(self.authorized_keys, 'w') as f:
+            for key in (self.key, self.encrypted_key):
+                with open(key + '.pub') as pub:
+                    f.write(pub.read())
+
+        for server in self.servers:
+            server.start()
+
+    def stop(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
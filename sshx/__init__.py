@@ -1,3 +1,6 @@
+import time
+_IMPORT_START = time.perf_counter()
+
 __version__ = '0.33.5'
 
 __all__ = ['sshx']
@@ -0,0 +1,173 @@
+'''
+sshx agent loads and decrypts the config once and keeps it in memory,
+answering account lookups of later sshx invocations over an unix socket
+(cfg.AGENT_SOCKET), like ssh-agent. It reloads the config whenever the
+account file changed, and exits after idle for `idle` seconds or after
+running for `lifetime` seconds.
+'''
+
+import os
+import time
+
+from . import cfg, ipc, logger
+
+
+def _signature():
+    try:
+        st = os.stat(cfg.ACCOUNT_FILE)
+        return st.st_ino, st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+
+class Agent(object):
+    def __init__(self, config, idle=3600, lifetime=0):
+        self.config = config
+        self.idle = idle
+        self.lifetime = lifetime
+        self.started = self.last_used = time.time()
+        self.stopped = False
+        self.signature = _signature()
+
+    def refresh(self):
+        signature = _signature()
+        if signature == self.signature:
+            return
+
+        if signature is None:
+            self.stopped = True
+            raise ipc.IPCError('Config file was removed.')
+
+        logger.debug('reload config')
+        config = cfg.read_config()
+        passphrase = self.config._phrase
+        if config.security:
+            if not passphrase or not config.verify_passphrase(passphrase):
+                self.stopped = True
+                raise ipc.IPCError('Passphrase was changed, please restart the agent.')
+            config._phrase = passphrase
+        config.decrypt_accounts()
+
+        self.config = config
+        self.signature = signature
+
+    def use(self):
+        self.last_used = time.time()
+        self.refresh()
+
+    def op_ping(self):
+        return {
+            'pid': os.getpid(),
+            'started': self.started,
+            'idle': self.idle,
+            'lifetime': self.lifetime,
+        }
+
+    def op_header(self):
+        self.use()
+        return {
+            'security': self.config.security,
+            'phrase': self.config.phrase,
+            'passphrase': self.config._phrase,
+        }
+
+    def op_get(self, name):
+        self.use()
+        account = self.config.get_account(name)
+        return {'account': account.to_dict() if account else None}
+
+    def op_accounts(self):
+        self.use()
+        return {'accounts': [a.to_dict() for a in self.config.get_accounts()]}
+
+    def op_stop(self):
+        self.stopped = True
+
+    def tick(self):
+        now = time.time()
+        if self.stopped:
+            return False
+        if self.idle and now - self.last_used > self.idle:
+            logger.debug('agent idle timeout')
+            return False
+        if self.lifetime and now - self.started > self.lifetime:
+            logger.debug('agent lifetime expired')
+            return False
+        return True
+
+
+class AgentConfig(cfg.LazyConfig):
+    '''Config served by a running agent, accounts are already decrypted.'''
+
+    def __init__(self, client):
+        header = client.request('header')
+        super().__init__(header, load=False)
+        self._phrase = header['passphrase']
+        self._client = client
+
+    def _load_account(self, name):
+        return self._client.request('get', name=name)['account']
+
+    def _load_accounts(self):
+        return self._client.request('accounts')['accounts']
+
+
+def get_config():
+    '''Return an AgentConfig if the agent is running, otherwise None.'''
+    client = ipc.connect(cfg.AGENT_SOCKET)
+    if client is None:
+        return None
+
+    try:
+        return AgentConfig(client)
+    except (OSError, ipc.IPCError) as e:
+        logger.debug(f'agent unavailable: {e}')
+        client.close()
+        return None
+
+
+def status():
+    '''Return the ping response of the running agent, or None.'''
+    client = ipc.connect(cfg.AGENT_SOCKET)
+    if client is None:
+        return None
+
+    try:
+        return client.request('ping')
+    except (OSError, ipc.IPCError):
+        return None
+    finally:
+        client.close()
+
+
+def stop():
+    client = ipc.connect(cfg.AGENT_SOCKET)
+    if client is None:
+        return False
+
+    try:
+        client.request('stop')
+        return True
+    except (OSError, ipc.IPCError):
+        return False
+    finally:
+        client.close()
+
+
+def start(idle=3600, lifetime=0, foreground=False):
+    '''
+    Load the config, prompt for the passphrase in security mode and serve.
+    Return True in the parent process once the agent was started.
+    '''
+    if status():
+        logger.error('Agent is already running.')
+        return False
+
+    config = cfg.read_config()
+    if config.security and config.get_passphrase() is None:
+        logger.error('Wrong passphrase.')
+        return False
+    config.decrypt_accounts()
+
+    server = ipc.Server(cfg.AGENT_SOCKET, Agent(config, idle=idle, lifetime=lifetime))
+    return server.start(foreground=foreground)
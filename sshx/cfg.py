@@ -1,11 +1,10 @@
-# -*- coding: future_fstrings -*-
-
 import os
 import io
 import stat
-import shutil
 import lazy_object_proxy as lazy
 
+from collections import OrderedDict
+
 from typing import List
 
 from sshx import logger
@@ -19,17 +18,49 @@ from . import const as c
 
 _CONFIG_DIR = '.sshx'
 _ACCOUNT_FILE = '.accounts'
+_LOCK_FILE = '.accounts.lock'
+_AGENT_SOCKET = 'agent.sock'
+_TUNNELS_FILE = 'tunnels.json'
+_TUNNELS_SOCKET = 'tunnels.sock'
+_PORTS_FILE = '.ports'
+_PORTS_LOCK_FILE = '.ports.lock'
+_KNOWN_HOSTS_FILE = 'known_hosts'
+_SEARCH_INDEX_FILE = '.accounts.index'
 
 CONFIG_DIR = ''
 ACCOUNT_FILE = ''
+LOCK_FILE = ''
+AGENT_SOCKET = ''
+TUNNELS_FILE = ''
+TUNNELS_SOCKET = ''
+PORTS_FILE = ''
+PORTS_LOCK_FILE = ''
+KNOWN_HOSTS_FILE = ''
+SEARCH_INDEX_FILE = ''
 
 
 def set_config_dir(config_dir):
     global CONFIG_DIR
     global ACCOUNT_FILE
+    global LOCK_FILE
+    global AGENT_SOCKET
+    global TUNNELS_FILE
+    global TUNNELS_SOCKET
+    global PORTS_FILE
+    global PORTS_LOCK_FILE
+    global KNOWN_HOSTS_FILE
+    global SEARCH_INDEX_FILE
 
     CONFIG_DIR = config_dir
     ACCOUNT_FILE = os.path.join(CONFIG_DIR, _ACCOUNT_FILE)
+    LOCK_FILE = os.path.join(CONFIG_DIR, _LOCK_FILE)
+    AGENT_SOCKET = os.path.join(CONFIG_DIR, _AGENT_SOCKET)
+    TUNNELS_FILE = os.path.join(CONFIG_DIR, _TUNNELS_FILE)
+    TUNNELS_SOCKET = os.path.join(CONFIG_DIR, _TUNNELS_SOCKET)
+    PORTS_FILE = os.path.join(CONFIG_DIR, _PORTS_FILE)
+    PORTS_LOCK_FILE = os.path.join(CONFIG_DIR, _PORTS_LOCK_FILE)
+    KNOWN_HOSTS_FILE = os.path.join(CONFIG_DIR, _KNOWN_HOSTS_FILE)
+    SEARCH_INDEX_FILE = os.path.join(CONFIG_DIR, _SEARCH_INDEX_FILE)
 
 
 ENV_CONFIG_DIR = 'SSHX_HOME'
@@ -41,6 +72,8 @@ else:
     set_config_dir(os.path.join(HOME, _CONFIG_DIR))
 
 
+_SECRET_FIELDS = ('password', 'passphrase')
+
 STATUS_INITED = 0
 STATUS_BROKEN = 1
 STATUS_UNINIT = 2
@@ -61,6 +94,80 @@ class Config(object):
         self.accounts = [Account(**a) for a in config_dict.get('accounts', [])]
         # self._load = load
         self.encrypted = {a.name: load for a in self.accounts}
+        self._tokens = {}
+        self.reset_changes()
+        self.reindex()
+
+    def reset_changes(self):
+        '''
+        Forget the changes since loaded or written.
+
+        write_config() only encrypts and writes the changed accounts, on top
+        of the config file, unless the whole config has to be rewritten.
+        '''
+        self._changed = {}
+        self._removed = set()
+        self._rewrite = False
+
+    def _mark_changed(self, account):
+        self._removed.discard(account.name)
+        self._changed[account.name] = account
+
+    def _mark_removed(self, name):
+        self._changed.pop(name, None)
+        self._removed.add(name)
+
+    def has_changes(self):
+        return bool(self._rewrite or self._changed or self._removed)
+
+    def merge_into(self, config_dict):
+        '''
+        Apply the changes to `config_dict`, which was loaded from the config file
+        by the time of writing and is probably modified by another process.
+        Return the dict to dump.
+        '''
+        accounts = OrderedDict((a['name'], a) for a in config_dict.get('accounts', []))
+        for name in self._removed:
+            accounts.pop(name, None)
+        if self._changed:
+            # asked for anyway, so that the rest is migrated before
+            self.get_passphrase()
+        self.upgrade(accounts.values())
+        for name, account in self._changed.items():
+            self.encrypt_account(account)
+            accounts[name] = account
+
+        return {
+            'security': self.security,
+            'phrase': self.phrase,
+            'accounts': list(accounts.values()),
+        }
+
+    def reindex(self):
+        '''
+        Rebuild the indexes of accounts.
+
+        Accounts must be mutated by add_account(), rename_account(),
+        update_account() and remove_account() to keep them consistent.
+        '''
+        self._by_name = {}
+        self._by_host = {}
+        self._by_via = {}
+        for a in self.accounts:
+            self._index(a)
+
+    def _index(self, account):
+        self._by_name.setdefault(account.name, account)
+        self._by_host.setdefault(account.host, {})[account.name] = account
+        self._by_via.setdefault(account.via, {})[account.name] = account
+
+    def _unindex(self, account):
+        self._by_name.pop(account.name, None)
+        for index, key in ((self._by_host, account.host), (self._by_via, account.via)):
+            accounts = index.get(key, {})
+            accounts.pop(account.name, None)
+            if not accounts:
+                index.pop(key, None)
 
     def is_valid(self):
         b = utils.is_str(self.phrase) and isinstance(
@@ -88,22 +195,60 @@ class Config(object):
                     self._phrase = _phrase
             return self._phrase
         else:
+            tokenizer.set_key_cost(self.phrase, tokenizer.RANDOM_KEY_COST)
             return self.phrase
 
     def reset_passphrase(self):
         '''Can't be called until all accounts was decrypted.'''
+        self._rewrite = True
+        self._tokens = {}
         if self.security:
             self._phrase = utils.read_passphrase()
-            self.phrase = tokenizer.hash(self._phrase)
+            self.phrase = tokenizer.make_verifier(self._phrase)
         else:
             self._phrase = None
             self.phrase = utils.random_str(32)
 
     def verify_passphrase(self, phrase) -> bool:
         if self.security:
-            return self.phrase == tokenizer.hash(phrase)
+            return tokenizer.verify(phrase, self.phrase)
         return self.phrase == phrase
 
+    def rekey(self):
+        '''
+        Encrypt all accounts again with a new salt, by the current
+        tokenizer.KDF_COST in security mode.
+        '''
+        self.decrypt_accounts()
+        self._rewrite = True
+        self._tokens = {}
+        if self.security:
+            self.phrase = tokenizer.make_verifier(self.get_passphrase())
+        else:
+            tokenizer.reset_salt(self.phrase, tokenizer.RANDOM_KEY_COST)
+
+    def upgrade(self, accounts):
+        '''
+        Migrate the legacy verifier, and the secrets of the accounts (Account
+        or dicts of the config file) still encrypted in the legacy format.
+        '''
+        # don't ask for the passphrase only to migrate
+        phrase = self._phrase if self.security else self.get_passphrase()
+        if not phrase:
+            return
+        if self.security and not tokenizer.is_v2(self.phrase):
+            self.phrase = tokenizer.make_verifier(phrase)
+
+        for a in accounts:
+            if isinstance(a, Account):
+                if self.encrypted.get(a.name):
+                    a.password = tokenizer.upgrade(a.password, phrase)
+                    a.passphrase = tokenizer.upgrade(a.passphrase, phrase)
+            else:
+                for field in ('password', 'passphrase'):
+                    if a.get(field):
+                        a[field] = tokenizer.upgrade(a[field], phrase)
+
     def set_security(self, security: bool):
         if self.security:
             if security:
@@ -129,11 +274,17 @@ class Config(object):
         phrase = self.get_passphrase()
         if phrase:
             if self.encrypted[account.name]:
+                tokens = [account.password, account.passphrase]
                 account.password = tokenizer.decrypt(account.password, phrase)
                 if account.passphrase:
                     account.passphrase = tokenizer.decrypt(account.passphrase, phrase)
                 self.encrypted[account.name] = False
 
+                # {plain: token} of the fields, written back as they were unless changed
+                plains = [account.password, account.passphrase]
+                self._tokens[account.name] = {p: t for p, t in zip(plains, tokens)
+                                              if t and tokenizer.is_current(t)}
+
     def decrypt_accounts(self):
         for a in self.accounts:
             self.decrypt_account(a)
@@ -142,17 +293,23 @@ class Config(object):
         phrase = self.get_passphrase()
         if phrase:
             if not self.encrypted[account.name]:
-                account.password = tokenizer.encrypt(account.password, phrase)
+                tokens = self._tokens.pop(account.name, {})
+                account.password = self._encrypt(account.password, phrase, tokens)
                 if account.passphrase:
-                    account.passphrase = tokenizer.encrypt(account.passphrase, phrase)
+                    account.passphrase = self._encrypt(account.passphrase, phrase, tokens)
                 self.encrypted[account.name] = True
 
+    def _encrypt(self, plain, phrase, tokens=None):
+        if tokens and plain in tokens:
+            return tokens[plain]
+        return tokenizer.encrypt(plain, phrase)
+
     def encrypt_accounts(self):
         for a in self.accounts:
             self.encrypt_account(a)
 
     def get_account(self, name, decrypt=False) -> Account:
-        account = find_by_name(self.accounts, name)
+        account = self._by_name.get(name) if name else None
         if account:
             if decrypt:
                 self.decrypt_account(account)
@@ -163,14 +320,22 @@ class Config(object):
             self.decrypt_accounts()
         return self.accounts
 
+    def get_accounts_by_host(self, host) -> List[Account]:
+        return list(self._by_host.get(host, {}).values())
+
+    def get_accounts_by_via(self, via) -> List[Account]:
+        '''Return accounts which use `via` as jump host.'''
+        return list(self._by_via.get(via, {}).values()) if via else []
+
     def add_account(self, account):
-        a = find_by_name(self.accounts, account.name)
-        if a:
+        if account.name in self._by_name:
             logger.error('Account exists!')
             return False
 
         self.accounts.append(account)
         self.encrypted[account.name] = False
+        self._index(account)
+        self._mark_changed(account)
         return True
 
     def rename_account(self, account, newname):
@@ -178,41 +343,217 @@ class Config(object):
             logger.error(f'Account {newname} exists!')
             return False
 
-        encrypted = self.encrypted.pop(account.name)
-        account.name = newname
-        self.encrypted[newname] = encrypted
+        self.update_account(account, {'name': newname})
         return True
 
+    def update_account(self, account, update):
+        '''
+        Secrets set on an account which was never decrypted are encrypted
+        alone, so that the other fields stay as they were.
+        '''
+        name = account.name
+        if self.encrypted.get(name) and any(f in update for f in _SECRET_FIELDS):
+            phrase = self.get_passphrase()
+            if phrase:
+                update = dict(update)
+                if 'password' in update:
+                    update['password'] = self._encrypt(update['password'], phrase)
+                if update.get('passphrase'):
+                    update['passphrase'] = self._encrypt(update['passphrase'], phrase)
+
+        self._unindex(account)
+        account.update(update)
+        self._index(account)
+        if account.name != name:
+            self.encrypted[account.name] = self.encrypted.pop(name)
+            if name in self._tokens:
+                self._tokens[account.name] = self._tokens.pop(name)
+            self._mark_removed(name)
+        self._mark_changed(account)
+
     def remove_account(self, name):
-        a = find_by_name(self.accounts, name)
+        a = self.get_account(name)
         if not a:
             logger.error('Account not found.')
             return False
 
         self.accounts.remove(a)
+        self._unindex(a)
         del self.encrypted[name]
+        self._tokens.pop(name, None)
+        self._mark_removed(name)
         return True
 
 
+class LazyConfig(Config):
+    '''
+    Config whose accounts are loaded on demand.
+
+    Only the header (security, phrase) is loaded on construction.
+    get_account() loads a single account by _load_account(), anything
+    which needs the whole list loads all of them by _load_accounts().
+    Accounts loaded before are kept, so references stay valid.
+    '''
+
+    _LAZY_FIELDS = ('accounts', '_by_name', '_by_host', '_by_via')
+
+    def __init__(self, config_dict, load=True):
+        self.security = config_dict.get('security', False)
+        self.phrase = config_dict.get('phrase', None)
+        self._phrase = None
+        self.encrypted = {}
+        self._tokens = {}
+        self._load = load
+        self._fetched = {}
+        self.reset_changes()
+
+    def __getattr__(self, name):
+        # Only called when the attribute is missing.
+        if name not in self._LAZY_FIELDS:
+            raise AttributeError(name)
+        self.load_accounts()
+        return self.__dict__[name]
+
+    def _load_account(self, name) -> dict:
+        raise NotImplementedError
+
+    def _load_accounts(self) -> List[dict]:
+        raise NotImplementedError
+
+    @staticmethod
+    def _account(d):
+        account = Account(**d)
+        if not account.is_valid():
+            raise ValueError(f'Broken account in the config: {d.get("name")!r}')
+        return account
+
+    def load_accounts(self):
+        self.accounts = [self._fetched.get(d['name']) or self._account(d)
+                         for d in self._load_accounts()]
+        for a in self.accounts:
+            self.encrypted.setdefault(a.name, self._load)
+        self.reindex()
+
+    def get_account(self, name, decrypt=False) -> Account:
+        if 'accounts' in self.__dict__:
+            return super().get_account(name, decrypt=decrypt)
+        if not name:
+            return None
+
+        if name not in self._fetched:
+            d = self._load_account(name)
+            self._fetched[name] = self._account(d) if d else None
+            if d:
+                self.encrypted[name] = self._load
+
+        account = self._fetched[name]
+        if account and decrypt:
+            self.decrypt_account(account)
+        return account
+
+
+class BinaryConfig(LazyConfig):
+    '''Config of a binary accounts file, whose records are decoded on demand.'''
+
+    def __init__(self, reader, load=True):
+        super().__init__(reader.header, load=load)
+        self._store = reader
+
+    def is_valid(self):
+        # accounts are checked as they are loaded, by LazyConfig._account()
+        return utils.is_str(self.phrase)
+
+    def _load_account(self, name):
+        return self._store.get(name)
+
+    def _load_accounts(self):
+        return self._store.accounts()
+
+
 def create_config_file():
     io.open(ACCOUNT_FILE, 'a', encoding='utf-8').close()
     os.chmod(ACCOUNT_FILE, stat.S_IRUSR | stat.S_IWUSR)
 
 
 def read_config():
-    with io.open(ACCOUNT_FILE, 'r', encoding='utf-8') as configfile:
-        config_dict = utils.json_load(configfile.read())
-        config = Config(config_dict)
+    # the format is told by the magic, a binary file is mapped instead of read
+    with io.open(ACCOUNT_FILE, 'rb') as configfile:
+        magic = configfile.read(len(c.CONFIG_MAGIC))
+        if magic == c.CONFIG_MAGIC:
+            from . import store
+            config = BinaryConfig(store.Store(configfile))
+        else:
+            config = Config(utils.json_load((magic + configfile.read()).decode('utf-8')))
+
+    if config.is_valid():
+        return config
 
-        if config.is_valid():
-            return config
+
+def _read_config_file():
+    '''Return (config dict or None, format) of the config file.'''
+    try:
+        configfile = io.open(ACCOUNT_FILE, 'rb')
+    except FileNotFoundError:
+        return None, c.CONFIG_JSON
+
+    with configfile:
+        magic = configfile.read(len(c.CONFIG_MAGIC))
+        if magic == c.CONFIG_MAGIC:
+            from . import store
+            reader = store.Store(configfile)
+            try:
+                return reader.to_dict(), c.CONFIG_BINARY
+            finally:
+                reader.close()
+        s = (magic + configfile.read()).decode('utf-8')
+    return (utils.json_load(s) if s.strip() else None), c.CONFIG_JSON
+
+
+def _dumps(config_dict, fmt):
+    if fmt == c.CONFIG_BINARY:
+        from . import store
+        return store.dumps(config_dict)
+    return utils.json_dump(config_dict)
 
 
 def write_config(config):
-    with io.open(ACCOUNT_FILE, 'w', encoding='utf-8') as configfile:
-        config.encrypt_accounts()
-        s = utils.json_dump(config.dump())
-        configfile.write(s)
+    '''
+    Write the changes of config, return False if failed.
+
+    The config file is locked while writing, and the changed accounts are
+    merged into the current content of the file, so that concurrent sshx
+    processes don't lose updates. The file is replaced atomically, in the
+    format it was.
+    '''
+    with utils.file_lock(LOCK_FILE):
+        base, fmt = _read_config_file()
+        if config._rewrite:
+            base = None
+        if base is None:
+            config.upgrade(config.accounts)
+            config.encrypt_accounts()
+            config_dict = config.dump()
+        elif base.get('phrase') != config.phrase or base.get('security') != config.security:
+            logger.error('Config was changed by another process, please retry.')
+            return False
+        elif not config.has_changes():
+            return True
+        else:
+            config_dict = config.merge_into(base)
+
+        utils.atomic_write(ACCOUNT_FILE, _dumps(config_dict, fmt))
+        config.reset_changes()
+        return True
+
+
+def convert_config(fmt):
+    '''Rewrite the config file in the format, return False if it was already.'''
+    with utils.file_lock(LOCK_FILE):
+        config_dict, current = _read_config_file()
+        if current == fmt:
+            return False
+        utils.atomic_write(ACCOUNT_FILE, _dumps(config_dict, fmt))
+        return True
 
 
 def check_init():
@@ -247,13 +588,20 @@ def init_config(security=False):
 
 
 def remove_all_config():
+    import shutil
     shutil.rmtree(CONFIG_DIR)
 
 
 def get_config():
     try:
+        if os.path.exists(AGENT_SOCKET):
+            from . import agent
+            config = agent.get_config()
+            if config:
+                return config
         return read_config()
     except Exception as e:
+        logger.debug(e)
         raise Exception(c.MSG_CONFIG_BROKEN)
 
 
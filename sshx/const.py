@@ -2,6 +2,10 @@ DEFAULT_USER = 'root'
 DEFAULT_HOST = None
 DEFAULT_PORT = '22'
 
+CONFIG_JSON = 'json'
+CONFIG_BINARY = 'binary'
+CONFIG_MAGIC = b'SSHXBIN1'
+
 STATUS_SUCCESS = 0
 STATUS_FAIL = 1
 
@@ -11,3 +15,4 @@ MSG_CONNECTION_ERROR = 'Connection error.'
 MSG_CONNECTION_TIMED_OUT = 'Connection timed out.'
 MSG_CONNECT_VIA_SELF = 'Cannot connect via itself.'
 MSG_AUTH_FAILED = 'Auth failed!'
+MSG_HOST_KEY_VERIFICATION_FAILED = 'Host key verification failed.'
@@ -0,0 +1,235 @@
+'''
+Host keys of the accounts, kept in cfg.KNOWN_HOSTS_FILE.
+
+Instead of disabling host key checking, ssh is told to check against this
+file, under the account name (HostKeyAlias), so that a key is kept per
+account and hop whatever host and port it is reached by, including local
+ports forwarded through jump hosts. A key is added on the first connection
+(StrictHostKeyChecking=accept-new), after which a changed key fails the
+connection instead of being accepted. OpenSSH before 7.6 has no accept-new,
+it's told to check strictly then, and keys have to be scanned first.
+The keys are renamed with the account, and removed with it or once its
+host or port is changed.
+
+`sshx hostkeys scan` fetches the keys of many accounts at once by
+ssh-keyscan, so that the first connections don't trust on first use.
+`sshx --no-known-hosts` turns it off, like sshx did before.
+
+ssh appends the keys it accepts to the file without knowing the lock of
+sshx, so the file is only appended to as well, and rewritten only to
+remove keys, from its content read right before.
+'''
+
+import os
+
+from . import cfg, utils, logger
+
+
+Enabled = True
+
+SCAN_TIMEOUT = 5
+
+# The first version of OpenSSH knowing StrictHostKeyChecking=accept-new.
+ACCEPT_NEW_VERSION = (7, 6)
+
+# Keys added by ssh are kept readable, for `sshx hostkeys list` and scan.
+_OPTIONS = ('-o StrictHostKeyChecking={checking} -o UserKnownHostsFile={file} '
+            '-o HashKnownHosts=no -o HostKeyAlias={name}')
+_OPTIONS_DISABLED = '-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null'
+_CONFIG = '\tStrictHostKeyChecking {checking}\n\tUserKnownHostsFile "{file}"\n\tHashKnownHosts no'
+_CONFIG_DISABLED = '\tStrictHostKeyChecking no\n\tUserKnownHostsFile /dev/null'
+_SSH_KEYSCAN = 'ssh-keyscan -T {timeout} -p {port} {host}'
+
+
+class HostKeyError(Exception):
+    pass
+
+
+def set_known_hosts(enabled):
+    global Enabled
+    Enabled = enabled
+
+
+def ssh_version():
+    '''Return (major, minor) of the OpenSSH client, (0, 0) if unknown.'''
+    import re
+    import subprocess
+
+    try:
+        p = subprocess.run(['ssh', '-V'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return (0, 0)
+    m = re.search(r'OpenSSH_(\d+)\.(\d+)', p.stdout.decode('utf-8', errors='replace'))
+    return (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+
+
+_checking = None
+
+
+def strict_checking():
+    '''Value of StrictHostKeyChecking, ssh is asked for its version once.'''
+    global _checking
+    if _checking is None:
+        _checking = 'accept-new' if ssh_version() >= ACCEPT_NEW_VERSION else 'yes'
+        logger.debug(f'StrictHostKeyChecking={_checking}')
+    return _checking
+
+
+def ssh_options(name):
+    '''Options of the ssh command line connecting to the account `name`.'''
+    import shlex
+
+    if not Enabled:
+        return _OPTIONS_DISABLED
+    return _OPTIONS.format(checking=strict_checking(), file=shlex.quote(cfg.KNOWN_HOSTS_FILE), name=name)
+
+
+def ssh_config():
+    '''Lines of the `Host *` block of chain configs.'''
+    if not Enabled:
+        return _CONFIG_DISABLED
+    return _CONFIG.format(checking=strict_checking(), file=cfg.KNOWN_HOSTS_FILE)
+
+
+def load(filename=None):
+    '''Return {name: [(keytype, key)]} of the file.'''
+    filename = filename or cfg.KNOWN_HOSTS_FILE
+    keys = {}
+    try:
+        with open(filename) as f:
+            lines = f.readlines()
+    except OSError:
+        return keys
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3 or fields[0].startswith('#'):
+            continue
+        for name in fields[0].split(','):
+            keys.setdefault(name, []).append((fields[1], fields[2]))
+    return keys
+
+
+def _append(entries):
+    '''Append [(name, keytype, key)] to the file by a single write, as ssh does.'''
+    if not entries:
+        return
+    data = ''.join(f'{name} {keytype} {key}\n' for name, keytype, key in entries)
+    fd = os.open(cfg.KNOWN_HOSTS_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+
+
+def keyscan(account, timeout=SCAN_TIMEOUT):
+    '''Return [(keytype, key)] the host of the account offers.'''
+    import shlex
+    import subprocess
+
+    cmd = _SSH_KEYSCAN.format(timeout=timeout, port=account.port,
+                              host=shlex.quote(account.host))
+    logger.debug(cmd)
+    try:
+        p = subprocess.run(shlex.split(cmd), stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE, timeout=timeout * 3)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise HostKeyError(str(e))
+
+    keys = []
+    for line in p.stdout.decode('utf-8', errors='replace').splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and not fields[0].startswith('#'):
+            keys.append((fields[1], fields[2]))
+    if not keys:
+        error = p.stderr.decode('utf-8', errors='replace').strip()
+        raise HostKeyError(error.splitlines()[-1] if error else 'No host key received.')
+    return keys
+
+
+def scan(accounts, jobs=10, timeout=SCAN_TIMEOUT):
+    '''
+    Fetch the keys of the accounts in parallel and store them.
+
+    Return [(name, status, detail)], where status is one of added,
+    unchanged, changed, skipped and failed. A changed key is reported but
+    not stored, it has to be removed first. Accounts behind jump hosts are
+    skipped, their keys are added on the first connection.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    def _scan(account):
+        try:
+            return keyscan(account, timeout=timeout), ''
+        except HostKeyError as e:
+            return None, str(e)
+
+    direct = [a for a in accounts if not a.via]
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        scanned = dict(zip([a.name for a in direct], executor.map(_scan, direct)))
+
+    results = []
+    added = []
+    with utils.file_lock(cfg.LOCK_FILE):
+        keys = load()
+        for account in accounts:
+            name = account.name
+            if name not in scanned:
+                results.append((name, 'skipped', f'via {account.via}'))
+                continue
+            found, error = scanned[name]
+            if found is None:
+                results.append((name, 'failed', error))
+                continue
+
+            known = keys.get(name, [])
+            types = dict(known)
+            new = [e for e in found if e not in known]
+            if any(t in types for t, _ in new):
+                status = 'changed'
+            elif new:
+                status = 'added'
+                added.extend((name, keytype, key) for keytype, key in new)
+            else:
+                status = 'unchanged'
+            results.append((name, status, ' '.join(t for t, _ in found)))
+        _append(added)
+    return results
+
+
+def remove(name):
+    '''Forget the keys of the account, return False if there were none.'''
+    return _rename(name, None)
+
+
+def rename(name, newname):
+    '''Keep the keys of the account under newname, return False if there were none.'''
+    return _rename(name, newname)
+
+
+def _rename(name, newname):
+    with utils.file_lock(cfg.LOCK_FILE):
+        try:
+            with open(cfg.KNOWN_HOSTS_FILE) as f:
+                lines = f.readlines()
+        except OSError:
+            return False
+
+        keep = []
+        for line in lines:
+            fields = line.split()
+            names = fields[0].split(',') if len(fields) >= 3 and not fields[0].startswith('#') else []
+            if name in names or (newname and newname in names):
+                # the line may be shared with other names, and the keys
+                # already under newname were of an account gone before
+                moved = newname and name in names
+                names = [n for n in names if n not in (name, newname)]
+                if moved:
+                    names.append(newname)
+                if names:
+                    keep.append(' '.join([','.join(names)] + fields[1:]) + '\n')
+            else:
+                keep.append(line)
+        if keep == lines:
+            return False
+        # only the keys ssh added since the read above can be lost
+        utils.atomic_write(cfg.KNOWN_HOSTS_FILE, ''.join(keep))
+    return True
@@ -0,0 +1,149 @@
+'''
+Request/response over an unix socket.
+
+Every message is a json object in a single line. A request looks like
+{"op": "get", "name": "host1"}, and the response is {"ok": true, ...}
+or {"ok": false, "error": "..."}.
+'''
+
+import os
+import json
+import socket
+import threading
+import socketserver
+
+from . import logger
+
+
+class IPCError(Exception):
+    pass
+
+
+class Client(object):
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, op, **kwargs):
+        kwargs['op'] = op
+        self.file.write(json.dumps(kwargs).encode('utf-8') + b'\n')
+        self.file.flush()
+
+        line = self.file.readline()
+        if not line:
+            raise IPCError('Connection closed.')
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok'):
+            raise IPCError(response.get('error'))
+        return response
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def connect(path, timeout=5):
+    '''Return a Client, or None if nobody is listening on `path`.'''
+    if not os.path.exists(path):
+        return None
+    try:
+        return Client(path, timeout=timeout)
+    except OSError as e:
+        logger.debug(f'failed to connect "{path}": {e}')
+        return None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = self.server.dispatch(request)
+            except Exception as e:
+                logger.debug(e)
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Dispatch a request to the method `op_<op>` of `handler`, whose return
+    value (a dict) is merged into the response.
+
+    serve() calls `handler.tick()` every `interval` seconds and stops once
+    it returns False.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, path, handler, interval=1):
+        if os.path.exists(path):
+            os.remove(path)
+
+        # only the owner can talk to us
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+
+        self.path = path
+        self.handler = handler
+        self.timeout = interval
+        self.lock = threading.Lock()
+
+    def dispatch(self, request):
+        op = request.pop('op', None)
+        method = getattr(self.handler, f'op_{op}', None)
+        if method is None:
+            raise IPCError(f'Unknown op: {op}')
+
+        with self.lock:
+            response = method(**request) or {}
+        response['ok'] = True
+        return response
+
+    def serve(self):
+        try:
+            while True:
+                self.handle_request()
+                with self.lock:
+                    if not self.handler.tick():
+                        break
+        finally:
+            self.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def start(self, foreground=False):
+        '''
+        Serve in this process, or in a detached child (a daemon of its own
+        session, with stdio on /dev/null). Return True in the parent.
+
+        The socket is listened on before forking, so that the server can be
+        used as soon as this returns.
+        '''
+        if foreground:
+            self.serve()
+            return True
+
+        if os.fork():
+            self.socket.close()
+            return True
+
+        try:
+            _detach()
+            self.serve()
+        finally:
+            os._exit(0)
+
+
+def _detach():
+    os.setsid()
+    fd = os.open(os.devnull, os.O_RDWR)
+    for fileno in (0, 1, 2):
+        os.dup2(fd, fileno)
@@ -0,0 +1,126 @@
+'''
+Local ports for forwarding.
+
+A port is free if it can be bound, rather than if nothing answers on it.
+Ports handed out are reserved in cfg.PORTS_FILE under a lock until
+released (or their process exited), so that concurrent sshx processes
+never get the same port in the window before ssh binds it.
+
+By default the kernel picks the ports (binding port 0). With a port range
+(`sshx --port-range 50000-50100`), the lowest free ports of the range are
+taken.
+'''
+
+import os
+import json
+
+from . import cfg, utils, logger
+
+
+LOCALHOST = '127.0.0.1'
+
+PortRange = None
+
+
+class PortError(Exception):
+    pass
+
+
+def set_port_range(port_range):
+    '''port_range is (low, high) inclusive, or None for ports picked by the kernel.'''
+    global PortRange
+    PortRange = port_range
+
+
+def parse_port_range(s):
+    try:
+        low, high = (int(p) for p in s.split('-'))
+    except ValueError:
+        raise PortError(f'Invalid port range: {s}')
+    if not 0 < low <= high < 65536:
+        raise PortError(f'Invalid port range: {s}')
+    return low, high
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _load():
+    '''Return the reservations {port: pid} of running processes.'''
+    try:
+        with open(cfg.PORTS_FILE) as f:
+            reserved = {int(port): pid for port, pid in json.load(f).items()}
+    except (OSError, ValueError):
+        return {}
+    return {port: pid for port, pid in reserved.items() if _alive(pid)}
+
+
+def _save(reserved):
+    utils.atomic_write(cfg.PORTS_FILE, json.dumps({str(k): v for k, v in sorted(reserved.items())}))
+
+
+def _bind(host, port):
+    '''Return the port bound, or None if it's in use.'''
+    import socket
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # like ssh does, so that ports in TIME_WAIT count as free
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except OSError:
+            return None
+        return sock.getsockname()[1]
+
+
+def _candidates(host, reserved):
+    if PortRange:
+        low, high = PortRange
+        for port in range(low, high + 1):
+            if port not in reserved and _bind(host, port):
+                yield port
+        return
+
+    # ports recently reserved by others may be picked by the kernel again
+    for _ in range(100):
+        port = _bind(host, 0)
+        if port and port not in reserved:
+            yield port
+
+
+def allocate(count=1, host=LOCALHOST):
+    '''Reserve `count` distinct free ports, return them in a list.'''
+    if count <= 0:
+        return []
+
+    with utils.file_lock(cfg.PORTS_LOCK_FILE):
+        reserved = _load()
+        ports = []
+        for port in _candidates(host, reserved):
+            if port not in ports:
+                ports.append(port)
+            if len(ports) == count:
+                break
+        else:
+            raise PortError(f'Not enough free ports, {len(ports)} of {count} found.')
+
+        pid = os.getpid()
+        reserved.update((port, pid) for port in ports)
+        _save(reserved)
+    logger.debug(f'allocated ports {ports}')
+    return ports
+
+
+def release(ports):
+    with utils.file_lock(cfg.PORTS_LOCK_FILE):
+        reserved = _load()
+        for port in ports:
+            reserved.pop(port, None)
+        _save(reserved)
@@ -0,0 +1,97 @@
+'''
+Relay between the terminal and the pty of a spawned ssh, replacing
+pexpect's interact().
+
+interact() reads 1000 bytes at a time, checks whether the child is alive
+on every round (a waitpid) and drops the rest of partial writes. This
+relay waits on both fds with a selector (epoll on linux), reads up to
+BUFSIZE at once and writes everything with os.write, so that large outputs
+stream at the speed of ssh itself.
+'''
+
+import os
+import sys
+import tty
+import errno
+import select
+import selectors
+
+
+BUFSIZE = 64 * 1024
+
+_BLANK = b' \t\r\n\x0b\x0c'
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        try:
+            n = os.write(fd, view)
+        except BlockingIOError:
+            select.select([], [fd], [])
+            continue
+        view = view[n:]
+
+
+def _read(fd):
+    '''Return b'' at EOF, which is EIO for the master of a pty on linux.'''
+    try:
+        return os.read(fd, BUFSIZE)
+    except OSError as e:
+        if e.errno == errno.EIO:
+            return b''
+        raise
+
+
+def interact(p, skip_blank=False, on_first_byte=None, stdin=None, stdout=None):
+    '''
+    Relay until the child closes its pty.
+
+    With skip_blank, the leading whitespace of the output (what ssh prints
+    before the remote shell does) is dropped, and on_first_byte() is called
+    once the remote sent anything else.
+    '''
+    stdin = sys.stdin.fileno() if stdin is None else stdin
+    stdout = sys.stdout.fileno() if stdout is None else stdout
+    child = p.child_fd
+
+    # what expect() has read beyond its match
+    pending = p.buffer
+    p.buffer = b''
+
+    mode = None
+    if os.isatty(stdin):
+        mode = tty.tcgetattr(stdin)
+        tty.setraw(stdin)
+
+    selector = selectors.DefaultSelector()
+    selector.register(child, selectors.EVENT_READ)
+    selector.register(stdin, selectors.EVENT_READ)
+    try:
+        data = pending
+        while True:
+            if data and skip_blank:
+                data = data.lstrip(_BLANK)
+                if data:
+                    skip_blank = False
+                    if on_first_byte:
+                        on_first_byte()
+            if data:
+                _write_all(stdout, data)
+
+            data = b''
+            for key, _ in selector.select():
+                if key.fd == child:
+                    data = _read(child)
+                    if not data:
+                        return
+                elif key.fd == stdin:
+                    chunk = _read(stdin)
+                    if chunk:
+                        _write_all(child, chunk)
+                    else:
+                        selector.unregister(stdin)
+    finally:
+        selector.close()
+        if mode is not None:
+            tty.tcsetattr(stdin, tty.TCSAFLUSH, mode)
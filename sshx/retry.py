@@ -0,0 +1,102 @@
+'''
+Retry policy of --retry: exponential backoff with jitter, and circuit
+breakers per host.
+
+Failures are classified by the outcome of auth. A denied password or a
+changed host key won't be accepted by retrying, so it stops at once, while timeouts and
+connection errors back off: the delay before the n-th retry is
+interval * 2 ** n, capped by max_interval, of which a random half is
+taken, so that sessions failed together don't retry in lockstep.
+
+After BREAKER_THRESHOLD failures in a row at the same host, its breaker
+opens and every session of the process connecting through that host waits
+BREAKER_COOLDOWN seconds before trying again.
+'''
+
+import time
+import random
+import threading
+
+from . import const as c
+
+
+TIMEOUT = 'timeout'
+CONNECTION_ERROR = 'connection_error'
+AUTH_DENIED = 'auth_denied'
+HOST_KEY_CHANGED = 'host_key_changed'
+
+RETRYABLE = (TIMEOUT, CONNECTION_ERROR)
+
+_OUTCOMES = {
+    c.MSG_CONNECTION_TIMED_OUT: TIMEOUT,
+    c.MSG_CONNECTION_ERROR: CONNECTION_ERROR,
+    c.MSG_AUTH_FAILED: AUTH_DENIED,
+    c.MSG_HOST_KEY_VERIFICATION_FAILED: HOST_KEY_CHANGED,
+}
+
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+
+
+def classify(error):
+    '''Return the outcome of an error message of auth.'''
+    return _OUTCOMES.get(error, CONNECTION_ERROR)
+
+
+class RetryPolicy(object):
+    def __init__(self, retries=0, interval=5, max_interval=300, multiplier=2):
+        self.retries = retries
+        self.interval = interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+
+    def should_retry(self, attempt, outcome):
+        '''Whether to retry after `attempt` retries, failed by outcome.'''
+        if outcome not in RETRYABLE:
+            return False
+        return self.retries == 'always' or attempt < self.retries
+
+    def delay(self, attempt):
+        '''Seconds to sleep before the retry after `attempt` retries.'''
+        delay = min(self.max_interval, self.interval * self.multiplier ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+class CircuitBreaker(object):
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                # stays open for cooldown since the last failure
+                self.opened = time.time()
+
+    def remaining(self):
+        '''Seconds until the breaker lets sessions try again, 0 if closed.'''
+        with self.lock:
+            if self.opened is None:
+                return 0
+            return max(0, self.opened + self.cooldown - time.time())
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name):
+    '''Return the breaker of the host of the account name.'''
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker()
+        return _breakers[name]
@@ -0,0 +1,208 @@
+'''
+Search of the accounts for `sshx list`.
+
+The listed fields of every account are kept lowercased in
+cfg.SEARCH_INDEX_FILE, next to the accounts file, along with the stat of
+the accounts file it was built from. While that stat doesn't change, a
+listing reads the index only, without parsing (or asking the agent for)
+the accounts.
+
+A query is a list of terms which all have to match. A term matches if any
+of the fields matches it, `field:term` limits it to a field, e.g.
+`via:jump1 web`. Terms are matched case insensitively by the mode:
+
+    substring  the term is a part of the field
+    glob       fnmatch pattern of the whole field, e.g. web-*
+    regex      re.search() of the field
+    fuzzy      the characters of the term appear in the field in order,
+               results are ranked by how close they are
+
+Substring terms of any field are found by a single scan of the index, the
+other modes test the fields one by one.
+'''
+
+import os
+import re
+import json
+import bisect
+import fnmatch
+
+from . import cfg, utils, logger
+
+
+FIELDS = ('name', 'host', 'user', 'via')
+SUBSTRING = 'substring'
+GLOB = 'glob'
+REGEX = 'regex'
+FUZZY = 'fuzzy'
+MODES = [SUBSTRING, GLOB, REGEX, FUZZY]
+
+_VERSION = 1
+# Separators of fields and rows in the scanned text, no term contains them.
+_FS = '\x1f'
+_RS = '\n'
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _source_stat():
+    try:
+        st = os.stat(cfg.ACCOUNT_FILE)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+class Index(object):
+    '''The rows (name, host, user, via) of all accounts, in the order of the config.'''
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.lower = [tuple(v.lower() for v in row) for row in rows]
+        self._text = None
+
+    @classmethod
+    def from_accounts(cls, accounts):
+        return cls([tuple(getattr(a, f) for f in FIELDS) for a in accounts])
+
+    def _scan_text(self):
+        '''Return (text of all rows, offsets where the rows start).'''
+        if self._text is None:
+            lines = [_FS.join(row) for row in self.lower]
+            starts, offset = [], 0
+            for line in lines:
+                starts.append(offset)
+                offset += len(line) + 1
+            self._text = _RS.join(lines), starts
+        return self._text
+
+    def scan(self, term):
+        '''Return the indexes of the rows where any field contains term.'''
+        text, starts = self._scan_text()
+        found = []
+        i = text.find(term)
+        while i >= 0:
+            row = bisect.bisect_right(starts, i) - 1
+            found.append(row)
+            # continue from the next row
+            i = text.find(term, starts[row + 1]) if row + 1 < len(starts) else -1
+        return found
+
+
+def load_index():
+    '''Return the persisted index if it's up to date, or None.'''
+    try:
+        with open(cfg.SEARCH_INDEX_FILE, encoding='utf-8') as f:
+            d = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if d.get('version') != _VERSION or d.get('source') != _source_stat():
+        return None
+    return Index([tuple(row) for row in d['rows']])
+
+
+def save_index(index, source):
+    try:
+        utils.atomic_write(cfg.SEARCH_INDEX_FILE, json.dumps(
+            {'version': _VERSION, 'source': source, 'rows': index.rows}, separators=(',', ':')))
+    except OSError as e:
+        # only slower next time
+        logger.debug(f'Failed to write the search index: {e}')
+
+
+def get_index(config):
+    '''Return the index of the accounts, rebuilt from config if stale.'''
+    index = load_index()
+    if index is None:
+        # stat before reading, a write in between only makes the index stale
+        source = _source_stat()
+        index = Index.from_accounts(config.get_accounts())
+        if source is not None:
+            save_index(index, source)
+    return index
+
+
+def _fuzzy_score(term, pattern, value):
+    '''Return how many characters the closest match skips, or None.'''
+    best = None
+    start = value.find(term[0])
+    while start >= 0:
+        m = pattern.match(value, start)
+        if not m:
+            # no later start matches either
+            break
+        if best is None or m.end() - start < best:
+            best = m.end() - start
+        start = value.find(term[0], start + 1)
+    return None if best is None else best - len(term)
+
+
+def _matcher(term, mode):
+    '''Return a function (value) -> score or None, a lower score is better.'''
+    if mode != REGEX:
+        term = term.lower()
+    if mode == SUBSTRING or (mode == FUZZY and not term):
+        return lambda v: 0 if term in v else None
+    if mode == FUZZY:
+        pattern = re.compile('.*?'.join(map(re.escape, term)))
+        return lambda v: _fuzzy_score(term, pattern, v)
+
+    if mode == GLOB:
+        search = re.compile(fnmatch.translate(term)).match
+    else:
+        try:
+            # a lowercased pattern would mean something else, e.g. \S
+            search = re.compile(term, re.IGNORECASE).search
+        except re.error as e:
+            raise QueryError(f'Bad regex {term}: {e}')
+    return lambda v: 0 if search(v) else None
+
+
+def parse_query(query):
+    '''Return [(field index or None, term)] of the query terms.'''
+    terms = []
+    for q in query:
+        field, sep, term = q.partition(':')
+        if sep and field.lower() in FIELDS:
+            terms.append((FIELDS.index(field.lower()), term))
+        else:
+            terms.append((None, q))
+    return terms
+
+
+def search(index, query=(), mode=SUBSTRING):
+    '''Return the indexes of the rows matching all terms, with their scores.'''
+    candidates = range(len(index.rows))
+    scores = dict.fromkeys(candidates, 0)
+    for field, term in parse_query(query):
+        if mode == SUBSTRING and field is None:
+            found = set(index.scan(term.lower())) if term else set(candidates)
+            candidates = [i for i in candidates if i in found]
+            continue
+
+        match = _matcher(term, mode)
+        matched = []
+        for i in candidates:
+            values = index.lower[i] if field is None else (index.lower[i][field],)
+            results = [s for s in map(match, values) if s is not None]
+            if results:
+                scores[i] += min(results)
+                matched.append(i)
+        candidates = matched
+    return [(i, scores[i]) for i in candidates]
+
+
+def find(config, query=(), mode=SUBSTRING, key='name', reverse=False):
+    '''
+    Return the rows (name, host, user, via) of the matched accounts, sorted
+    by key, or by score first in fuzzy mode.
+    '''
+    index = get_index(config)
+    found = search(index, query, mode)
+    k = FIELDS.index(key)
+    found.sort(key=lambda f: index.lower[f[0]][k], reverse=reverse)
+    if mode == FUZZY:
+        found.sort(key=lambda f: f[1])
+    return [index.rows[i] for i, _ in found]
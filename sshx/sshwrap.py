@@ -1,27 +1,45 @@
-# -*- coding: future_fstrings -*-
-
 import os
+import re
 import sys
-import uuid
+import atexit
+import shlex
 import time
+import hashlib
 import struct
 import termios
 import signal
 import fcntl
-import pexpect
+import importlib
+import lazy_object_proxy as lazy
 
 
 from . import const as c
-from . import utils, logger, cfg
+from . import utils, logger, cfg, trace, hostkeys
+from .account import Account
 from .sshx_forward import Forwards
 from .const import STATUS_SUCCESS, STATUS_FAIL
 
 
+# Defer pexpect until a process was actually spawned.
+pexpect = lazy.Proxy(lambda: importlib.import_module('pexpect'))
+
 LOCALHOST = '127.0.0.1'
 
 ServerAliveInterval = 0
 ServerAliveCountMax = 3
 
+Multiplex = False
+ControlPersist = 600
+
+_MUX_DIR = 'mux'
+
+_CHAINS_DIR = 'chains'
+# Cached chain configs unused for this long are removed.
+CHAIN_CONFIG_TTL = 7 * 24 * 3600
+
+# Files named by uuid4 were written by previous versions for every connection.
+_LEGACY_CHAIN_CONFIG = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
 
 def set_winsize(p):
     s = struct.pack("HHHH", 0, 0, 0, 0)
@@ -48,21 +66,18 @@ _SSH_KEEPALIVE = ' -o ServerAliveInterval={interval} -o ServerAliveCountMax={cou
 _SSH_COMMAND_PASSWORD = 'ssh \
 -o PreferredAuthentications=password \
 -o LogLevel=ERROR \
--o StrictHostKeyChecking=no \
--o UserKnownHostsFile=/dev/null \
+{hostkeys} \
 -o ExitOnForwardFailure=yes \
 {extras} {forwards} {jump} -p {port} {user}@{host} {cmd}'
 _SSH_COMMAND_IDENTITY = 'ssh \
 -o PreferredAuthentications=publickey \
 -o LogLevel=ERROR \
--o StrictHostKeyChecking=no \
--o UserKnownHostsFile=/dev/null \
+{hostkeys} \
 -o ExitOnForwardFailure=yes \
 -i {identity} {extras} {forwards} {jump} -p {port} {user}@{host} {cmd}'
 _SSH_CONFIG_GLOBAL = '''Host *
 \tLogLevel ERROR
-\tStrictHostKeyChecking no
-\tUserKnownHostsFile /dev/null
+{hostkeys}
 \tExitOnForwardFailure yes
 \tServerAliveInterval {interval}
 \tServerAliveCountMax {countmax}
@@ -72,22 +87,32 @@ _SSH_DEST = '{user}@{host}:{port}'
 _SCP_COMMAND_PASSWORD = 'scp -r \
 -oPreferredAuthentications=password \
 -o LogLevel=ERROR \
--oStrictHostKeyChecking=no \
--oUserKnownHostsFile=/dev/null \
+{hostkeys} \
 -oExitOnForwardFailure=yes \
-{jump} -P {port} {src} {dst}'
+{extras} {jump} -P {port} {src} {dst}'
 _SCP_COMMAND_IDENTITY = 'scp -r \
 -o LogLevel=ERROR \
--oStrictHostKeyChecking=no \
--oUserKnownHostsFile=/dev/null \
+{hostkeys} \
 -oExitOnForwardFailure=yes \
--i {identity} {jump} -P {port} {src} {dst}'
+-i {identity} {extras} {jump} -P {port} {src} {dst}'
 _SCP_COMMAND_CONFIG = 'scp -r {extras} {src} {dst}'
 _SSH_COPYID = 'ssh-copy-id \
 -o LogLevel=ERROR \
--o StrictHostKeyChecking=no \
--o UserKnownHostsFile=/dev/null \
+{hostkeys} \
 {extras} -i {identity} -p {port} {user}@{host}'
+_AUTH_PROMPTS = [
+    "Host key verification failed",
+    "Permission denied",
+    '[p|P]assword:', r'passphrase for key[\s\S]+?:']
+# Refused after the password was sent, with more tries left or not.
+_AUTH_DENIED = r'Permission denied(, please try again| \()'
+# Anything else printed after the password, left unread for the session.
+_AUTH_PASSED = r'(?=\S)'
+# Seconds to wait for the password to be refused, a session printing
+# nothing (e.g. -N) is taken as authenticated after it.
+AUTH_RESULT_TIMEOUT = 3
+_SSH_MULTIPLEX = ' -o ControlMaster={master} -o ControlPath={path} -o ControlPersist={persist}'
+_SSH_MUX_CONTROL = 'ssh -o ControlPath={path} -O {op} {name}'
 
 
 def set_keepalive(interval, countmax):
@@ -97,6 +122,109 @@ def set_keepalive(interval, countmax):
     ServerAliveCountMax = countmax
 
 
+def set_multiplex(multiplex, persist=600):
+    '''Reuse a per-account ControlMaster connection for sessions.
+
+    The master exits after idle for `persist` seconds.
+    '''
+    global Multiplex, ControlPersist
+    Multiplex = multiplex
+    ControlPersist = persist
+
+
+def control_path(name):
+    return os.path.join(cfg.CONFIG_DIR, _MUX_DIR, name)
+
+
+def compile_multiplex(name, master='auto'):
+    os.makedirs(os.path.join(cfg.CONFIG_DIR, _MUX_DIR),
+                mode=0o700, exist_ok=True)
+    return _SSH_MULTIPLEX.format(
+        master=master, path=control_path(name), persist=ControlPersist)
+
+
+def mux_control(name, op):
+    '''Send a control command (check, exit, ...) to the master of `name`.'''
+    path = control_path(name)
+    if not os.path.exists(path):
+        return False
+
+    cmd = _SSH_MUX_CONTROL.format(path=path, op=op, name=name)
+    logger.debug(cmd)
+
+    _, status = pexpect.run(cmd, withexitstatus=True)
+    return status == 0
+
+
+def mux_check(name):
+    return mux_control(name, 'check')
+
+
+def mux_stop(name):
+    stopped = mux_control(name, 'exit')
+    if os.path.exists(control_path(name)):
+        # stale socket of a dead master
+        utils.delete_file(control_path(name))
+    return stopped
+
+
+# Masters this process started for its own pipes or parallel scps, which
+# nobody asked to share (--mux), stopped when it exits instead of
+# persisting for ControlPersist.
+_own_masters = set()
+
+
+def claim_master(name):
+    '''Stop the master of `name` about to be started at exit, unless it's shared.'''
+    if Multiplex or name in _own_masters or mux_check(name):
+        return
+    if not _own_masters:
+        atexit.register(stop_own_masters)
+    _own_masters.add(name)
+
+
+def stop_own_masters():
+    while _own_masters:
+        mux_stop(_own_masters.pop())
+
+
+def mux_list():
+    '''Return [(name, alive)] of all known master sockets.'''
+    mux_dir = os.path.join(cfg.CONFIG_DIR, _MUX_DIR)
+    if not os.path.isdir(mux_dir):
+        return []
+    return [(name, mux_check(name)) for name in sorted(os.listdir(mux_dir))]
+
+
+def chains_dir():
+    return os.path.join(cfg.CONFIG_DIR, _CHAINS_DIR)
+
+
+def config_digest(config):
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()[:32]
+
+
+def gc_chain_configs(ttl=CHAIN_CONFIG_TTL):
+    '''Remove chain configs unused for `ttl` seconds, and the legacy ones.'''
+    orphans = []
+    if os.path.isdir(cfg.CONFIG_DIR):
+        orphans += [os.path.join(cfg.CONFIG_DIR, f) for f in os.listdir(cfg.CONFIG_DIR)
+                    if _LEGACY_CHAIN_CONFIG.match(f)]
+    if os.path.isdir(chains_dir()):
+        expire = time.time() - ttl
+        for f in os.listdir(chains_dir()):
+            path = os.path.join(chains_dir(), f)
+            try:
+                if os.stat(path).st_mtime < expire:
+                    orphans.append(path)
+            except OSError:
+                pass
+
+    for path in orphans:
+        utils.delete_file(path)
+    return len(orphans)
+
+
 class AccountChain(object):
     def __init__(self, account, vias=None):
         self.accounts = self.get_accounts(account, vias=vias)
@@ -108,8 +236,9 @@ class AccountChain(object):
                         for v in vias.split(',')]
             accounts.append(account)
 
-            for i in range(1, len(accounts)):
-                accounts[i].via = accounts[i - 1].name
+            # chained by copies, the accounts of the config keep their via
+            accounts[1:] = [Account(**dict(a.to_dict(), via=prev.name))
+                            for prev, a in zip(accounts, accounts[1:])]
         else:
             accounts = []
             a = cfg.config.get_account(account.via, decrypt=True)
@@ -126,35 +255,56 @@ class AccountChain(object):
         jump = (prefix + ','.join(dests)) if dests else ''
         return jump
 
+    def get_auth_accounts(self):
+        '''Accounts which would be asked for a password or passphrase, in order.'''
+        return [a for a in self.accounts if not a.identity or a.passphrase]
+
     def get_passwords(self):
-        passwords = []
-        for a in self.accounts:
-            if not a.identity:
-                passwords.append(a.password)
-            elif a.passphrase:
-                passwords.append(a.passphrase)
-        return passwords
+        return [a.passphrase if a.identity else a.password
+                for a in self.get_auth_accounts()]
 
     def has_identity(self):
         return any(map(lambda a: a.identity, self.accounts))
 
+    def host_config(self, account):
+        c = account.to_ssh_config()
+        if hostkeys.Enabled:
+            # after the Host line, since a ProxyCommand line ends the block
+            c = c.replace('\n', f'\n\tHostKeyAlias {account.name}\n', 1)
+        return c
+
     def get_config(self):
         global_config = _SSH_CONFIG_GLOBAL.format(
+            hostkeys=hostkeys.ssh_config(),
             interval=ServerAliveInterval,
             countmax=ServerAliveCountMax)
         config_list = [global_config] + \
-            [a.to_ssh_config() for a in self.accounts]
+            [self.host_config(a) for a in self.accounts]
         config = '\n'.join(config_list)
-        self.config_file = os.path.join(cfg.CONFIG_DIR, str(uuid.uuid4()))
-        with open(self.config_file, 'w') as f:
-            config = config.format(config=self.config_file)
-            logger.debug(config)
-            f.write(config)
+
+        # Named by the digest of the content, so that the same chain reuses
+        # the file, and a changed account in the chain gets a new one.
+        self.config_file = os.path.join(chains_dir(), config_digest(config))
+        config = config.format(config=self.config_file)
+        logger.debug(config)
+
+        try:
+            with open(self.config_file, 'r') as f:
+                if f.read() == config:
+                    # keep it from gc
+                    os.utime(self.config_file)
+                    return self.config_file
+        except OSError:
+            pass
+
+        os.makedirs(chains_dir(), mode=0o700, exist_ok=True)
+        utils.atomic_write(self.config_file, config)
+        gc_chain_configs()
         return self.config_file
 
 
 class SSHPexpect(object):
-    def __init__(self, account, vias=None, forwards=None, extras='', tty=True, background=False, execute=True, cmd='', detach=False, keepalive=True):
+    def __init__(self, account, vias=None, forwards=None, extras='', tty=True, background=False, execute=True, cmd='', detach=False, keepalive=True, multiplex=None):
         self.account = account
         self.vias = vias
         self.forwards = forwards.compile() if forwards else ''
@@ -172,7 +322,27 @@ class SSHPexpect(object):
         self.tty = False if self.detach else tty
         self.keepalive = keepalive
 
+        # Forwardings requested through a master would outlive this
+        # process, so only sessions are multiplexed.
+        if multiplex is None:
+            multiplex = Multiplex
+        self.multiplex = multiplex and execute
+        self.reuse_master = False
+
         self.p = None
+        self.auth_accounts = []
+        # (outcome, name of the hop) of the last failed attempt
+        self.failure = None
+        self.session = trace.new_session()
+        self.first_byte = None
+
+    def span(self, name, **attrs):
+        return trace.span(name, session=self.session, account=self.account.name, **attrs)
+
+    def new_first_byte(self):
+        # From sending the last password, or from auth without one, until
+        # the remote sends anything.
+        return trace.Span('first_byte', session=self.session, account=self.account.name)
 
     def compile_flags(self):
         _flags_maps = [
@@ -203,6 +373,7 @@ class SSHPexpect(object):
         self.chain = AccountChain(self.account, vias=self.vias)
         self.jump = self.chain.get_jump()
         self.passwords = self.chain.get_passwords()
+        self.auth_accounts = self.chain.get_auth_accounts()
 
         self.compile_extras()
 
@@ -220,6 +391,8 @@ class SSHPexpect(object):
                 interval=ServerAliveInterval,
                 countmax=ServerAliveCountMax,
             )
+        if self.multiplex:
+            self.extras += compile_multiplex(self.account.name)
 
     def compile_pure_command(self):
         account = self.account
@@ -231,6 +404,7 @@ class SSHPexpect(object):
                 host=account.host,
                 port=account.port,
                 identity=account.identity,
+                hostkeys=hostkeys.ssh_options(account.name),
                 extras=self.extras,
                 cmd=self.cmd)
         else:
@@ -240,6 +414,7 @@ class SSHPexpect(object):
                 user=account.user,
                 host=account.host,
                 port=account.port,
+                hostkeys=hostkeys.ssh_options(account.name),
                 extras=self.extras,
                 cmd=self.cmd)
         return command
@@ -256,35 +431,79 @@ class SSHPexpect(object):
         return command
 
     def auth(self):
-        if self.passwords:
-            it = iter(self.passwords)
-            password = next(it)
-            while True:
-                r = self.p.expect([
-                    pexpect.TIMEOUT, pexpect.EOF,
-                    "(?i)are you sure you want to continue connecting",
-                    "Permission denied",
-                    '[p|P]assword:', r'passphrase for key[\s\S]+?:'])
-                if r == 0:
-                    logger.error(c.MSG_CONNECTION_TIMED_OUT)
-                    return False
-                elif r == 1:
-                    logger.error(c.MSG_CONNECTION_ERROR)
-                    return False
-                elif r == 2:
-                    self.p.sendline('yes')
-                    continue
-                elif r == 3:
-                    logger.error(c.MSG_AUTH_FAILED)
-                    return False
-                else:
-                    self.p.sendline(password)
-                    try:
-                        password = next(it)
-                    except StopIteration:
-                        break
+        if self.reuse_master:
+            logger.debug('reuse master connection, skip auth')
+            return True
+
+        names = [a.name for a in self.auth_accounts]
+        for hop, password in enumerate(self.passwords):
+            # From connecting to the hop until it asks for the password.
+            with self.span('auth.hop', hop=hop,
+                           hop_account=names[hop] if hop < len(names) else '') as s:
+                error = self.wait_password_prompt()
+                if error:
+                    s.update(ok=False, error=error)
+            if not error:
+                prompt = self.p.after
+                last = hop == len(self.passwords) - 1
+                self.p.sendline(password)
+                if last:
+                    self.first_byte = self.new_first_byte()
+                error = self.wait_password_result(prompt, last)
+            if error:
+                logger.error(error)
+                hop_name = names[hop] if hop < len(names) else self.account.name
+                from . import retry as _retry
+                self.failure = (_retry.classify(error), hop_name)
+                return False
         return True
 
+    def auth_timeout(self, timeout=-1):
+        '''Timeout of an expect() of auth, -1 for the one of the spawn.'''
+        return timeout
+
+    def wait_password_prompt(self):
+        '''Return None once asked for the password, otherwise the error message.'''
+        while True:
+            r = self.p.expect(
+                [pexpect.TIMEOUT, pexpect.EOF] + _AUTH_PROMPTS, timeout=self.auth_timeout())
+            if r == 0:
+                return c.MSG_CONNECTION_TIMED_OUT
+            elif r == 1:
+                return c.MSG_CONNECTION_ERROR
+            elif r == 2:
+                return c.MSG_HOST_KEY_VERIFICATION_FAILED
+            elif r == 3:
+                return c.MSG_AUTH_FAILED
+            else:
+                return None
+
+    def wait_password_result(self, prompt, last):
+        '''Return MSG_AUTH_FAILED if the password sent after prompt was refused.
+
+        ssh asking the last password again means it was wrong as well, while
+        the prompt of the next hop is left unread for wait_password_prompt().
+        '''
+        patterns = [pexpect.TIMEOUT, pexpect.EOF, _AUTH_DENIED]
+        if last:
+            patterns.append(re.escape(prompt))
+        r = self.p.expect(patterns + [_AUTH_PASSED], timeout=self.auth_timeout(AUTH_RESULT_TIMEOUT))
+        if 2 <= r < len(patterns):
+            return c.MSG_AUTH_FAILED
+        self.unread()
+        return None
+
+    def unread(self):
+        '''Put back all the last expect() read, for the next one to read again.'''
+        p = self.p
+        data = p.before + (p.after if isinstance(p.after, bytes) else b'') + p.buffer
+        # pexpect searches _buffer, and makes `before` of _before, which
+        # both hold the unmatched data after a match
+        p._buffer = p.buffer_type()
+        p._buffer.write(data)
+        p._before = p.buffer_type()
+        p._before.write(data)
+
     def drain_child_buffer(self):
         '''Read all data from child to make it eof.'''
         try:
@@ -313,10 +532,11 @@ class SSHPexpect(object):
         return True
 
     def interactive(self):
+        from . import ptyrelay
         p = self.p
         if self.background:
             if self.execute:
-                p.interact(escape_character=None)
+                ptyrelay.interact(p)
             else:
                 self.drain_child_buffer()
         else:
@@ -324,53 +544,65 @@ class SSHPexpect(object):
             # Set auto-adjust window size
             signal.signal(signal.SIGWINCH, sigwinch_passthrough(p))
 
-            # r = p.expect([pexpect.TIMEOUT, '\S'])
-            # if r == 1:
-            #     p.write_to_stdout(p.after)
-
-            # find the first non-empty character
-            # block forever if not found
-            p.expect(r'\S', timeout=None)
-            p.write_to_stdout(p.after)
-
-            p.interact(escape_character=None)
+            # skip the blank lines before the first non-empty character
+            ptyrelay.interact(p, skip_blank=True, on_first_byte=self.first_byte.end)
         return STATUS_SUCCESS
 
-    def run(self, retry=0, retry_interval=5):
+    def run(self, retry=0, retry_interval=5, retry_max_interval=300):
         if self.detach:
             if self.daemonize():
                 return STATUS_SUCCESS
 
-        self.command = self.compile_command()
+        with self.span('compile'):
+            self.command = self.compile_command()
         logger.debug(self.command)
 
+        from . import retry as _retry
+        policy = _retry.RetryPolicy(retry, retry_interval, max_interval=retry_max_interval)
         _try = 0
         while True:
-            ret = self.start_process()
+            self.failure = None
+            with self.span('session', attempt=_try) as s:
+                ret = self.start_process()
+                s['ok'] = ret == STATUS_SUCCESS
+            outcome, hop_name = self.failure or (_retry.CONNECTION_ERROR, self.account.name)
+            breaker = _retry.breaker(hop_name)
             if ret == STATUS_SUCCESS:
+                breaker.success()
                 return STATUS_SUCCESS
+            breaker.failure()
 
-            if retry == 'always' or retry > 0:
-                if retry == 'always' or _try < retry:
-                    _try += 1
-                    logger.info(
-                        f'failed, sleep {retry_interval}s before retry.')
-                    time.sleep(retry_interval)
-                    logger.info(f'retry: {_try}')
-                    continue
-                logger.error('still failed, please check the network.')
-            return STATUS_FAIL
+            if not policy.should_retry(_try, outcome):
+                if outcome not in _retry.RETRYABLE:
+                    logger.error(f'{hop_name}: {outcome}, not retrying.')
+                elif retry:
+                    logger.error('still failed, please check the network.')
+                return STATUS_FAIL
+
+            delay = policy.delay(_try)
+            if breaker.remaining() > delay:
+                delay = breaker.remaining()
+                logger.info(f'{hop_name} keeps failing, wait {delay:.1f}s.')
+            _try += 1
+            logger.info(f'failed, sleep {delay:.1f}s before retry.')
+            time.sleep(delay)
+            logger.info(f'retry: {_try}')
 
     def start_process(self):
         try:
-            self.p = pexpect.spawn(self.command)
-
-            if not self.auth():
+            self.reuse_master = self.multiplex and mux_check(self.account.name)
+            with self.span('spawn'):
+                self.p = pexpect.spawn(self.command)
+
+            self.first_byte = None
+            with self.span('auth', hops=len(self.passwords),
+                           reuse_master=self.reuse_master) as s:
+                s['ok'] = self.auth()
+            if not s['ok']:
                 return STATUS_FAIL
 
-            if self.need_config():
-                utils.delete_file(self.chain.config_file)
-
+            if self.first_byte is None:
+                self.first_byte = self.new_first_byte()
             return self.interactive()
         except Exception as e:
             logger.error(c.MSG_CONNECTION_ERROR)
@@ -384,8 +616,9 @@ class SSHPexpect(object):
 
 
 class SCPPexpect(SSHPexpect):
-    def __init__(self, account, targets, vias):
-        super().__init__(account, vias=vias, keepalive=False)
+    def __init__(self, account, targets, vias, extras='', multiplex=None):
+        super().__init__(account, vias=vias, extras=extras, keepalive=False,
+                         multiplex=multiplex)
         self.targets = targets
         self.vias = vias
 
@@ -399,13 +632,17 @@ class SCPPexpect(SSHPexpect):
                 port=account.port,
                 src=src,
                 dst=dst,
-                identity=account.identity)
+                identity=account.identity,
+                hostkeys=hostkeys.ssh_options(account.name),
+                extras=self.extras)
         else:
             command = _SCP_COMMAND_PASSWORD.format(
                 jump=self.jump,
                 port=account.port,
                 src=src,
-                dst=dst)
+                dst=dst,
+                hostkeys=hostkeys.ssh_options(account.name),
+                extras=self.extras)
         return command
 
     def compile_config_command(self):
@@ -421,12 +658,43 @@ class SCPPexpect(SSHPexpect):
         return command
 
 
+class SCPJob(SCPPexpect):
+    '''A quiet scp for running in parallel, which waits for scp to exit.'''
+
+    def __init__(self, account, unit, vias):
+        super().__init__(account, unit.targets(), vias, extras='-q', multiplex=True)
+        self.unit = unit
+        self.exitstatus = None
+
+    def interactive(self):
+        p = self.p
+        p.expect(pexpect.EOF, timeout=None)
+        p.close()
+        self.exitstatus = p.exitstatus
+        if self.exitstatus != 0:
+            output = p.before.decode('utf-8', errors='replace').strip()
+            logger.error(f'scp {self.unit.sources[0]}: {output or self.exitstatus}')
+            return STATUS_FAIL
+        return STATUS_SUCCESS
+
+
 class CmdWithForwarding(SSHPexpect):
-    def __init__(self, account, vias=None, forwards=None, extras='', tty=True, background=False, execute=True, cmd='', detach=False):
+    '''
+    Forward a local port to the account through its jump hosts, then run
+    the command against the forwarded port. The port is allocated and
+    released by itself, unless given, e.g. by ports.allocate(n) for n jobs.
+    '''
+
+    def __init__(self, account, vias=None, forwards=None, extras='', tty=True, background=False, execute=True, cmd='', detach=False, port=None):
         super().__init__(account, vias=vias, forwards=forwards,
                          extras=extras, tty=tty, background=background,
                          execute=execute, cmd=cmd, detach=detach, keepalive=False)
+        self.port = port
+        self.own_port = False
         self.forwarding = self.create_forwarding()
+        if self.forwarding:
+            # The forwarded local port changes every time.
+            self.multiplex = False
 
     def create_forwarding(self):
         account = self.account
@@ -436,20 +704,33 @@ class CmdWithForwarding(SSHPexpect):
         if jumps:
             jump1 = jumps.pop()
             host = LOCALHOST
-            port = find_available_port()
+            if self.port is None:
+                self.port = find_available_port()
+                self.own_port = True
+            port = self.port
             maps = f'{host}:{port}:{account.host}:{account.port}'
             forwards = Forwards(maps, '')
 
             vias = ','.join([a.name for a in jumps])
 
-            # change account to local forwarded account
-            account.host = host
-            account.port = port
-            account.via = ''
+            # connect to the local forwarded port, by a copy of the account
+            # of the config
+            self.account = Account(**dict(account.to_dict(), host=host, port=port, via=''))
             self.vias = ''
             return SSHPexpect(
                 jump1, vias=vias, forwards=forwards,
-                tty=False, background=True, execute=False, keepalive=False)
+                tty=False, background=True, execute=False, keepalive=False,
+                multiplex=False)
+
+    def run(self, *args, **kwargs):
+        # every retry forwards the same port, so it's released after the last
+        try:
+            return super().run(*args, **kwargs)
+        finally:
+            if self.own_port:
+                from . import ports
+                ports.release([self.port])
+                self.own_port = False
 
     def start_process(self):
         if self.forwarding:
@@ -489,13 +770,17 @@ class SCPPexpect2(CmdWithForwarding):
                 port=account.port,
                 src=src,
                 dst=dst,
-                identity=account.identity)
+                identity=account.identity,
+                hostkeys=hostkeys.ssh_options(account.name),
+                extras=self.extras)
         else:
             command = _SCP_COMMAND_PASSWORD.format(
                 jump='',
                 port=account.port,
                 src=src,
-                dst=dst)
+                dst=dst,
+                hostkeys=hostkeys.ssh_options(account.name),
+                extras=self.extras)
         return command
 
 
@@ -507,6 +792,7 @@ class SSHCopyId(CmdWithForwarding):
     def compile_pure_command(self):
         account = self.account
         command = _SSH_COPYID.format(
+            hostkeys=hostkeys.ssh_options(account.name),
             extras=self.extras,
             identity=self.identity,
             user=account.user,
@@ -533,26 +819,106 @@ class SSHCopyId(CmdWithForwarding):
         return STATUS_FAIL
 
 
+class ExecPexpect(SSHPexpect):
+    '''Execute a command without tty and pass every output line to `output`.
+
+    `timeout` limits the whole execution including auth, in seconds.
+    '''
+
+    def __init__(self, account, cmd, vias=None, output=None, timeout=None, multiplex=None):
+        super().__init__(account, vias=vias, tty=False, cmd=cmd, multiplex=multiplex)
+        self.output = output or (lambda account, line: print(line))
+        self.timeout = timeout
+        self.exitstatus = None
+        self.timed_out = False
+        self.elapsed = 0
+        self._start = None
+
+    def remaining(self):
+        if self.timeout is None:
+            return None
+        return max(self.timeout - (time.time() - self._start), 0)
+
+    def auth_timeout(self, timeout=-1):
+        # auth is part of the execution, it never waits beyond the budget
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout == -1:
+            timeout = self.p.timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def start_process(self):
+        self._start = time.time()
+        try:
+            return super().start_process()
+        finally:
+            self.elapsed = time.time() - self._start
+            if self.failure and self.remaining() == 0:
+                # auth ran out of the budget
+                self.timed_out = True
+
+    def emit(self, data):
+        self.first_byte.end()
+        line = data.decode('utf-8', errors='replace')
+        self.output(self.account, line)
+
+    def interactive(self):
+        p = self.p
+        while True:
+            r = p.expect([r'\r?\n', pexpect.EOF, pexpect.TIMEOUT],
+                         timeout=self.remaining())
+            if r == 0:
+                self.emit(p.before)
+            elif r == 1:
+                if p.before:
+                    self.emit(p.before)
+                self.first_byte.end(ok=False)
+                break
+            else:
+                logger.error(
+                    f'{self.account.name}: {c.MSG_CONNECTION_TIMED_OUT}')
+                self.timed_out = True
+                p.close(force=True)
+                return STATUS_FAIL
+
+        p.close()
+        self.exitstatus = p.exitstatus
+        return STATUS_SUCCESS if self.exitstatus == 0 else STATUS_FAIL
+
+
+def pexec(accounts, cmd, vias=None, jobs=10, timeout=None, output=None):
+    '''Execute `cmd` on every account with at most `jobs` concurrent sessions.
+
+    Accounts (and their jump hosts) must be decrypted before calling.
+    Return the finished ExecPexpect of every account, in the same order.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    sessions = [ExecPexpect(a, cmd, vias=vias, output=output, timeout=timeout)
+                for a in accounts]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        statuses = list(executor.map(lambda p: p.run(), sessions))
+
+    for p, status in zip(sessions, statuses):
+        p.status = status
+    return sessions
+
+
 def find_available_port():
-    import socket
-    import random
-
-    while True:
-        port = random.randint(50000, 60000)
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            res = sock.connect_ex((LOCALHOST, port))
-            if res == 0:
-                continue
-            return port
+    '''Reserve a free local port, which should be released by ports.release().'''
+    from . import ports
+    return ports.allocate(1, host=LOCALHOST)[0]
 
 
 def ssh(account, vias=None, forwards=None, extras='', detach=False,
         tty=True, background=False, execute=True, cmd='',
-        retry=0, retry_interval=5):
+        retry=0, retry_interval=5, retry_max_interval=300):
     p = SSHPexpect(account,
                    vias=vias, forwards=forwards, extras=extras, detach=detach,
                    tty=tty, background=background, execute=execute, cmd=cmd)
-    return p.run(retry=retry, retry_interval=retry_interval)
+    return p.run(retry=retry, retry_interval=retry_interval,
+                 retry_max_interval=retry_max_interval)
 
 
 def scp(account, targets, vias=None, with_forward=False):
@@ -561,6 +927,256 @@ def scp(account, targets, vias=None, with_forward=False):
     return p.run()
 
 
+def _start_master(account, cmd, vias=None):
+    '''Run cmd by the session starting the master, return the finished ExecPexpect,
+    whose status is STATUS_SUCCESS if cmd succeeded.'''
+    claim_master(account.name)
+    p = ExecPexpect(account, cmd, vias=vias, multiplex=True,
+                    output=lambda account, line: logger.info(line))
+    p.status = p.run()
+    if p.status != STATUS_SUCCESS or p.exitstatus != 0:
+        logger.error(f'Failed to prepare {account.name}: {cmd}')
+        p.status = STATUS_FAIL
+    return p
+
+
+# Bytes of the directories created by one mkdir, well below the 128 KiB
+# (MAX_ARG_STRLEN) of the single argument the remote shell gets it in.
+MAX_MKDIR_BYTES = 64 * 1024
+
+
+def mkdir_commands(dirs, max_bytes=MAX_MKDIR_BYTES):
+    '''Return the `mkdir -p` commands creating dirs, at most max_bytes of them each.'''
+    commands, words, size = [], [], 0
+    for d in dirs:
+        word = shlex.quote(d)
+        if words and size + len(word.encode('utf-8')) > max_bytes:
+            commands.append('mkdir -p ' + ' '.join(words))
+            words, size = [], 0
+        words.append(word)
+        size += len(word.encode('utf-8')) + 1
+    if words:
+        commands.append('mkdir -p ' + ' '.join(words))
+    return commands
+
+
+def pscp(account, units, vias=None, jobs=4, mkdirs=None):
+    '''Copy the units by `jobs` concurrent scp sharing a master connection.
+
+    The remote directories `mkdirs` are created first, by the session which
+    authenticates and starts the master, and the sessions reusing it if they
+    don't fit in one command. Return the finished SCPJob of every unit.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    for cmd in mkdir_commands(mkdirs or []) or ['true']:
+        if _start_master(account, cmd, vias).status != STATUS_SUCCESS:
+            return None
+
+    scps = [SCPJob(account, unit, vias) for unit in units]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        statuses = list(executor.map(lambda p: p.run(), scps))
+
+    for p, status in zip(scps, statuses):
+        p.status = status
+    return scps
+
+
+def open_pipe(account, cmd, vias=None):
+    '''Run cmd on the account with binary pipes, return the subprocess.Popen.
+
+    It goes through the master connection without a pty, so the master
+    must have been started, e.g. by ExecPexpect(..., multiplex=True).
+    BatchMode makes ssh fail instead of prompting if it has gone.
+    '''
+    import subprocess
+
+    p = SSHPexpect(account, vias=vias, tty=False, extras='-o BatchMode=yes',
+                   keepalive=False, multiplex=True)
+    # ssh joins the words after the destination by spaces, cmd goes as a
+    # single one to reach the remote shell as it was quoted
+    argv = shlex.split(p.compile_command()) + [cmd]
+    logger.debug(argv)
+    return subprocess.Popen(argv, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+class ExecError(Exception):
+    pass
+
+
+class ExecStream(object):
+    """Output of a remote command, read as it is consumed.
+
+        stream = exec_stream(account, 'cat /var/log/huge.log', lines=True)
+        for name, data in stream:   # name is 'stdout' or 'stderr'
+            ...
+        stream.returncode
+
+    Nothing is read ahead of the consumer, so a slow consumer makes ssh stop
+    reading the channel, and the remote command blocks on its output by
+    ssh flow control. A line is yielded in pieces of at most max_buffer
+    bytes, so memory stays bounded whatever the output looks like.
+    """
+
+    def __init__(self, p, lines=False, chunk_size=64 * 1024, max_buffer=1024 * 1024,
+                 encoding=None):
+        self.p = p
+        self.lines = lines
+        self.chunk_size = chunk_size
+        self.max_buffer = max_buffer
+        self.encoding = encoding
+        self.returncode = None
+
+    def _decode(self, data):
+        return data.decode(self.encoding, errors='replace') if self.encoding else data
+
+    def __iter__(self):
+        import selectors
+
+        p = self.p
+        p.stdin.close()
+        names = {p.stdout.fileno(): 'stdout', p.stderr.fileno(): 'stderr'}
+        pending = {'stdout': b'', 'stderr': b''}
+        selector = selectors.DefaultSelector()
+        for fd in names:
+            selector.register(fd, selectors.EVENT_READ)
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+                    name = names[key.fd]
+                    data = os.read(key.fd, self.chunk_size)
+                    if not data:
+                        selector.unregister(key.fd)
+                        if pending[name]:
+                            yield name, self._decode(pending[name])
+                        continue
+                    if not self.lines:
+                        yield name, self._decode(data)
+                        continue
+
+                    data = pending[name] + data
+                    start = 0
+                    while True:
+                        end = data.find(b'\n', start, start + self.max_buffer)
+                        if end >= 0:
+                            yield name, self._decode(data[start:end + 1])
+                            start = end + 1
+                        elif len(data) - start >= self.max_buffer:
+                            # an overlong line is yielded in pieces
+                            yield name, self._decode(data[start:start + self.max_buffer])
+                            start += self.max_buffer
+                        else:
+                            break
+                    pending[name] = data[start:]
+            self.returncode = p.wait()
+        finally:
+            selector.close()
+            self.close()
+        return self.returncode
+
+    def close(self):
+        """Stop the remote command if the output was not consumed to the end."""
+        p = self.p
+        if p.poll() is None:
+            p.kill()
+            p.wait()
+        p.stdout.close()
+        p.stderr.close()
+
+
+def exec_stream(account, cmd, vias=None, **kwargs):
+    """Run cmd on the account without a tty, return an ExecStream of its output.
+
+    Authenticate by a master connection first, which the stream goes through.
+    See ExecStream for the arguments.
+    """
+    if _start_master(account, 'true', vias).status != STATUS_SUCCESS:
+        raise ExecError(f'Failed to connect {account.name}.')
+    return ExecStream(open_pipe(account, cmd, vias=vias), **kwargs)
+
+
+RELAY_CHUNK = 1024 * 1024
+# Chunks buffered between the two sessions, so both links keep busy.
+RELAY_BUFFERS = 16
+
+
+def relay(src_account, src_path, dst_account, dst_dir, src_vias=None, dst_vias=None):
+    """Copy src_path of one account into dst_dir of another, piping tar between
+    two sessions through a bounded in-memory buffer, nothing is written locally.
+
+    Each side connects by its own jump chain. Return the bytes relayed, or None.
+    """
+    import queue
+    import threading
+
+    if _start_master(src_account, 'true', src_vias).status != STATUS_SUCCESS or \
+            _start_master(dst_account, f'mkdir -p {shlex.quote(dst_dir)}', dst_vias).status != STATUS_SUCCESS:
+        return None
+
+    parent, name = os.path.split(src_path.rstrip('/') or '/')
+    src = open_pipe(src_account, f'tar -C {shlex.quote(parent or "/")} -cf - {shlex.quote(name or ".")}',
+                    vias=src_vias)
+    dst = open_pipe(dst_account, f'tar -C {shlex.quote(dst_dir)} -xf -', vias=dst_vias)
+    src.stdin.close()
+
+    buffers = queue.Queue(maxsize=RELAY_BUFFERS)
+    relayed = [0]
+    errors = []
+    stderrs = {}
+
+    def _read():
+        try:
+            for data in iter(lambda: src.stdout.read1(RELAY_CHUNK), b''):
+                buffers.put(data)
+        except (OSError, ValueError) as e:
+            errors.append(f'{src_account.name}: {e}')
+        finally:
+            buffers.put(None)
+
+    def _write():
+        failed = False
+        for data in iter(buffers.get, None):
+            if failed:
+                continue
+            try:
+                dst.stdin.write(data)
+                relayed[0] += len(data)
+            except (OSError, ValueError) as e:
+                # keep draining, so the reader never blocks on a full queue,
+                # a broken pipe is told by the exit of tar
+                failed = True
+                if not isinstance(e, BrokenPipeError):
+                    errors.append(f'{dst_account.name}: {e}')
+        try:
+            dst.stdin.close()
+        except (OSError, ValueError):
+            pass
+
+    def _drain(p):
+        # read along, or tar blocks on a full stderr pipe
+        stderrs[p] = p.stderr.read()
+
+    threads = [threading.Thread(target=_read, daemon=True),
+               threading.Thread(target=_write, daemon=True),
+               threading.Thread(target=_drain, args=(src,), daemon=True),
+               threading.Thread(target=_drain, args=(dst,), daemon=True)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    for error in errors:
+        logger.error(error)
+    ok = not errors
+    for account, p in ((src_account, src), (dst_account, dst)):
+        stderr = stderrs[p].decode('utf-8', errors='replace').strip()
+        if p.wait() != 0:
+            logger.error(f'{account.name}: {stderr or f"exited with {p.returncode}"}')
+            ok = False
+    return relayed[0] if ok else None
+
+
 def ssh_copy_id(account, identity, vias=None):
     p = SSHCopyId(account, identity, vias=vias)
     return p.run()
@@ -0,0 +1,243 @@
+'''asyncio based session engine.
+
+AsyncSSHSession compiles the same ssh command as SSHPexpect, but matches
+the auth prompts and reads the output without blocking, so that a single
+event loop can drive many sessions at once.
+'''
+
+import os
+import re
+import asyncio
+import pexpect
+
+from . import const as c
+from . import logger
+from .sshwrap import SSHPexpect, _AUTH_PROMPTS
+from .const import STATUS_SUCCESS, STATUS_FAIL
+
+
+TIMEOUT = 0
+EOF = 1
+
+BUFSIZE = 64 * 1024
+
+
+class AsyncSSHSession(SSHPexpect):
+    '''
+    session = AsyncSSHSession(account, cmd='uptime')
+    await session.start()
+    async for chunk in session.stream():
+        ...
+    status = await session.wait()
+
+    Or simply `await session.run()` and `await session.exec(cmd)`.
+    '''
+
+    def __init__(self, account, vias=None, forwards=None, extras='', tty=False,
+                 execute=True, cmd='', timeout=30, output=None):
+        super().__init__(account, vias=vias, forwards=forwards, extras=extras,
+                         tty=tty, background=True, execute=execute, cmd=cmd,
+                         multiplex=False)
+        self.timeout = timeout
+        self.output = output
+        self.command = None
+        # compile_command() appends to extras, so it starts over from these
+        self._extras = extras
+        # the cmd self.command was compiled for
+        self._command_cmd = cmd
+        self.chain = None
+        self.exitstatus = None
+        self.buffer = b''
+        self.before = b''
+        self.after = b''
+        self.eof = False
+
+    async def read(self, timeout=None):
+        '''Read a chunk from the child, return b'' on EOF.'''
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        if self.eof:
+            return b''
+
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        fd = self.p.child_fd
+
+        def _readable():
+            loop.remove_reader(fd)
+            try:
+                data = os.read(fd, BUFSIZE)
+            except OSError:
+                # Linux raises EIO when the child closed the pty
+                data = b''
+            if not fut.done():
+                fut.set_result(data)
+
+        loop.add_reader(fd, _readable)
+        try:
+            data = await asyncio.wait_for(fut, timeout)
+        finally:
+            loop.remove_reader(fd)
+
+        if not data:
+            self.eof = True
+        return data
+
+    async def expect(self, patterns, timeout=None):
+        '''Return the index of the first matched pattern, or TIMEOUT/EOF.
+
+        Patterns are indexed from 2, like [pexpect.TIMEOUT, pexpect.EOF] + patterns.
+        '''
+        regexes = [re.compile(p.encode('utf-8')) for p in patterns]
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        while True:
+            matches = [(m.start(), i) for i, m in
+                       enumerate(r.search(self.buffer) for r in regexes) if m]
+            if matches:
+                _, i = min(matches)
+                m = regexes[i].search(self.buffer)
+                self.before = self.buffer[:m.start()]
+                self.after = m.group()
+                self.buffer = self.buffer[m.end():]
+                return i + 2
+
+            if self.eof:
+                self.before, self.buffer = self.buffer, b''
+                return EOF
+
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError()
+                buffer, self.buffer = self.buffer, b''
+                data = await self.read(timeout=remaining)
+                self.buffer = buffer + data
+            except asyncio.TimeoutError:
+                self.before = self.buffer
+                return TIMEOUT
+
+    def sendline(self, line):
+        self.p.sendline(line)
+
+    async def auth(self):
+        if not self.passwords:
+            return True
+
+        it = iter(self.passwords)
+        password = next(it)
+        while True:
+            r = await self.expect(_AUTH_PROMPTS, timeout=self.timeout)
+            if r == TIMEOUT:
+                logger.error(c.MSG_CONNECTION_TIMED_OUT)
+                return False
+            elif r == EOF:
+                logger.error(c.MSG_CONNECTION_ERROR)
+                return False
+            elif r == 2:
+                logger.error(c.MSG_HOST_KEY_VERIFICATION_FAILED)
+                return False
+            elif r == 3:
+                logger.error(c.MSG_AUTH_FAILED)
+                return False
+            else:
+                self.sendline(password)
+                try:
+                    password = next(it)
+                except StopIteration:
+                    return True
+
+    async def start(self):
+        '''Spawn ssh and authenticate. Return True on success.'''
+        if self.command is None or self.cmd != self._command_cmd:
+            self.extras = self._extras
+            self.command = self.compile_command()
+            self._command_cmd = self.cmd
+            logger.debug(self.command)
+
+        self.buffer = b''
+        self.eof = False
+        self.exitstatus = None
+        self.p = pexpect.spawn(self.command)
+        try:
+            authed = await self.auth()
+        except Exception as e:
+            logger.error(c.MSG_CONNECTION_ERROR)
+            logger.debug(e)
+            authed = False
+
+        if not authed:
+            self.close()
+        return authed
+
+    async def stream(self):
+        '''Yield output chunks until EOF.'''
+        while True:
+            data = await self.read()
+            if not data:
+                break
+            yield data
+
+    async def wait(self):
+        '''
+        Wait for the child to exit and return the exit status.
+
+        Output not read yet is discarded, a child blocked on a full pty
+        would never exit.
+        '''
+        while await self.read():
+            pass
+        if self.p.isalive():
+            await self._wait_exit()
+        self.exitstatus = self.p.exitstatus
+        return self.exitstatus
+
+    async def _wait_exit(self):
+        loop = asyncio.get_event_loop()
+        try:
+            # readable once the process exited, linux 5.3+
+            fd = os.pidfd_open(self.p.pid)
+        except (AttributeError, OSError):
+            await loop.run_in_executor(None, self.p.wait)
+            return
+
+        fut = loop.create_future()
+        loop.add_reader(fd, lambda: fut.done() or fut.set_result(None))
+        try:
+            await fut
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+        # reaps the child and sets exitstatus
+        self.p.isalive()
+
+    def close(self):
+        if self.p and not self.p.closed:
+            self.p.close(force=True)
+            self.exitstatus = self.p.exitstatus
+
+    async def run(self):
+        '''Run the session until ssh exits, passing output to `self.output`.'''
+        if not await self.start():
+            return STATUS_FAIL
+
+        async for data in self.stream():
+            if self.output:
+                self.output(data)
+        status = await self.wait()
+        return STATUS_SUCCESS if status == 0 else STATUS_FAIL
+
+    async def exec(self, cmd=None):
+        '''Execute a command and return (exitstatus, output).'''
+        if cmd is not None:
+            self.cmd = cmd
+        if not await self.start():
+            return None, b''
+
+        output = []
+        async for data in self.stream():
+            output.append(data)
+        status = await self.wait()
+        return status, b''.join(output)
@@ -1,5 +1,4 @@
-# -*- coding: future_fstrings -*-
-
+import os
 import sys
 import time
 import click
@@ -10,6 +9,8 @@ from . import __version__, logger, set_debug
 from . import cfg
 from . import utils
 from . import sshwrap
+from . import hostkeys
+from . import tokenizer
 from . import const as c
 from .sshx_forward import Forwards
 from .sshx_scp import TargetPair
@@ -18,6 +19,7 @@ from .const import STATUS_SUCCESS, STATUS_FAIL
 
 RETRY = 0
 RETRY_INTERVAL = 5
+RETRY_MAX_INTERVAL = 300
 
 
 def handle_init(force=False, security=False):
@@ -44,20 +46,41 @@ def handle_init(force=False, security=False):
         return STATUS_SUCCESS
 
 
-def handle_config(security=None, chphrase=False):
+def handle_config(security=None, chphrase=False, kdf_cost=None, fmt=None):
+    if fmt:
+        if cfg.convert_config(fmt):
+            logger.info(f'Accounts converted to {fmt}.')
+        else:
+            logger.info(f'Accounts are in {fmt} already.')
+        return STATUS_SUCCESS
+
     config = cfg.config
 
+    if kdf_cost is not None:
+        # applies to the secrets written by the rest of the command
+        tokenizer.set_kdf_cost(kdf_cost)
+
     if security is not None:
         config.set_security(security=security)
-        cfg.write_config(config)
+        if not cfg.write_config(config):
+            return STATUS_FAIL
         return STATUS_SUCCESS
 
     if chphrase:
+        config.decrypt_accounts()
         config.reset_passphrase()
-        cfg.write_config(config)
+        if not cfg.write_config(config):
+            return STATUS_FAIL
         logger.info('Passphrase changed.')
         return STATUS_SUCCESS
 
+    if kdf_cost is not None:
+        config.rekey()
+        if not cfg.write_config(config):
+            return STATUS_FAIL
+        logger.info('Secrets encrypted again.')
+        return STATUS_SUCCESS
+
     return STATUS_FAIL
 
 
@@ -91,7 +114,10 @@ def handle_add(name, host, port=c.DEFAULT_PORT, user=c.DEFAULT_USER, password=''
         user=user, password=password, identity=identity,
     )
     if config.add_account(account):
-        cfg.write_config(config)
+        if not cfg.write_config(config):
+            return STATUS_FAIL
+        # keys kept under the name are of an account gone before
+        hostkeys.remove(name)
         logger.info('Account added.')
         return STATUS_SUCCESS
     else:
@@ -105,9 +131,9 @@ def handle_update(name, update_fields):
         logger.error('Nothing to update')
         return STATUS_FAIL
 
-    # need to decrypt when updating sensitive data
-    _sensitive = ['password', 'identity']
-    decrypt = any([f in update_fields for f in _sensitive])
+    # the passphrase of the identity is checked in plain, while a new
+    # password is encrypted alone by update_account()
+    decrypt = 'identity' in update_fields
 
     account = config.get_account(name, decrypt=decrypt)
     if not account:
@@ -155,8 +181,16 @@ def handle_update(name, update_fields):
                 f'Identity was unset but no password was set, please set an password for account {account.name}')
             update_fields['password'] = utils.read_password()
 
-    account.update(update_fields)
-    cfg.write_config(config)
+    moved = any(f in update_fields and update_fields[f] != getattr(account, f) for f in ('host', 'port'))
+    config.update_account(account, update_fields)
+    if not cfg.write_config(config):
+        return STATUS_FAIL
+
+    # host keys are kept by the account name, see hostkeys
+    if newname:
+        hostkeys.rename(name, newname)
+    if moved:
+        hostkeys.remove(account.name)
     logger.info('Account updated.')
     return STATUS_SUCCESS
 
@@ -164,25 +198,43 @@ def handle_update(name, update_fields):
 def handle_del(name):
     config = cfg.config
 
+    dependents = [a.name for a in config.get_accounts_by_via(name)]
+    if dependents:
+        logger.warning(
+            f"Account '{name}' is the jump host of: {', '.join(dependents)}.")
+
     if not config.remove_account(name):
         logger.error(f'Failed to delete.')
         return STATUS_FAIL
 
-    cfg.write_config(config)
+    if not cfg.write_config(config):
+        return STATUS_FAIL
+    hostkeys.remove(name)
     logger.info('Acccount deleted.')
     return STATUS_SUCCESS
 
 
-def handle_list(key='name', reverse=False):
-    config = cfg.config
+def handle_list(key='name', reverse=False, query=(), mode='substring', json_output=False,
+                limit=0, page=1):
+    import json
+    from . import search
 
-    accounts = config.get_accounts()
+    try:
+        rows = search.find(cfg.config, query, mode=mode, key=key, reverse=reverse)
+    except search.QueryError as e:
+        logger.error(str(e))
+        return STATUS_FAIL
+    if limit:
+        rows = rows[(page - 1) * limit:page * limit]
 
-    print('%-20s%-30s%-20s%-20s' % ('name', 'host', 'user', 'via'))
-    print('%-20s%-30s%-20s%-20s' % ('-----', '-----', '-----', '-----'))
-    accounts.sort(key=lambda a: str.lower(getattr(a, key)), reverse=reverse)
-    for a in accounts:
-        print('%-20s%-30s%-20s%-20s' % (a.name, a.host, a.user, a.via))
+    if json_output:
+        print(json.dumps([dict(zip(search.FIELDS, row)) for row in rows], indent=4))
+        return STATUS_SUCCESS
+
+    lines = ['%-20s%-30s%-20s%-20s' % ('name', 'host', 'user', 'via'),
+             '%-20s%-30s%-20s%-20s' % ('-----', '-----', '-----', '-----')]
+    lines.extend('%-20s%-30s%-20s%-20s' % row for row in rows)
+    print('\n'.join(lines))
     return STATUS_SUCCESS
 
 
@@ -194,10 +246,90 @@ def handle_show(name, password=False):
         logger.error(c.MSG_ACCOUNT_NOT_FOUND)
         return STATUS_FAIL
 
+    # the account is the one of the config, print a copy
+    fields = account.to_dict()
     if not password:
-        del account.password
+        del fields['password']
+
+    print(fields)
+    return STATUS_SUCCESS
+
+
+def handle_import(filename, fmt=None, update=False):
+    from . import sshx_import
+
+    fmt = fmt or sshx_import.guess_format(filename)
+    try:
+        if filename == '-':
+            s = sys.stdin.read()
+        else:
+            with open(filename, 'r', encoding='utf-8') as f:
+                s = f.read()
+        accounts = sshx_import.parse(s, fmt)
+    except (OSError, ValueError, TypeError) as e:
+        logger.error(f'Failed to read {filename}: {e}')
+        return STATUS_FAIL
+
+    config = cfg.config
 
-    print(account)
+    names = set()
+    for a in accounts:
+        if not a.is_valid():
+            logger.error(f'Invalid account: {a.name}')
+            return STATUS_FAIL
+        if a.name in names:
+            logger.error(f'Duplicated account: {a.name}')
+            return STATUS_FAIL
+        names.add(a.name)
+
+    for a in accounts:
+        if ',' in a.via:
+            logger.error(f"'{a.name}' has more than one jump account, chain them by the via of each.")
+            return STATUS_FAIL
+        if a.via and a.via not in names and not config.get_account(a.via):
+            logger.error(f"Jump account '{a.via}' of '{a.name}' doesn't exist.")
+            return STATUS_FAIL
+
+    added, updated, skipped = 0, 0, 0
+    for a in accounts:
+        origin = config.get_account(a.name)
+        if not origin:
+            config.add_account(a)
+            added += 1
+        elif update:
+            # keep the secrets if the format doesn't carry them
+            fields = {k: v for k, v in a.to_dict().items()
+                      if k != 'name' and (v or k not in sshx_import.SECRET_FIELDS)}
+            if any(k in fields for k in sshx_import.SECRET_FIELDS):
+                config.decrypt_account(origin)
+            config.update_account(origin, fields)
+            updated += 1
+        else:
+            logger.warning(f'Account {a.name} exists, skipped.')
+            skipped += 1
+
+    if not cfg.write_config(config):
+        return STATUS_FAIL
+    logger.info(f'{added} added, {updated} updated, {skipped} skipped.')
+    return STATUS_SUCCESS
+
+
+def handle_export(fmt='ssh', output=None, password=False):
+    from . import sshx_import
+
+    config = cfg.config
+    accounts = config.get_accounts(decrypt=password and fmt == 'csv')
+
+    if fmt == 'csv':
+        s = sshx_import.dump_csv(accounts, secrets=password)
+    else:
+        ssh_config = os.path.abspath(output) if output else sshx_import.DEFAULT_SSH_CONFIG
+        s = sshx_import.dump_ssh_config(accounts, config=ssh_config)
+
+    if output:
+        utils.atomic_write(output, s, mode=0o600 if password else 0o644)
+    else:
+        sys.stdout.write(s)
     return STATUS_SUCCESS
 
 
@@ -215,7 +347,7 @@ def handle_connect(name, via='', forwards=None, extras='', detach=False,
     return sshwrap.ssh(
         account, vias=via, forwards=forwards, extras=extras, detach=detach,
         tty=tty, background=background, execute=execute, cmd=cmd,
-        retry=RETRY, retry_interval=RETRY_INTERVAL)
+        retry=RETRY, retry_interval=RETRY_INTERVAL, retry_max_interval=RETRY_MAX_INTERVAL)
 
 
 def handle_forward(name, maps=None, rmaps=None, via='', background=False):
@@ -239,13 +371,90 @@ def handle_exec(name, via='', tty=False, cmd=[]):
     return handle_connect(name, via=via, extras=extras, cmd=_cmd)
 
 
-def handle_scp(src, dst, via='', with_forward=False):
+def _decrypt_jump_hosts(accounts, via=''):
+    '''
+    Decrypt the jump hosts of the accounts, `via` if given, before sessions
+    run in parallel and would decrypt them at the same time.
+    '''
+    config = cfg.config
+    if via:
+        for name in via.split(','):
+            config.get_account(name, decrypt=True)
+        return
+
+    done = set()
+    for account in accounts:
+        name = account.via
+        while name and name not in done:
+            done.add(name)
+            jump = config.get_account(name, decrypt=True)
+            name = jump.via if jump else ''
+
+
+def _match_names(names, patterns):
+    '''
+    Return the names matching the comma separated fnmatch patterns, in the
+    order of the patterns, or None if a pattern matches nothing.
+    '''
+    import fnmatch
+
+    matched = []
+    seen = set()
+    for pattern in patterns.split(','):
+        found = fnmatch.filter(names, pattern)
+        if not found:
+            logger.error(f"No account matches '{pattern}'.")
+            return None
+        for name in found:
+            if name not in seen:
+                seen.add(name)
+                matched.append(name)
+    return matched
+
+
+def handle_pexec(patterns, via='', jobs=10, timeout=None, cmd=[]):
+    import threading
+
+    config = cfg.config
+
+    matched = _match_names([a.name for a in config.get_accounts()], patterns)
+    if matched is None:
+        return STATUS_FAIL
+
+    accounts = [config.get_account(n, decrypt=True) for n in matched]
+    _decrypt_jump_hosts(accounts, via=via)
+
+    lock = threading.Lock()
+
+    def output(account, line):
+        with lock:
+            print(f'[{account.name}] {line}', flush=True)
+
+    start = time.time()
+    sessions = sshwrap.pexec(accounts, ' '.join(cmd), vias=via,
+                             jobs=jobs, timeout=timeout, output=output)
+    elapsed = time.time() - start
+
+    print('%-20s%-10s%-10s%-10s' % ('name', 'status', 'exit', 'time'))
+    print('%-20s%-10s%-10s%-10s' % ('-----', '-----', '-----', '-----'))
+    for p in sessions:
+        if p.timed_out:
+            status = 'timeout'
+        else:
+            status = 'ok' if p.status == STATUS_SUCCESS else 'failed'
+        exitstatus = '-' if p.exitstatus is None else p.exitstatus
+        print('%-20s%-10s%-10s%-10s' % (p.account.name, status, exitstatus, '%.2fs' % p.elapsed))
+
+    failed = len([p for p in sessions if p.status != STATUS_SUCCESS])
+    logger.info(f'{len(sessions) - failed} succeeded, {failed} failed in {elapsed:.2f}s.')
+    return STATUS_FAIL if failed else STATUS_SUCCESS
+
+
+def handle_scp(src, dst, via='', with_forward=False, dst_via=''):
     targets = TargetPair(src, dst)
 
     if targets.both_are_remote():
-        # TODO: implement copy between remote targets
-        logger.error('Copy between remote targets are not supported yet.')
-        return STATUS_FAIL
+        return handle_relay(targets, src_via=via, dst_via=dst_via)
 
     config = cfg.config
 
@@ -259,6 +468,141 @@ def handle_scp(src, dst, via='', with_forward=False):
     return sshwrap.scp(account, targets, vias=via, with_forward=with_forward)
 
 
+def handle_relay(targets, src_via='', dst_via=''):
+    config = cfg.config
+    src_account = config.get_account(targets.src.host, decrypt=True)
+    dst_account = config.get_account(targets.dst.host, decrypt=True)
+    if not src_account or not dst_account:
+        logger.error(c.MSG_ACCOUNT_NOT_FOUND)
+        return STATUS_FAIL
+
+    start = time.time()
+    relayed = sshwrap.relay(src_account, targets.src.path, dst_account, targets.dst.path,
+                            src_vias=src_via or src_account.via,
+                            dst_vias=dst_via or dst_account.via)
+    if relayed is None:
+        return STATUS_FAIL
+
+    elapsed = time.time() - start
+    mb = relayed / 1000 / 1000
+    logger.info(f'Relayed {mb:.1f} MB from {src_account.name} to {dst_account.name} '
+                f'in {elapsed:.2f}s, {mb / max(elapsed, 1e-6):.1f} MB/s.')
+    return STATUS_SUCCESS
+
+
+def _transfer_account(src_targets, dst_target, via=''):
+    '''
+    Return the account of a transfer whose sources are either all local with
+    a remote destination, or on the same remote host with a local destination.
+    '''
+    src_hosts = set(t.host for t in src_targets)
+
+    if dst_target.is_remote() and src_hosts == {''}:
+        name = dst_target.host
+    elif not dst_target.is_remote() and '' not in src_hosts and len(src_hosts) == 1:
+        name = src_hosts.pop()
+    else:
+        logger.error('Sources must be local with a remote destination, '
+                     'or on the same remote host with a local destination.')
+        return None
+
+    config = cfg.config
+    account = config.get_account(name, decrypt=True)
+    if not account:
+        logger.error(c.MSG_ACCOUNT_NOT_FOUND)
+        return None
+    _decrypt_jump_hosts([account], via=via)
+    return account
+
+
+def handle_pscp(sources, dst, via='', jobs=4):
+    from .sshx_scp import Target, plan_upload, plan_download, written_size
+
+    src_targets = [Target(s) for s in sources]
+    dst_target = Target(dst)
+    account = _transfer_account(src_targets, dst_target, via=via)
+    if not account:
+        return STATUS_FAIL
+    name = account.name
+
+    mkdirs = None
+    if dst_target.is_remote():
+        try:
+            mkdirs, units, _ = plan_upload(
+                sources, name, dst_target.path or '.', jobs=jobs)
+        except OSError as e:
+            logger.error(f'No such file or directory: {e}')
+            return STATUS_FAIL
+    else:
+        os.makedirs(dst, exist_ok=True)
+        units = plan_download(sources, dst)
+
+    start = time.time()
+    scps = sshwrap.pscp(account, units, vias=via, jobs=jobs, mkdirs=mkdirs)
+    elapsed = time.time() - start
+    if scps is None:
+        return STATUS_FAIL
+
+    if not dst_target.is_remote():
+        for p in scps:
+            p.unit.size = written_size(p.unit, start)
+
+    failed = len([p for p in scps if p.status != STATUS_SUCCESS])
+    mb = sum(p.unit.size for p in scps if p.status == STATUS_SUCCESS) / 1000 / 1000
+    logger.info(f'{len(scps) - failed}/{len(scps)} transfers succeeded, '
+                f'{mb:.1f} MB in {elapsed:.2f}s, {mb / max(elapsed, 1e-6):.1f} MB/s.')
+    return STATUS_FAIL if failed else STATUS_SUCCESS
+
+
+def handle_sync(sources, dst, via='', chunk_size=1024 * 1024):
+    import posixpath
+    from .sshx_scp import Target
+    from .sshx_sync import Sync, SyncError
+
+    src_targets = [Target(s) for s in sources]
+    dst_target = Target(dst)
+    account = _transfer_account(src_targets, dst_target, via=via)
+    if not account:
+        return STATUS_FAIL
+
+    from .retry import RetryPolicy
+
+    sync = Sync(account, vias=via, chunk_size=chunk_size)
+    upload = dst_target.is_remote()
+    policy = RetryPolicy(RETRY, RETRY_INTERVAL, max_interval=RETRY_MAX_INTERVAL)
+    start = time.time()
+    _try = 0
+    while True:
+        try:
+            sync.connect(mkdir=dst_target.path if upload else None)
+            for t in src_targets:
+                name = os.path.basename(os.path.normpath(t.path))
+                if upload:
+                    sync.upload(t.path, posixpath.join(dst_target.path, name))
+                else:
+                    sync.download(t.path, os.path.join(dst, name))
+            break
+        except (SyncError, OSError) as e:
+            logger.error(e)
+            # only a lost connection is retried, which resumes from the
+            # chunks written so far, local errors (OSError) are permanent
+            if policy.should_retry(_try, getattr(e, 'outcome', None)):
+                delay = policy.delay(_try)
+                _try += 1
+                logger.info(f'failed, sleep {delay:.1f}s before retry.')
+                time.sleep(delay)
+                logger.info(f'retry: {_try}')
+                continue
+            return STATUS_FAIL
+    elapsed = time.time() - start
+
+    stats = sync.stats
+    logger.info(f'{stats.changed} of {stats.files} files changed, sent '
+                f'{stats.sent / 1000 / 1000:.1f} of {stats.total / 1000 / 1000:.1f} MB '
+                f'in {elapsed:.2f}s.')
+    return STATUS_SUCCESS
+
+
 def handle_copyid(name, identity, via=''):
     config = cfg.config
     account = config.get_account(name, decrypt=True)
@@ -270,6 +614,237 @@ def handle_copyid(name, identity, via=''):
     return ret
 
 
+def handle_profile_startup():
+    '''Report the time spent on importing sshx and loading the config.'''
+    from . import _IMPORT_START
+
+    import_time = time.perf_counter() - _IMPORT_START
+    logger.info(f'import: {import_time * 1000:.1f}ms')
+
+    if cfg.check_init() == cfg.STATUS_INITED:
+        start = time.perf_counter()
+        accounts = cfg.config.get_accounts()
+        load_time = time.perf_counter() - start
+        logger.info(
+            f'config load: {load_time * 1000:.1f}ms ({len(accounts)} accounts)')
+
+    _heavy = ['pexpect', 'itsdangerous', 'asyncio', 'concurrent.futures']
+    loaded = [m for m in _heavy if m in sys.modules]
+    deferred = [m for m in _heavy if m not in sys.modules]
+    logger.info(f"loaded: {', '.join(loaded) or '-'}")
+    logger.info(f"deferred: {', '.join(deferred) or '-'}")
+    return STATUS_SUCCESS
+
+
+def handle_agent_start(idle=3600, lifetime=0, foreground=False):
+    from . import agent
+
+    if cfg.check_init() != cfg.STATUS_INITED:
+        logger.error(c.MSG_CONFIG_BROKEN)
+        return STATUS_FAIL
+
+    if agent.start(idle=idle, lifetime=lifetime, foreground=foreground):
+        if not foreground:
+            logger.info('Agent started.')
+        return STATUS_SUCCESS
+    return STATUS_FAIL
+
+
+def handle_agent_stop():
+    from . import agent
+
+    if agent.stop():
+        logger.info('Agent stopped.')
+        return STATUS_SUCCESS
+    logger.error('Agent is not running.')
+    return STATUS_FAIL
+
+
+def handle_agent_status():
+    from . import agent
+
+    info = agent.status()
+    if not info:
+        logger.info('Agent is not running.')
+        return STATUS_FAIL
+
+    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(info['started']))
+    logger.info(f"Agent is running (pid {info['pid']}, started at {started}).")
+    return STATUS_SUCCESS
+
+
+def handle_mux_list():
+    masters = sshwrap.mux_list()
+
+    print('%-20s%-20s' % ('name', 'status'))
+    print('%-20s%-20s' % ('-----', '-----'))
+    for name, alive in masters:
+        print('%-20s%-20s' % (name, 'alive' if alive else 'dead'))
+    return STATUS_SUCCESS
+
+
+def handle_mux_check(name):
+    if sshwrap.mux_check(name):
+        logger.info(f'Master connection of {name} is alive.')
+        return STATUS_SUCCESS
+    logger.error(f'No master connection for {name}.')
+    return STATUS_FAIL
+
+
+def handle_mux_stop(name=None):
+    names = [name] if name else [n for n, _ in sshwrap.mux_list()]
+    for n in names:
+        if sshwrap.mux_stop(n):
+            logger.info(f'Master connection of {n} stopped.')
+    return STATUS_SUCCESS
+
+
+def handle_tunnels_add(name, account, via='', maps=None, rmaps=None, socks=''):
+    from . import tunnels
+
+    if not cfg.config.get_account(account):
+        logger.error(c.MSG_ACCOUNT_NOT_FOUND)
+        return STATUS_FAIL
+
+    spec = {'name': name, 'account': account, 'via': via, 'forwards': maps,
+            'rforwards': rmaps, 'socks': socks}
+    try:
+        tunnels.add_spec(spec)
+    except tunnels.TunnelError as e:
+        logger.error(e)
+        return STATUS_FAIL
+    logger.info(f'Tunnel {name} saved.')
+    return handle_tunnels_reload(quiet=True)
+
+
+def handle_tunnels_remove(name):
+    from . import tunnels
+
+    if not tunnels.remove_spec(name):
+        logger.error(f'Tunnel {name} not found.')
+        return STATUS_FAIL
+    logger.info(f'Tunnel {name} removed.')
+    return handle_tunnels_reload(quiet=True)
+
+
+def handle_tunnels_list():
+    from . import tunnels
+
+    response = tunnels.request('list')
+    if response:
+        infos = response['tunnels']
+    else:
+        infos = [dict(spec, state='-', restarts=0, pid=None, uptime=0, error='')
+                 for spec in tunnels.load_specs().values()]
+
+    print('%-20s%-20s%-10s%-10s%-10s%-40s' % ('name', 'account', 'state', 'restarts', 'uptime', 'forwards'))
+    print('%-20s%-20s%-10s%-10s%-10s%-40s' % ('-----', '-----', '-----', '-----', '-----', '-----'))
+    for info in infos:
+        forwards = [f'-L {m}' for m in info['forwards']] + [f'-R {m}' for m in info['rforwards']]
+        if info['socks']:
+            forwards.append(f"-D {info['socks']}")
+        print('%-20s%-20s%-10s%-10s%-10s%-40s' % (
+            info['name'], info['account'], info['state'], info['restarts'],
+            f"{info['uptime']}s", ' '.join(forwards)))
+    if not response:
+        logger.info('Supervisor is not running.')
+    return STATUS_SUCCESS
+
+
+def handle_tunnels_start(foreground=False):
+    from . import tunnels
+
+    if cfg.check_init() != cfg.STATUS_INITED:
+        logger.error(c.MSG_CONFIG_BROKEN)
+        return STATUS_FAIL
+
+    try:
+        started = tunnels.start(foreground=foreground)
+    except tunnels.TunnelError as e:
+        logger.error(e)
+        return STATUS_FAIL
+    if started:
+        if not foreground:
+            logger.info('Supervisor started.')
+        return STATUS_SUCCESS
+    return STATUS_FAIL
+
+
+def handle_tunnels_stop(name=None):
+    from . import tunnels, ipc
+
+    try:
+        response = tunnels.request('stop', name=name)
+    except ipc.IPCError as e:
+        logger.error(e)
+        return STATUS_FAIL
+    if response is None:
+        logger.error('Supervisor is not running.')
+        return STATUS_FAIL
+    logger.info(f'Tunnel {name} stopped.' if name else 'Supervisor stopped.')
+    return STATUS_SUCCESS
+
+
+def handle_tunnels_reload(quiet=False):
+    from . import tunnels, ipc
+
+    try:
+        response = tunnels.request('reload')
+    except ipc.IPCError as e:
+        logger.error(e)
+        return STATUS_FAIL
+    if response is None:
+        if not quiet:
+            logger.error('Supervisor is not running.')
+            return STATUS_FAIL
+        return STATUS_SUCCESS
+
+    for key in ('added', 'removed', 'restarted'):
+        if response[key]:
+            logger.info(f"Tunnels {key}: {', '.join(response[key])}.")
+    return STATUS_SUCCESS
+
+
+def handle_hostkeys_scan(patterns='*', jobs=10, timeout=5):
+    accounts = cfg.config.get_accounts()
+    matched = _match_names([a.name for a in accounts], patterns)
+    if matched is None:
+        return STATUS_FAIL
+
+    matched = set(matched)
+    accounts = [a for a in accounts if a.name in matched]
+    results = hostkeys.scan(accounts, jobs=jobs, timeout=timeout)
+
+    print('%-20s%-12s%-40s' % ('name', 'status', 'keys'))
+    print('%-20s%-12s%-40s' % ('-----', '-----', '-----'))
+    for name, status, detail in results:
+        print('%-20s%-12s%-40s' % (name, status, detail))
+
+    changed = [name for name, status, _ in results if status == 'changed']
+    if changed:
+        logger.error(f"Host keys of {', '.join(changed)} have changed, "
+                     f"remove them by `sshx hostkeys remove` if it's expected.")
+    failed = [name for name, status, _ in results if status == 'failed']
+    return STATUS_FAIL if changed or failed else STATUS_SUCCESS
+
+
+def handle_hostkeys_list():
+    keys = hostkeys.load()
+    print('%-20s%-40s' % ('name', 'keys'))
+    print('%-20s%-40s' % ('-----', '-----'))
+    for name, entries in sorted(keys.items()):
+        print('%-20s%-40s' % (name, ' '.join(t for t, _ in entries)))
+    return STATUS_SUCCESS
+
+
+def handle_hostkeys_remove(name):
+    if not hostkeys.remove(name):
+        logger.error(f'No host key of {name}.')
+        return STATUS_FAIL
+    logger.info(f'Host keys of {name} removed.')
+    return STATUS_SUCCESS
+
+
 class RetryType(click.ParamType):
     name = "retry"
 
@@ -304,7 +879,7 @@ class SortedGroup(click.Group):
         return self.commands.keys()
 
 
-@click.group(cls=SortedGroup)
+@click.group(cls=SortedGroup, invoke_without_command=True)
 @click.version_option(__version__)
 @click.option('-d', '--debug', is_flag=True)
 @click.option('--interval', type=click.IntRange(min=0), default=0,
@@ -315,13 +890,33 @@ class SortedGroup(click.Group):
 @click.option('--retry', type=RETRY_TYPE, default=0,
               help='Reconnect after connection closed, repeat for retry times. Supported values are "always" or non negative integer. If retry was enabled, --interval must be greater than 0.')
 @click.option('--retry-interval', type=click.IntRange(min=0), default=5,
-              help='Sleep seconds before every retry.')
-def cli(debug, interval, countmax, forever, retry, retry_interval):
+              help='Sleep seconds before the first retry, doubled for every next retry with jitter.')
+@click.option('--retry-max-interval', type=click.IntRange(min=0), default=300,
+              help='Max seconds to sleep before a retry.')
+@click.option('--mux', is_flag=True,
+              help='Reuse a per-account master connection (ControlMaster) for connect, exec, scp and copyid.')
+@click.option('--mux-persist', type=click.IntRange(min=1), default=600,
+              help='Idle seconds before a master connection exits.')
+@click.option('--port-range', metavar='LOW-HIGH',
+              help='Take local ports for forwarding from the range, instead of any free port.')
+@click.option('--no-known-hosts', is_flag=True,
+              help='Disable host key checking, instead of checking against the host keys kept by sshx.')
+@click.option('--profile-startup', is_flag=True,
+              help='Report the time spent on imports and loading the config.')
+@click.option('--trace', metavar='FILE',
+              help='Append timing spans of connection stages to FILE as json lines, - for stderr.')
+@click.pass_context
+def cli(ctx, debug, interval, countmax, forever, retry, retry_interval, retry_max_interval,
+        mux, mux_persist, port_range, no_known_hosts, profile_startup, trace):
     set_debug(debug)
+    if trace:
+        from . import trace as _trace
+        _trace.set_trace(trace)
 
-    global RETRY, RETRY_INTERVAL
+    global RETRY, RETRY_INTERVAL, RETRY_MAX_INTERVAL
     RETRY = retry
     RETRY_INTERVAL = retry_interval
+    RETRY_MAX_INTERVAL = retry_max_interval
 
     if forever:
         # Set the alive time to 100 years, forever of life. :)
@@ -330,6 +925,17 @@ def cli(debug, interval, countmax, forever, retry, retry_interval):
         countmax = 4 * 60 * 24 * 365 * 100
 
     sshwrap.set_keepalive(interval, countmax)
+    sshwrap.set_multiplex(mux, persist=mux_persist)
+    from . import ports
+    ports.set_port_range(ports.parse_port_range(port_range) if port_range else None)
+    hostkeys.set_known_hosts(not no_known_hosts)
+
+    if profile_startup:
+        handle_profile_startup()
+    if ctx.invoked_subcommand is None:
+        if not profile_startup:
+            click.echo(ctx.get_help())
+        return STATUS_SUCCESS
 
 
 @cli.command('init', help='Initialize the account storage.')
@@ -344,8 +950,12 @@ def command_init(force, security):
 @click.option('--security-on', 'security', flag_value=True, default=None, help='Enable security mode.')
 @click.option('--security-off', 'security', flag_value=False, default=None, help='Disable security mode.')
 @click.option('--chphrase', is_flag=True, help='Change the passphrase.')
-def command_config(security, chphrase):
-    return handle_config(security=security, chphrase=chphrase)
+@click.option('--kdf-cost', type=click.IntRange(min=1, max=tokenizer.MAX_KDF_COST),
+              help='Encrypt the secrets again, in security mode with a key derived by scrypt of N = 2 ** KDF_COST (14 by default, 128 * 8 * N bytes of memory).')
+@click.option('--format', 'fmt', type=click.Choice(['json', 'binary']),
+              help='Convert the accounts file to the format, binary loads large inventories faster.')
+def command_config(security, chphrase, kdf_cost, fmt):
+    return handle_config(security=security, chphrase=chphrase, kdf_cost=kdf_cost, fmt=fmt)
 
 
 @cli.command('add', help='Add an account and assign a name for it.')
@@ -401,12 +1011,19 @@ def command_del(name):
     return handle_del(name)
 
 
-@cli.command('list', help='List all accounts.')
-@click.option('--sort', type=click.Choice(['name', 'host', 'user']),
+@cli.command('list', help='List accounts, or those matching all QUERY terms, which can be FIELD:TERM.')
+@click.argument('query', nargs=-1)
+@click.option('--sort', type=click.Choice(['name', 'host', 'user', 'via']),
               default='name', help='Sort by keys.')
 @click.option('--reverse', is_flag=True)
-def command_list(sort, reverse):
-    return handle_list(key=sort, reverse=reverse)
+@click.option('-m', '--match', type=click.Choice(['substring', 'glob', 'regex', 'fuzzy']),
+              default='substring', help='How QUERY terms match name, host, user and via.')
+@click.option('--json', 'json_output', is_flag=True, help='Print json.')
+@click.option('-n', '--limit', type=click.IntRange(min=0), default=0, help='Accounts per page, 0 for all.')
+@click.option('--page', type=click.IntRange(min=1), default=1, help='Page to print with --limit.')
+def command_list(query, sort, reverse, match, json_output, limit, page):
+    return handle_list(key=sort, reverse=reverse, query=query, mode=match,
+                       json_output=json_output, limit=limit, page=page)
 
 
 @cli.command('show', help='Show account info.')
@@ -416,6 +1033,23 @@ def command_show(name, password):
     return handle_show(name, password=password)
 
 
+@cli.command('import', help='Import accounts from an ssh config, csv or yaml file, - for stdin.')
+@click.argument('filename')
+@click.option('-f', '--format', 'fmt', type=click.Choice(['ssh', 'csv', 'yaml']),
+              help='File format, guessed by extension if omitted.')
+@click.option('--update', is_flag=True, help='Update existing accounts instead of skipping.')
+def command_import(filename, fmt, update):
+    return handle_import(filename, fmt=fmt, update=update)
+
+
+@cli.command('export', help='Export all accounts as ssh config or csv.')
+@click.option('-f', '--format', 'fmt', type=click.Choice(['ssh', 'csv']), default='ssh')
+@click.option('-o', '--output', help='Output file, stdout if omitted.')
+@click.option('-p', '--password', is_flag=True, help='Include passwords in csv.')
+def command_export(fmt, output, password):
+    return handle_export(fmt=fmt, output=output, password=password)
+
+
 @cli.command('connect', help='Connect with specified account.')
 @click.argument('name')
 @click.option('-v', '--via', help='Account name of jump host.')
@@ -452,11 +1086,24 @@ def command_socks(name, port, bind, via, background):
 
 
 @cli.command('scp', help='Copy files with specified accounts.')
-@click.argument('src')
+@click.argument('src', nargs=-1, required=True)
 @click.argument('dst')
 @click.option('-v', '--via')
-def command_scp(src, dst, via):
-    return handle_scp(src, dst, via=via)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1,
+              help='Copy by concurrent scp over a shared connection, DST must be a directory.')
+@click.option('--resume', is_flag=True,
+              help='Only copy the changed chunks of files and resume interrupted copies, '
+                   'DST must be a directory. Requires python on the remote host.')
+@click.option('--chunk-size', type=click.IntRange(min=4), default=1024,
+              help='Chunk size in KB for --resume.')
+@click.option('--dst-via',
+              help='Jump hosts of DST when copying between remote hosts, -v is for SRC then.')
+def command_scp(src, dst, via, jobs, resume, chunk_size, dst_via):
+    if resume:
+        return handle_sync(src, dst, via=via, chunk_size=chunk_size * 1024)
+    if len(src) == 1 and jobs == 1:
+        return handle_scp(src[0], dst, via=via, dst_via=dst_via)
+    return handle_pscp(src, dst, via=via, jobs=jobs)
 
 
 @cli.command('scp2', help='Copy files with specified accounts. This can be used for scp without ProxyJump option support.')
@@ -476,6 +1123,18 @@ def command_exec(name, cmd, via, tty):
     return handle_exec(name, via=via, tty=tty, cmd=cmd)
 
 
+@cli.command('pexec', help='Execute a command on many accounts in parallel. NAMES is a comma separated list of account names or glob patterns.')
+@click.argument('names')
+@click.argument('cmd', required=True, nargs=-1)
+@click.option('-v', '--via')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=10,
+              help='Max number of concurrent sessions.')
+@click.option('-t', '--timeout', type=click.IntRange(min=1), default=None,
+              help='Seconds before giving up on a host.')
+def command_pexec(names, cmd, via, jobs, timeout):
+    return handle_pexec(names, via=via, jobs=jobs, timeout=timeout, cmd=cmd)
+
+
 @cli.command('copyid', help='Copy ssh publickey (*.pub) to remote host.')
 @click.argument('identity')
 @click.argument('name')
@@ -484,8 +1143,127 @@ def command_copyid(identity, name, via):
     return handle_copyid(name, identity, via=via)
 
 
+@cli.group('agent', cls=SortedGroup, help='Keep the decrypted accounts in memory for later commands.')
+def command_agent():
+    pass
+
+
+@command_agent.command('start', help='Start the agent in background.')
+@click.option('--idle', type=click.IntRange(min=0), default=3600,
+              help='Exit after idle for seconds, 0 means never.')
+@click.option('--lifetime', type=click.IntRange(min=0), default=0,
+              help='Exit after running for seconds, 0 means never.')
+@click.option('-f', '--foreground', is_flag=True, help='Run in foreground.')
+def command_agent_start(idle, lifetime, foreground):
+    return handle_agent_start(idle=idle, lifetime=lifetime, foreground=foreground)
+
+
+@command_agent.command('stop', help='Stop the agent.')
+def command_agent_stop():
+    return handle_agent_stop()
+
+
+@command_agent.command('status', help='Show whether the agent is running.')
+def command_agent_status():
+    return handle_agent_status()
+
+
+@cli.group('mux', cls=SortedGroup, help='Manage master connections created by --mux.')
+def command_mux():
+    pass
+
+
+@command_mux.command('list', help='List master connections.')
+def command_mux_list():
+    return handle_mux_list()
+
+
+@command_mux.command('check', help='Check whether the master connection of an account is alive.')
+@click.argument('name')
+def command_mux_check(name):
+    return handle_mux_check(name)
+
+
+@command_mux.command('stop', help='Stop the master connection of an account, or all of them.')
+@click.argument('name', required=False)
+def command_mux_stop(name):
+    return handle_mux_stop(name=name)
+
+
+@cli.group('tunnels', cls=SortedGroup, help='Run many forwards supervised by one process.')
+def command_tunnels():
+    pass
+
+
+@command_tunnels.command('add', help='Add or replace a tunnel, applied at once if the supervisor is running.')
+@click.argument('name')
+@click.argument('account')
+@click.option('-v', '--via', help='Account name of jump host.')
+@click.option('-L', '--forward', multiple=True,
+              help='[bind_address]:<bind_port>:<remote_address>:<remote_port> => Forward local bind_address:bind_port to remote_address:remote_port.')
+@click.option('-R', '--rforward', multiple=True,
+              help='<bind_address>:<bind_port>:<local_address>:<local_port> => Forward remote bind_address:bind_port to local local_address:local_port.')
+@click.option('-D', '--socks', help='Run a socks5 server bound to [host:]<port>.')
+def command_tunnels_add(name, account, via, forward, rforward, socks):
+    return handle_tunnels_add(name, account, via=via, maps=forward, rmaps=rforward, socks=socks)
+
+
+@command_tunnels.command('remove', help='Remove a tunnel.')
+@click.argument('name')
+def command_tunnels_remove(name):
+    return handle_tunnels_remove(name)
+
+
+@command_tunnels.command('list', help='List tunnels and their states.')
+def command_tunnels_list():
+    return handle_tunnels_list()
+
+
+@command_tunnels.command('start', help='Start the supervisor in background.')
+@click.option('-f', '--foreground', is_flag=True, help='Run in foreground.')
+def command_tunnels_start(foreground):
+    return handle_tunnels_start(foreground=foreground)
+
+
+@command_tunnels.command('stop', help='Stop a tunnel until the next reload, or the supervisor with all tunnels.')
+@click.argument('name', required=False)
+def command_tunnels_stop(name):
+    return handle_tunnels_stop(name=name)
+
+
+@command_tunnels.command('reload', help='Apply the changes of tunnels, and restart stopped ones.')
+def command_tunnels_reload():
+    return handle_tunnels_reload()
+
+
+@cli.group('hostkeys', cls=SortedGroup, help='Manage the host keys of accounts.')
+def command_hostkeys():
+    pass
+
+
+@command_hostkeys.command('scan', help='Fetch and keep the host keys of accounts in parallel.')
+@click.argument('patterns', default='*')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=10,
+              help='Max number of concurrent scans.')
+@click.option('-t', '--timeout', type=click.IntRange(min=1), default=5,
+              help='Seconds to wait for every host.')
+def command_hostkeys_scan(patterns, jobs, timeout):
+    return handle_hostkeys_scan(patterns, jobs=jobs, timeout=timeout)
+
+
+@command_hostkeys.command('list', help='List the accounts with known host keys.')
+def command_hostkeys_list():
+    return handle_hostkeys_list()
+
+
+@command_hostkeys.command('remove', help='Forget the host keys of an account, e.g. after it was reinstalled.')
+@click.argument('name')
+def command_hostkeys_remove(name):
+    return handle_hostkeys_remove(name)
+
+
 @cli.resultcallback()
-def process_result(result, debug, interval, countmax, forever, retry, retry_interval):
+def process_result(result, **kwargs):
     '''The result is used as the exit status code.'''
     return result
 
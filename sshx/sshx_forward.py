@@ -1,5 +1,3 @@
-# -*- coding: future_fstrings -*-
-
 class Forward(object):
     def __init__(self, maps, local_forward):
         self.maps = ''
@@ -0,0 +1,236 @@
+'''
+Read and write accounts in the formats of other tools.
+
+ssh   OpenSSH client config, Host blocks
+csv   A header line with the fields of Account, one account per line
+yaml  A list of accounts, or a mapping with an "accounts" list (needs PyYAML)
+'''
+
+import os
+import io
+import csv
+import shlex
+import fnmatch
+from collections import OrderedDict
+
+from . import logger
+from .account import Account, DEF_USER, DEF_PORT, FIELDS as ACCOUNT_FIELDS
+
+
+FORMATS = ['ssh', 'csv', 'yaml']
+EXPORT_FORMATS = ['ssh', 'csv']
+
+FIELDS = list(ACCOUNT_FIELDS)
+SECRET_FIELDS = ['password', 'passphrase']
+
+# Where the exported ProxyCommand finds the jump hosts, expanded by the shell.
+DEFAULT_SSH_CONFIG = '~/.ssh/config'
+
+
+def guess_format(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.csv':
+        return 'csv'
+    if ext in ('.yml', '.yaml'):
+        return 'yaml'
+    return 'ssh'
+
+
+def _match(name, patterns):
+    '''Match like ssh_config(5), a negated pattern never matches.'''
+    matched = False
+    for pattern in patterns:
+        if pattern.startswith('!'):
+            if fnmatch.fnmatchcase(name, pattern[1:]):
+                return False
+        elif fnmatch.fnmatchcase(name, pattern):
+            matched = True
+    return matched
+
+
+def _is_pattern(name):
+    return any(ch in name for ch in '*?!')
+
+
+def _parse_proxy_jump(value):
+    '''ProxyJump [user@]host[:port][,...] -> [(user, host, port)] of the hops.'''
+    if value.lower() == 'none':
+        return []
+    hops = []
+    for hop in value.split(','):
+        user, _, hop = hop.strip().rpartition('@')
+        if hop.startswith('['):
+            host, _, port = hop[1:].partition(']')
+            port = port.lstrip(':')
+        else:
+            host, _, port = hop.partition(':')
+        hops.append((user, host, port))
+    return hops
+
+
+def _parse_proxy_command(value):
+    '''Take the destination of "ssh ... -W %h:%p host" as the jump host.'''
+    try:
+        args = shlex.split(value)
+    except ValueError:
+        args = []
+    if len(args) > 1 and os.path.basename(args[0]) == 'ssh' and '-W' in args:
+        dest = args[-1]
+        if not dest.startswith('-') and '%' not in dest:
+            return dest.split('@')[-1]
+    logger.warning(f'Unsupported ProxyCommand ignored: {value}')
+    return ''
+
+
+def parse_ssh_config(s) -> list:
+    '''
+    Return an account for every host name (without wildcards) in Host blocks,
+    options of matched wildcard blocks apply as well, the first obtained value
+    wins as ssh does. Match blocks and Include are not supported.
+
+    Jump hosts are chained by via. A hop of ProxyJump is the account of its
+    Host, unless it's given another user or port, is not a Host of the file,
+    or is reached by other jump hosts than its Host is, then it becomes an
+    account of its own, named like the hop, e.g. admin@bastion:2222, or
+    web1-via-bastion if the name is taken.
+    '''
+    blocks = []  # [(patterns, {option: value})]
+    options = None
+    for line in s.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if '=' in line.split()[0]:
+            key, _, value = line.partition('=')
+        else:
+            parts = line.split(None, 1)
+            key, value = parts[0], parts[1] if len(parts) > 1 else ''
+        key, value = key.strip().lower(), value.strip().strip('"')
+
+        if key == 'host':
+            options = {}
+            blocks.append((value.split(), options))
+        elif key == 'match':
+            options = None
+        elif options is not None:
+            options.setdefault(key, value)
+
+    def _options(host):
+        merged = {}
+        for patterns, opts in blocks:
+            if _match(host, patterns):
+                for k, v in opts.items():
+                    merged.setdefault(k, v)
+        return merged
+
+    def _account(name, host, user='', port=''):
+        merged = _options(host)
+        identity = merged.get('identityfile', '')
+        return Account(
+            name=name,
+            user=user or merged.get('user', DEF_USER),
+            host=merged.get('hostname', host).replace('%h', host),
+            port=port or merged.get('port', DEF_PORT),
+            identity=os.path.expanduser(identity) if identity else '',
+        )
+
+    accounts = OrderedDict()
+    for patterns, _ in blocks:
+        for name in patterns:
+            if not _is_pattern(name) and name not in accounts:
+                accounts[name] = _account(name, name)
+
+    resolved = {}
+
+    def _via(name):
+        '''Return the jump account of the Host, adding the accounts of its hops.'''
+        if name not in resolved:
+            resolved[name] = None
+            merged = _options(name)
+            if 'proxyjump' in merged:
+                resolved[name] = _chain(_parse_proxy_jump(merged['proxyjump']))
+            elif 'proxycommand' in merged:
+                resolved[name] = _parse_proxy_command(merged['proxycommand'])
+            else:
+                resolved[name] = ''
+        elif resolved[name] is None:
+            raise ValueError(f'Jump hosts of {name} loop.')
+        return resolved[name]
+
+    def _chain(hops):
+        via = ''
+        for i, (user, host, port) in enumerate(hops):
+            known = accounts.get(host)
+            # the first hop is reached by the jump hosts of its own Host
+            hop_via = _via(host) if known and i == 0 else via
+            if known and user in ('', known.user) and port in ('', known.port) and hop_via == _via(host):
+                via = host
+                continue
+
+            name = (f'{user}@' if user else '') + host + (f':{port}' if port else '')
+            hop = _account(name, host, user=user, port=port)
+            hop.via = hop_via
+            if name in accounts and accounts[name] != hop:
+                name = hop.name = f'{name}-via-{hop_via}'
+            if accounts.setdefault(name, hop) != hop:
+                raise ValueError(f'Jump host {name} is reached by different jump hosts.')
+            via = name
+        return via
+
+    for name in list(accounts):
+        accounts[name].via = _via(name)
+    return list(accounts.values())
+
+
+def parse_csv(s) -> list:
+    reader = csv.DictReader(io.StringIO(s))
+    unknown = set(reader.fieldnames or []) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown csv columns: {', '.join(sorted(unknown))}")
+    return [Account(**{k: v for k, v in row.items() if v is not None}) for row in reader]
+
+
+def parse_yaml(s) -> list:
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError('PyYAML is required for the yaml format, please install it.')
+
+    data = yaml.safe_load(s) or []
+    if isinstance(data, dict):
+        data = data.get('accounts', [])
+    accounts = []
+    for d in data:
+        unknown = set(d) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        # yaml turns numbers into int
+        accounts.append(Account(**{k: '' if v is None else str(v) for k, v in d.items()}))
+    return accounts
+
+
+def parse(s, fmt) -> list:
+    return {
+        'ssh': parse_ssh_config,
+        'csv': parse_csv,
+        'yaml': parse_yaml,
+    }[fmt](s)
+
+
+def dump_ssh_config(accounts, config=DEFAULT_SSH_CONFIG) -> str:
+    '''`config` is the ssh config file containing the jump hosts.'''
+    blocks = []
+    for a in accounts:
+        blocks.append(a.to_ssh_config().format(config=config).rstrip('\n') + '\n')
+    return '\n'.join(blocks)
+
+
+def dump_csv(accounts, secrets=False) -> str:
+    fields = FIELDS if secrets else [f for f in FIELDS if f not in SECRET_FIELDS]
+    f = io.StringIO()
+    writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    for a in accounts:
+        writer.writerow(a.to_dict())
+    return f.getvalue()
@@ -1,3 +1,9 @@
+import os
+import shlex
+import posixpath
+
+from collections import OrderedDict
+
 from . import cfg
 
 
@@ -60,3 +66,91 @@ class TargetPair(object):
 
     def __repr__(self):
         return self.__str__()
+
+
+class TransferUnit(object):
+    '''Files copied by a single scp, into the same directory.'''
+
+    def __init__(self, sources, dst, size=0):
+        self.sources = sources
+        self.dst = dst
+        self.size = size
+
+    def targets(self):
+        src = ' '.join(s if Target(s).is_remote() else shlex.quote(s)
+                       for s in self.sources)
+        return TargetPair(src, self.dst)
+
+    def __repr__(self):
+        return f'TransferUnit({self.sources!r}, {self.dst!r}, {self.size})'
+
+
+# Keep the command lines short.
+MAX_FILES_PER_UNIT = 200
+
+
+def plan_upload(sources, host, dst, jobs=1):
+    '''
+    Split local sources into units of files by remote directory, so that the
+    tree can be copied by `jobs` concurrent scp. Sources are copied into
+    the directory dst like `scp -r`.
+
+    Return (remote directories to create, units largest first, total bytes).
+    '''
+    groups = OrderedDict()  # remote dir -> [(path, size)]
+    dirs = [dst]
+    for src in sources:
+        name = os.path.basename(os.path.normpath(src))
+        if os.path.isdir(src):
+            for root, _, files in os.walk(src):
+                rel = os.path.relpath(root, src)
+                rdir = posixpath.normpath(posixpath.join(
+                    dst, name, *([] if rel == '.' else rel.split(os.sep))))
+                dirs.append(rdir)
+                for f in sorted(files):
+                    path = os.path.join(root, f)
+                    groups.setdefault(rdir, []).append((path, os.path.getsize(path)))
+        elif os.path.exists(src):
+            groups.setdefault(dst, []).append((src, os.path.getsize(src)))
+        else:
+            raise FileNotFoundError(src)
+
+    nfiles = sum(len(files) for files in groups.values())
+    per_unit = MAX_FILES_PER_UNIT
+    if jobs > 1:
+        # a few units per job to even out the sizes
+        per_unit = max(1, min(per_unit, -(-nfiles // (jobs * 4))))
+
+    units = []
+    for rdir, files in groups.items():
+        for i in range(0, len(files), per_unit):
+            chunk = files[i:i + per_unit]
+            units.append(TransferUnit([p for p, _ in chunk], f'{host}:{rdir}/',
+                                      sum(s for _, s in chunk)))
+    units.sort(key=lambda u: u.size, reverse=True)
+    return dirs, units, sum(u.size for u in units)
+
+
+def plan_download(sources, dst):
+    '''Every remote source is copied by its own scp -r into the local directory dst.'''
+    return [TransferUnit([s], dst) for s in sources]
+
+
+def written_size(unit, since):
+    '''
+    Bytes a downloaded unit wrote, by the files it copied to modified since
+    the time, not to count the ones which were there before.
+    '''
+    size = 0
+    for s in unit.sources:
+        path = os.path.join(unit.dst, os.path.basename(os.path.normpath(Target(s).path)))
+        files = [path] if os.path.isfile(path) else \
+            [os.path.join(root, f) for root, _, names in os.walk(path) for f in names]
+        for f in files:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            if st.st_mtime >= since:
+                size += st.st_size
+    return size
@@ -0,0 +1,190 @@
+'''
+Resumable, delta based copy for `sshx scp --resume`.
+
+Both sides checksum fixed size chunks of the files (sync_helper runs on the
+remote host by python), and only the chunks which differ are sent and
+written in place. An interrupted copy keeps the chunks written so far, so
+running it again resumes, and re-syncing a mostly unchanged tree moves
+only the changed bytes.
+'''
+
+import os
+import json
+import zlib
+import base64
+import shlex
+import threading
+
+from . import sshwrap
+from . import sync_helper as helper
+from .const import STATUS_SUCCESS
+from .retry import CONNECTION_ERROR
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+_REMOTE_PYTHON = 'PY=$(command -v python3 || command -v python) && "$PY" -c {code} {args}'
+_REMOTE_LOADER = 'import base64,zlib;exec(zlib.decompress(base64.b64decode("{source}")))'
+
+
+# Exit status of ssh failing to connect, rather than of the remote command.
+_SSH_FAILED = 255
+
+
+class SyncError(Exception):
+    def __init__(self, message, outcome=None):
+        super().__init__(message)
+        # the retry outcome if the connection failed, None if retrying won't help
+        self.outcome = outcome
+
+
+def _helper_source():
+    with open(helper.__file__, 'rb') as f:
+        return base64.b64encode(zlib.compress(f.read(), 9)).decode('ascii')
+
+
+def helper_command(op, root, *args):
+    '''The remote command running sync_helper, without any whitespace inside arguments.'''
+    code = _REMOTE_LOADER.format(source=_helper_source())
+    return _REMOTE_PYTHON.format(
+        code=shlex.quote(code),
+        args=' '.join(shlex.quote(str(a)) for a in (op, root) + args))
+
+
+class SyncStats(object):
+    def __init__(self):
+        self.files = 0
+        self.changed = 0
+        self.total = 0
+        self.sent = 0
+
+    def add(self, local, changes):
+        self.files += len([i for i in local.values() if not i.get('dir')])
+        self.total += sum(i.get('size', 0) for i in local.values())
+        self.changed += len([c for c in changes if not c[1].get('dir')])
+        self.sent += sum(length for _, _, chunks in changes for _, length in chunks)
+
+
+class Sync(object):
+    '''
+    sync = Sync(account, vias)
+    sync.connect('/remote/dir')
+    sync.upload('/local/src', '/remote/dir/src')
+    sync.download('/remote/src', '/local/dir/src')
+    '''
+
+    def __init__(self, account, vias=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.account = account
+        self.vias = vias
+        self.chunk_size = chunk_size
+        self.stats = SyncStats()
+
+    def connect(self, mkdir=None):
+        '''Authenticate and start the master connection, creating the remote dir.'''
+        cmd = f'mkdir -p {shlex.quote(mkdir)}' if mkdir else 'true'
+        p = sshwrap._start_master(self.account, cmd, vias=self.vias)
+        if p.status != STATUS_SUCCESS:
+            if p.failure:
+                outcome = p.failure[0]
+            elif p.exitstatus in (None, _SSH_FAILED):
+                outcome = CONNECTION_ERROR
+            else:
+                # mkdir failed
+                outcome = None
+            raise SyncError(f'Failed to connect {self.account.name}.', outcome=outcome)
+
+    def remote(self, op, root, *args):
+        return sshwrap.open_pipe(self.account, helper_command(op, root, *args), vias=self.vias)
+
+    def _check(self, p, stderr):
+        if p.wait() != 0:
+            error = stderr.decode('utf-8', errors='replace').strip()
+            if p.returncode == _SSH_FAILED:
+                raise SyncError(error or f'Failed to connect {self.account.name}.',
+                                outcome=CONNECTION_ERROR)
+            if p.returncode == 127 or 'not found' in error:
+                error = f'python is required on the remote host. {error}'
+            raise SyncError(error or f'remote helper exited with {p.returncode}')
+
+    def remote_sums(self, root):
+        p = self.remote('sums', root, self.chunk_size)
+        stdout, stderr = p.communicate()
+        self._check(p, stderr)
+        return json.loads(stdout.decode('utf-8'))
+
+    def upload(self, src, dst):
+        '''Make the remote dst equal to the local src (file or directory).'''
+        local = helper.sums(src, self.chunk_size)
+        if not local and not os.path.isdir(src):
+            raise SyncError(f'No such file or directory: {src}')
+
+        remote = self.remote_sums(dst)
+        changes = helper.diff(local, remote, self.chunk_size)
+        if os.path.isdir(src) and not remote:
+            changes.insert(0, ('', {'dir': True}, []))
+        p = self.remote('write', dst)
+        try:
+            for rel, info, chunks in changes:
+                header = dict(info, path=rel, chunks=chunks)
+                header.pop('sums', None)
+                p.stdin.write(json.dumps(header).encode('utf-8') + b'\n')
+                if not info.get('dir'):
+                    for data in helper.read_chunks(helper._path(src, rel), chunks):
+                        p.stdin.write(data)
+            p.stdin.close()
+        except BrokenPipeError:
+            pass
+        stdout, stderr = p.stdout.read(), p.stderr.read()
+        self._check(p, stderr)
+
+        self.stats.add(local, changes)
+        return json.loads(stdout.decode('utf-8'))['written']
+
+    def download(self, src, dst):
+        '''Make the local dst equal to the remote src (file or directory).'''
+        remote = self.remote_sums(src)
+        if not remote:
+            raise SyncError(f'No such file or directory: {self.account.name}:{src}')
+
+        try:
+            for rel in remote:
+                helper.check_rel(rel)
+        except IOError as e:
+            raise SyncError(f'{self.account.name}:{src}: {e}')
+
+        changes = helper.diff(remote, helper.sums(dst, self.chunk_size), self.chunk_size)
+        if '' not in remote:
+            os.makedirs(dst, exist_ok=True)
+        p = self.remote('read', src)
+
+        def _request():
+            try:
+                for rel, info, chunks in changes:
+                    if not info.get('dir'):
+                        request = {'path': rel, 'chunks': chunks}
+                        p.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        # requests are written by another thread, not to block on a full stdout
+        t = threading.Thread(target=_request, daemon=True)
+        t.start()
+        written = 0
+        try:
+            for rel, info, chunks in changes:
+                header = dict(info, path=rel, chunks=chunks)
+                written += helper.apply_frame(dst, header, p.stdout)
+        except IOError as e:
+            # not to block the helper on the rest of its output
+            p.stdout.close()
+            stderr = p.stderr.read().decode('utf-8', errors='replace')
+            # a stream cut short by a lost connection is retried
+            outcome = CONNECTION_ERROR if p.wait() == _SSH_FAILED else None
+            raise SyncError(f'{e}: {stderr}', outcome=outcome)
+        finally:
+            t.join()
+        self._check(p, p.stderr.read())
+
+        self.stats.add(remote, changes)
+        return written
@@ -0,0 +1,125 @@
+'''
+The binary format of the accounts file, for very large inventories.
+
+A json config is parsed whole by every command, while a command usually
+needs only a few accounts. The binary file is mapped into memory, and an
+account is found by a binary search on the index of name hashes, so that
+only the records looked up are decoded:
+
+    magic       8 bytes, MAGIC
+    header      <II: size of the header json, count of accounts
+    header json {"security": ..., "phrase": ...}
+    index       count * <QQI: hash of the name, offset and size of the record,
+                sorted by hash
+    records     compact json of every account, in the order of the config
+
+The file is replaced as a whole on writing (utils.atomic_write), so a
+mapping is a consistent snapshot of the file it was opened from.
+'''
+
+import json
+import mmap
+import struct
+import hashlib
+
+from . import utils
+from .const import CONFIG_MAGIC as MAGIC, CONFIG_JSON as JSON, CONFIG_BINARY as BINARY
+
+
+FORMATS = [JSON, BINARY]
+
+_HEADER = struct.Struct('<II')
+_ENTRY = struct.Struct('<QQI')
+
+
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _to_dict(account):
+    return account if isinstance(account, dict) else account.to_dict()
+
+
+def _record(account):
+    return json.dumps(_to_dict(account), cls=utils.ClsDictEncoder,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def dumps(config_dict):
+    '''Return the binary file of the config dict, as json_dump() does for json.'''
+    header = json.dumps({'security': config_dict.get('security', False),
+                         'phrase': config_dict.get('phrase')}).encode('utf-8')
+    accounts = config_dict.get('accounts', [])
+    records = [_record(a) for a in accounts]
+
+    offset = len(MAGIC) + _HEADER.size + len(header) + _ENTRY.size * len(records)
+    entries = []
+    for account, record in zip(accounts, records):
+        entries.append((name_hash(_to_dict(account)['name']), offset, len(record)))
+        offset += len(record)
+    entries.sort()
+
+    return b''.join([MAGIC, _HEADER.pack(len(header), len(records)), header] +
+                    [_ENTRY.pack(*e) for e in entries] + records)
+
+
+def is_binary(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+class Store(object):
+    '''Read only view of a binary accounts file.'''
+
+    def __init__(self, source):
+        '''source is a filename, or a file opened in binary mode.'''
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mm = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        if not is_binary(self.mm):
+            raise ValueError(f'{getattr(source, "name", source)} is not a binary accounts file.')
+
+        header_size, self.count = _HEADER.unpack_from(self.mm, len(MAGIC))
+        start = len(MAGIC) + _HEADER.size
+        self.header = json.loads(self.mm[start:start + header_size])
+        self.index = start + header_size
+
+    def _entry(self, i):
+        return _ENTRY.unpack_from(self.mm, self.index + i * _ENTRY.size)
+
+    def _decode(self, offset, size):
+        return json.loads(self.mm[offset:offset + size])
+
+    def get(self, name):
+        '''Return the dict of the account, or None.'''
+        h = name_hash(name)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < h:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # names of the same hash are next to each other
+        while lo < self.count:
+            entry_hash, offset, size = self._entry(lo)
+            if entry_hash != h:
+                break
+            d = self._decode(offset, size)
+            if d['name'] == name:
+                return d
+            lo += 1
+        return None
+
+    def accounts(self):
+        '''Return the dicts of all accounts, in the order of the config.'''
+        entries = sorted(self._entry(i)[1:] for i in range(self.count))
+        return [self._decode(offset, size) for offset, size in entries]
+
+    def to_dict(self):
+        return dict(self.header, accounts=self.accounts())
+
+    def close(self):
+        self.mm.close()
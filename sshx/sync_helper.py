@@ -0,0 +1,182 @@
+'''
+Chunk checksums and chunked writes for `sshx scp --resume`.
+
+This module runs on both sides: imported locally, and sent as the source
+of `python -c` to the remote host, where it talks over stdin/stdout.
+Therefore it must only use the standard library and run on old pythons
+(no f-strings).
+
+    python -c SOURCE sums ROOT CHUNK   print {rel: info} of files under ROOT as json
+    python -c SOURCE write ROOT        apply frames from stdin to files under ROOT
+    python -c SOURCE read ROOT         print the requested chunks of files under ROOT
+
+info is {"size": int, "mode": int, "sums": [sha1 of every chunk]}, or
+{"dir": true}. A frame is a json header line {"path": rel, "size": int,
+"mode": int, "chunks": [[offset, length], ...]} followed by the bytes of
+the chunks. The rel path of ROOT itself (when it's a file) is "".
+'''
+
+import os
+import sys
+import json
+import hashlib
+
+
+BUFSIZE = 1024 * 1024
+
+
+def check_rel(rel):
+    '''Refuse rel paths out of ROOT, they come from the other side.'''
+    parts = rel.split('/')
+    if rel and (rel.startswith('/') or any(p in ('', '.', '..') or os.sep in p for p in parts)):
+        raise IOError('unsafe path: %r' % rel)
+    return parts
+
+
+def _path(root, rel):
+    return os.path.join(root, *check_rel(rel)) if rel else root
+
+
+def file_sums(path, chunk):
+    sums = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            sums.append(hashlib.sha1(data).hexdigest())
+    return sums
+
+
+def sums(root, chunk):
+    result = {}
+    if os.path.isfile(root):
+        st = os.stat(root)
+        result[''] = {'size': st.st_size, 'mode': st.st_mode & 0o777,
+                      'sums': file_sums(root, chunk)}
+    elif os.path.isdir(root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            rel = '' if rel == '.' else rel.replace(os.sep, '/')
+            if rel:
+                result[rel] = {'dir': True}
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                result[(rel + '/' if rel else '') + name] = {
+                    'size': st.st_size, 'mode': st.st_mode & 0o777,
+                    'sums': file_sums(path, chunk)}
+    return result
+
+
+def diff(src, dst, chunk):
+    '''Return [(rel, info, [[offset, length], ...])] to make dst equal to src.'''
+    changes = []
+    for rel, info in sorted(src.items()):
+        if info.get('dir'):
+            if not dst.get(rel, {}).get('dir'):
+                changes.append((rel, info, []))
+            continue
+
+        old = dst.get(rel) or {}
+        old_sums = old.get('sums') or []
+        chunks = []
+        for i, s in enumerate(info['sums']):
+            if i >= len(old_sums) or old_sums[i] != s:
+                offset = i * chunk
+                length = min(chunk, info['size'] - offset)
+                if chunks and chunks[-1][0] + chunks[-1][1] == offset:
+                    chunks[-1][1] += length
+                else:
+                    chunks.append([offset, length])
+        if chunks or old.get('size') != info['size'] or old.get('mode') != info['mode']:
+            changes.append((rel, info, chunks))
+    return changes
+
+
+def read_chunks(path, chunks):
+    '''Yield the data of chunks from the file.'''
+    with open(path, 'rb') as f:
+        for offset, length in chunks:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, BUFSIZE))
+                if not data:
+                    raise IOError('%s was truncated' % path)
+                length -= len(data)
+                yield data
+
+
+def _read_exactly(stream, n):
+    while n > 0:
+        data = stream.read(min(n, BUFSIZE))
+        if not data:
+            raise IOError('unexpected end of stream')
+        n -= len(data)
+        yield data
+
+
+def apply_frame(root, header, stream):
+    '''Write the chunks of a frame read from stream, then fix size and mode.'''
+    path = _path(root, header['path'])
+    if header.get('dir'):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return 0
+
+    parent = os.path.dirname(path)
+    if parent and not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    written = 0
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+b') as f:
+        for offset, length in header['chunks']:
+            f.seek(offset)
+            for data in _read_exactly(stream, length):
+                f.write(data)
+                written += len(data)
+        f.truncate(header['size'])
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(path, header['mode'])
+    return written
+
+
+def write(root, stream):
+    written = 0
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+        written += apply_frame(root, json.loads(line.decode('utf-8')), stream)
+    return written
+
+
+def read(root, stream, out):
+    for line in iter(stream.readline, b''):
+        request = json.loads(line.decode('utf-8'))
+        for data in read_chunks(_path(root, request['path']), request['chunks']):
+            out.write(data)
+    out.flush()
+
+
+def main(argv):
+    op, root = argv[1], argv[2]
+    stdin = sys.stdin.buffer if hasattr(sys.stdin, 'buffer') else sys.stdin
+    stdout = sys.stdout.buffer if hasattr(sys.stdout, 'buffer') else sys.stdout
+    if op == 'sums':
+        stdout.write(json.dumps(sums(root, int(argv[3]))).encode('utf-8') + b'\n')
+    elif op == 'write':
+        stdout.write(json.dumps({'written': write(root, stdin)}).encode('utf-8') + b'\n')
+    elif op == 'read':
+        read(root, stdin, stdout)
+    else:
+        sys.stderr.write('unknown op: %s\n' % op)
+        return 2
+    stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
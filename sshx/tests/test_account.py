@@ -1,5 +1,7 @@
 from . import global_test_init
+import json
 import unittest
+from sshx import utils
 from sshx.account import *
 
 
@@ -39,6 +41,28 @@ class AccountTest(unittest.TestCase):
         account = Account(name='a1', host='h1')
         self.assertEqual(self.ACCOUNT1, account)
 
+    def test_to_dict(self):
+        d = self.ACCOUNT1.to_dict()
+        self.assertEqual(list(FIELDS), list(d))
+        self.assertEqual(self.ACCOUNT1, Account(**d))
+        self.assertFalse(hasattr(self.ACCOUNT1, '__dict__'))
+        self.assertEqual('{"name": "a1", "user": "root", "host": "h1", "port": "22", "password": "", '
+                         '"identity": "", "passphrase": "", "via": ""}',
+                         json.dumps(self.ACCOUNT1, cls=utils.ClsDictEncoder))
+
+    def test_update(self):
+        self.ACCOUNT1.update(self.ACCOUNT4)
+        self.assertEqual(self.ACCOUNT4, self.ACCOUNT1)
+        self.ACCOUNT1.update({'host': 'h5'})
+        self.assertEqual('h5', self.ACCOUNT1.host)
+        self.assertEqual('h4', self.ACCOUNT4.host)
+        self.assertRaises(AttributeError, self.ACCOUNT1.update, {'hots': 'h5'})
+
+    def test_is_valid(self):
+        self.assertTrue(self.ACCOUNT1.is_valid())
+        self.assertFalse(Account(name='a1', port=22).is_valid())
+        self.assertFalse(Account(name='a1', via='a1').is_valid())
+
 
 global_test_init()
 
@@ -0,0 +1,102 @@
+from . import global_test_init
+import os
+import time
+import mock
+import shutil
+import threading
+import unittest
+
+import lazy_object_proxy as lazy
+
+from .. import cfg
+from .. import agent
+
+
+TEST_DIR = '/tmp/sshx-test-agent'
+PASSPHRASE = 'passphrase1'
+
+
+def _reset():
+    cfg.config = lazy.Proxy(cfg.get_config)
+
+
+class AgentTest(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        cfg.set_config_dir(TEST_DIR)
+
+        with mock.patch('sshx.utils.read_password', return_value=PASSPHRASE):
+            cfg.init_config(security=True)
+            config = cfg.read_config()
+            config.add_account(cfg.Account('bastion', host='h1', password='p1'))
+            config.add_account(cfg.Account('a1', host='h2', password='p2', via='bastion'))
+            cfg.write_config(config)
+
+            self.thread = threading.Thread(
+                target=agent.start, kwargs={'foreground': True, 'idle': 10})
+            self.thread.start()
+
+            # the agent is ready once it is listening
+            for _ in range(100):
+                if agent.status():
+                    break
+                time.sleep(0.05)
+        _reset()
+
+    def tearDown(self):
+        agent.stop()
+        self.thread.join()
+        _reset()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_status(self):
+        info = agent.status()
+        self.assertEqual(os.getpid(), info['pid'])
+        self.assertFalse(agent.start())
+
+    def test_lookup(self):
+        with mock.patch('sshx.utils.read_password') as m:
+            config = cfg.config
+            self.assertIsInstance(config.__wrapped__, agent.AgentConfig)
+            self.assertTrue(config.is_security())
+
+            # single accounts are fetched without loading all of them
+            a1 = config.get_account('a1', decrypt=True)
+            self.assertEqual('p2', a1.password)
+            self.assertEqual('p1', config.get_account(a1.via, decrypt=True).password)
+            self.assertIsNone(config.get_account('a2'))
+            self.assertNotIn('accounts', vars(config.__wrapped__))
+
+            self.assertEqual(['bastion', 'a1'], [a.name for a in config.get_accounts()])
+            self.assertIs(a1, config.get_account('a1'))
+            m.assert_not_called()
+
+    def test_write(self):
+        with mock.patch('sshx.utils.read_password') as m:
+            config = cfg.config
+            config.update_account(config.get_account('a1'), {'password': 'p3'})
+            cfg.write_config(config)
+            m.assert_not_called()
+
+        # the agent reloads the changed file
+        _reset()
+        self.assertEqual('p3', cfg.config.get_account('a1').password)
+
+        with mock.patch('sshx.utils.read_password', return_value=PASSPHRASE):
+            config = cfg.read_config()
+            self.assertEqual('p3', config.get_account('a1', decrypt=True).password)
+
+    def test_idle(self):
+        agent.stop()
+        self.thread.join()
+
+        with mock.patch('sshx.utils.read_password', return_value=PASSPHRASE):
+            self.assertTrue(agent.start(foreground=True, idle=1))
+        self.assertIsNone(agent.status())
+        self.assertFalse(os.path.exists(cfg.AGENT_SOCKET))
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
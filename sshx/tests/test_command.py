@@ -1,10 +1,13 @@
-# -*- coding: future_fstrings -*-
-
 from . import global_test_init
+import os
+import sys
 import mock
 import unittest
+import subprocess
 
 from .. import sshx
+from .. import ports
+from .. import hostkeys
 from .. import const as c
 
 
@@ -35,13 +38,24 @@ class CommandTest(unittest.TestCase):
     def test_config(self):
         with mock.patch('sshx.sshx.handle_config') as m:
             sshx.invoke(['config', '--security-on'])
-            m.assert_called_with(security=True, chphrase=False)
+            m.assert_called_with(security=True, chphrase=False, kdf_cost=None, fmt=None)
 
             sshx.invoke(['config', '--security-off'])
-            m.assert_called_with(security=False, chphrase=False)
+            m.assert_called_with(security=False, chphrase=False, kdf_cost=None, fmt=None)
 
             sshx.invoke(['config', '--chphrase'])
-            m.assert_called_with(security=None, chphrase=True)
+            m.assert_called_with(security=None, chphrase=True, kdf_cost=None, fmt=None)
+
+            sshx.invoke(['config', '--kdf-cost', '16'])
+            m.assert_called_with(security=None, chphrase=False, kdf_cost=16, fmt=None)
+
+            # scrypt of N = 2 ** 24 takes 16 GiB
+            m.reset_mock()
+            self.assertEqual(c.STATUS_FAIL, sshx.invoke(['config', '--kdf-cost', '24']))
+            m.assert_not_called()
+
+            sshx.invoke(['config', '--format', 'binary'])
+            m.assert_called_with(security=None, chphrase=False, kdf_cost=None, fmt='binary')
 
     def test_add(self):
         with mock.patch('sshx.utils.read_password', return_value=PASSWORD1) as m_read_password:
@@ -97,13 +111,20 @@ class CommandTest(unittest.TestCase):
     def test_list(self):
         with mock.patch('sshx.sshx.handle_list') as m:
             sshx.invoke(['list', ])
-            m.assert_called_with(key='name', reverse=False)
+            m.assert_called_with(key='name', reverse=False, query=(), mode='substring',
+                                 json_output=False, limit=0, page=1)
 
             sshx.invoke(['list', '--sort', 'host'])
-            m.assert_called_with(key='host', reverse=False)
+            m.assert_called_with(key='host', reverse=False, query=(), mode='substring',
+                                 json_output=False, limit=0, page=1)
 
             sshx.invoke(['list', '--reverse'])
-            m.assert_called_with(key='name', reverse=True)
+            m.assert_called_with(key='name', reverse=True, query=(), mode='substring',
+                                 json_output=False, limit=0, page=1)
+
+            sshx.invoke(['list', 'web', 'via:jump', '-m', 'glob', '--json', '-n', '10', '--page', '2'])
+            m.assert_called_with(key='name', reverse=False, query=('web', 'via:jump'), mode='glob',
+                                 json_output=True, limit=10, page=2)
 
     def test_show(self):
         with mock.patch('sshx.sshx.handle_show') as m:
@@ -161,18 +182,191 @@ class CommandTest(unittest.TestCase):
     def test_scp(self):
         with mock.patch('sshx.sshx.handle_scp') as m:
             sshx.invoke(['scp', 'SRC', 'DST'])
-            m.assert_called_with('SRC', 'DST', via=None)
+            m.assert_called_with('SRC', 'DST', via=None, dst_via=None)
+
+            sshx.invoke(['scp', '-v', 'VIA1', '--dst-via', 'VIA2', 'SRC', 'DST'])
+            m.assert_called_with('SRC', 'DST', via='VIA1', dst_via='VIA2')
+
+        with mock.patch('sshx.sshx.handle_pscp') as m:
+            sshx.invoke(['scp', 'SRC1', 'SRC2', 'DST'])
+            m.assert_called_with(('SRC1', 'SRC2'), 'DST', via=None, jobs=1)
+
+            sshx.invoke(['scp', '-j', '4', 'SRC', 'DST'])
+            m.assert_called_with(('SRC',), 'DST', via=None, jobs=4)
+
+        with mock.patch('sshx.sshx.handle_sync') as m:
+            sshx.invoke(['scp', '--resume', 'SRC', 'DST'])
+            m.assert_called_with(('SRC',), 'DST', via=None, chunk_size=1024 * 1024)
+
+            sshx.invoke(['scp', '--resume', '--chunk-size', '64', 'SRC1', 'SRC2', 'DST'])
+            m.assert_called_with(('SRC1', 'SRC2'), 'DST', via=None, chunk_size=64 * 1024)
 
     def test_exec(self):
         with mock.patch('sshx.sshx.handle_exec') as m:
             sshx.invoke(['exec', NAME1, '--tty', '--', 'ls', '-al'])
             m.assert_called_with(NAME1, via=None, tty=True, cmd=('ls', '-al'))
 
+    def test_pexec(self):
+        with mock.patch('sshx.sshx.handle_pexec') as m:
+            sshx.invoke(['pexec', 'name*', '--', 'ls', '-al'])
+            m.assert_called_with('name*', via=None, jobs=10,
+                                 timeout=None, cmd=('ls', '-al'))
+
+            sshx.invoke(['pexec', f'{NAME1},{NAME2}', '-j', '2', '-t', '5', '-v', NAME2,
+                         '--', 'uptime'])
+            m.assert_called_with(f'{NAME1},{NAME2}', via=NAME2, jobs=2,
+                                 timeout=5, cmd=('uptime',))
+
     def test_copyid(self):
         with mock.patch('sshx.sshx.handle_copyid') as m:
             sshx.invoke(['copyid', IDENTITY2, NAME1, '-v', NAME2])
             m.assert_called_with(NAME1, IDENTITY2, via=NAME2)
 
+    def test_lazy_imports(self):
+        modules = ('pexpect', 'itsdangerous', 'socket', 'mmap', 'random', 'selectors', 'tty')
+        code = "import sys, sshx.sshx; print([m for m in %r if m in sys.modules])" % (modules,)
+        root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        self.assertEqual(b'[]', output.strip())
+
+    def test_profile_startup(self):
+        with mock.patch('sshx.sshx.handle_profile_startup') as m:
+            with mock.patch('sshx.sshx.handle_list') as m_list:
+                sshx.invoke(['--profile-startup', 'list'])
+                m.assert_called_once_with()
+                m_list.assert_called_once()
+
+    def test_mux(self):
+        with mock.patch('sshx.sshx.handle_mux_list') as m:
+            sshx.invoke(['mux', 'list'])
+            m.assert_called_with()
+
+        with mock.patch('sshx.sshx.handle_mux_check') as m:
+            sshx.invoke(['mux', 'check', NAME1])
+            m.assert_called_with(NAME1)
+
+        with mock.patch('sshx.sshx.handle_mux_stop') as m:
+            sshx.invoke(['mux', 'stop', NAME1])
+            m.assert_called_with(name=NAME1)
+
+            sshx.invoke(['mux', 'stop'])
+            m.assert_called_with(name=None)
+
+        with mock.patch('sshx.sshwrap.set_multiplex') as m:
+            with mock.patch('sshx.sshx.handle_connect'):
+                sshx.invoke(['--mux', '--mux-persist', '60', 'connect', NAME1])
+                m.assert_called_with(True, persist=60)
+
+    def test_import(self):
+        with mock.patch('sshx.sshx.handle_import') as m:
+            sshx.invoke(['import', 'hosts.csv'])
+            m.assert_called_with('hosts.csv', fmt=None, update=False)
+
+            sshx.invoke(['import', '-', '-f', 'ssh', '--update'])
+            m.assert_called_with('-', fmt='ssh', update=True)
+
+        with mock.patch('sshx.sshx.handle_export') as m:
+            sshx.invoke(['export'])
+            m.assert_called_with(fmt='ssh', output=None, password=False)
+
+            sshx.invoke(['export', '-f', 'csv', '-o', 'hosts.csv', '-p'])
+            m.assert_called_with(fmt='csv', output='hosts.csv', password=True)
+
+    def test_trace(self):
+        with mock.patch('sshx.trace.set_trace') as m:
+            with mock.patch('sshx.sshx.handle_connect'):
+                sshx.invoke(['--trace', '-', 'connect', NAME1])
+                m.assert_called_with('-')
+
+    def test_retry(self):
+        with mock.patch('sshx.sshx.handle_connect'):
+            sshx.invoke(['--retry', 'always', '--retry-interval', '1',
+                         '--retry-max-interval', '60', 'connect', NAME1])
+            self.assertEqual(('always', 1, 60),
+                             (sshx.RETRY, sshx.RETRY_INTERVAL, sshx.RETRY_MAX_INTERVAL))
+
+            sshx.invoke(['connect', NAME1])
+            self.assertEqual((0, 5, 300),
+                             (sshx.RETRY, sshx.RETRY_INTERVAL, sshx.RETRY_MAX_INTERVAL))
+
+    def test_port_range(self):
+        with mock.patch('sshx.sshx.handle_connect'):
+            sshx.invoke(['--port-range', '50000-50100', 'connect', NAME1])
+            self.assertEqual((50000, 50100), ports.PortRange)
+
+            sshx.invoke(['connect', NAME1])
+            self.assertIsNone(ports.PortRange)
+
+    def test_hostkeys(self):
+        with mock.patch('sshx.sshx.handle_hostkeys_scan') as m:
+            sshx.invoke(['hostkeys', 'scan'])
+            m.assert_called_with('*', jobs=10, timeout=5)
+
+            sshx.invoke(['hostkeys', 'scan', 'web*', '-j', '4', '-t', '2'])
+            m.assert_called_with('web*', jobs=4, timeout=2)
+
+        with mock.patch('sshx.sshx.handle_hostkeys_list') as m:
+            sshx.invoke(['hostkeys', 'list'])
+            m.assert_called_with()
+
+        with mock.patch('sshx.sshx.handle_hostkeys_remove') as m:
+            sshx.invoke(['hostkeys', 'remove', NAME1])
+            m.assert_called_with(NAME1)
+
+        with mock.patch('sshx.sshx.handle_connect'):
+            sshx.invoke(['--no-known-hosts', 'connect', NAME1])
+            self.assertFalse(hostkeys.Enabled)
+
+            sshx.invoke(['connect', NAME1])
+            self.assertTrue(hostkeys.Enabled)
+
+    def test_tunnels(self):
+        with mock.patch('sshx.sshx.handle_tunnels_add') as m:
+            sshx.invoke(['tunnels', 'add', 'db', NAME1, '-L', '5432:127.0.0.1:5432'])
+            m.assert_called_with('db', NAME1, via=None, maps=('5432:127.0.0.1:5432',),
+                                 rmaps=(), socks=None)
+
+            sshx.invoke(['tunnels', 'add', 'proxy', NAME1, '-v', NAME2, '-D', '1080'])
+            m.assert_called_with('proxy', NAME1, via=NAME2, maps=(), rmaps=(), socks='1080')
+
+        with mock.patch('sshx.sshx.handle_tunnels_remove') as m:
+            sshx.invoke(['tunnels', 'remove', 'db'])
+            m.assert_called_with('db')
+
+        with mock.patch('sshx.sshx.handle_tunnels_list') as m:
+            sshx.invoke(['tunnels', 'list'])
+            m.assert_called_with()
+
+        with mock.patch('sshx.sshx.handle_tunnels_start') as m:
+            sshx.invoke(['tunnels', 'start', '-f'])
+            m.assert_called_with(foreground=True)
+
+        with mock.patch('sshx.sshx.handle_tunnels_stop') as m:
+            sshx.invoke(['tunnels', 'stop'])
+            m.assert_called_with(name=None)
+            sshx.invoke(['tunnels', 'stop', 'db'])
+            m.assert_called_with(name='db')
+
+        with mock.patch('sshx.sshx.handle_tunnels_reload') as m:
+            sshx.invoke(['tunnels', 'reload'])
+            m.assert_called_with()
+
+    def test_agent(self):
+        with mock.patch('sshx.sshx.handle_agent_start') as m:
+            sshx.invoke(['agent', 'start'])
+            m.assert_called_with(idle=3600, lifetime=0, foreground=False)
+
+            sshx.invoke(['agent', 'start', '--idle', '60', '--lifetime', '600', '-f'])
+            m.assert_called_with(idle=60, lifetime=600, foreground=True)
+
+        with mock.patch('sshx.sshx.handle_agent_stop') as m:
+            sshx.invoke(['agent', 'stop'])
+            m.assert_called_with()
+
+        with mock.patch('sshx.sshx.handle_agent_status') as m:
+            sshx.invoke(['agent', 'status'])
+            m.assert_called_with()
+
 
 global_test_init()
 
@@ -1,8 +1,12 @@
 from . import global_test_init
 import os
+import mock
+import shutil
 import unittest
 
 from .. import cfg
+from .. import utils
+from .. import tokenizer
 
 
 class ConfigTest(unittest.TestCase):
@@ -10,6 +14,40 @@ class ConfigTest(unittest.TestCase):
         c1 = cfg.Config({'phrase': '', 'accounts': []})
         self.assertTrue(c1.is_valid())
 
+    def test_index(self):
+        c1 = cfg.Config({'phrase': '', 'accounts': [
+            {'name': 'b1', 'host': 'h1'},
+            {'name': 'a1', 'host': 'h2', 'via': 'b1'},
+            {'name': 'a2', 'host': 'h2', 'via': 'b1'},
+        ]}, load=False)
+        self.assertEqual('h1', c1.get_account('b1').host)
+        self.assertIsNone(c1.get_account('a3'))
+        self.assertIsNone(c1.get_account(''))
+        self.assertEqual(['a1', 'a2'], [a.name for a in c1.get_accounts_by_via('b1')])
+        self.assertEqual(['a1', 'a2'], [a.name for a in c1.get_accounts_by_host('h2')])
+        self.assertEqual([], c1.get_accounts_by_via(''))
+
+        self.assertTrue(c1.add_account(cfg.Account('a3', host='h3', via='b1')))
+        self.assertFalse(c1.add_account(cfg.Account('a3')))
+        self.assertEqual('h3', c1.get_account('a3').host)
+        self.assertEqual(3, len(c1.get_accounts_by_via('b1')))
+
+        self.assertTrue(c1.rename_account(c1.get_account('a1'), 'a4'))
+        self.assertFalse(c1.rename_account(c1.get_account('a2'), 'a4'))
+        self.assertIsNone(c1.get_account('a1'))
+        self.assertEqual('h2', c1.get_account('a4').host)
+        self.assertEqual(['a2', 'a4'], sorted(a.name for a in c1.get_accounts_by_host('h2')))
+
+        c1.update_account(c1.get_account('a2'), {'host': 'h3', 'via': ''})
+        self.assertEqual(['a4'], [a.name for a in c1.get_accounts_by_host('h2')])
+        self.assertEqual(['a3', 'a4'], sorted(a.name for a in c1.get_accounts_by_via('b1')))
+
+        self.assertTrue(c1.remove_account('a3'))
+        self.assertFalse(c1.remove_account('a3'))
+        self.assertIsNone(c1.get_account('a3'))
+        self.assertEqual(['a2'], [a.name for a in c1.get_accounts_by_host('h3')])
+        self.assertEqual(3, len(c1.accounts))
+
 
 class CfgTest(unittest.TestCase):
     def test_set_config_dir(self):
@@ -20,6 +58,148 @@ class CfgTest(unittest.TestCase):
             config_dir, cfg._ACCOUNT_FILE), cfg.ACCOUNT_FILE)
 
 
+class WriteConfigTest(unittest.TestCase):
+    TEST_DIR = '/tmp/sshx-test-write'
+
+    def setUp(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+        cfg.set_config_dir(self.TEST_DIR)
+        cfg.init_config()
+        config = cfg.read_config()
+        for i in range(3):
+            config.add_account(cfg.Account(f'a{i}', host=f'h{i}', password=f'p{i}'))
+        cfg.write_config(config)
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def test_only_changed(self):
+        config = cfg.read_config()
+        config.get_accounts(decrypt=True)
+        config.update_account(config.get_account('a1'), {'host': 'h4'})
+        config.update_account(config.get_account('a2'), {'password': 'p5'})
+
+        with mock.patch('sshx.tokenizer.encrypt', return_value='x') as m:
+            self.assertTrue(cfg.write_config(config))
+            m.assert_called_once_with('p5', config.phrase)
+
+        # untouched accounts are written back as they were
+        with open(cfg.ACCOUNT_FILE) as f:
+            self.assertNotIn('"p0"', f.read())
+        self.assertEqual(0o600, os.stat(cfg.ACCOUNT_FILE).st_mode & 0o777)
+
+    def test_keep_ciphertext(self):
+        with open(cfg.ACCOUNT_FILE) as f:
+            before = utils.json_load(f.read())['accounts']
+
+        # decrypted, but the secrets are unchanged
+        config = cfg.read_config()
+        config.get_account('a0', decrypt=True)
+        config.update_account(config.get_account('a0'), {'host': 'h4', 'name': 'b0'})
+        # never decrypted, only the password set is encrypted
+        with mock.patch('sshx.tokenizer.decrypt') as m:
+            config.update_account(config.get_account('a1'), {'password': 'p5'})
+            m.assert_not_called()
+        with mock.patch('sshx.tokenizer.encrypt', wraps=tokenizer.encrypt) as m:
+            self.assertTrue(cfg.write_config(config))
+            m.assert_not_called()
+
+        with open(cfg.ACCOUNT_FILE) as f:
+            after = {a['name']: a for a in utils.json_load(f.read())['accounts']}
+        self.assertEqual(before[0]['password'], after['b0']['password'])
+        self.assertNotEqual(before[1]['password'], after['a1']['password'])
+        self.assertEqual(before[2], after['a2'])
+
+        config = cfg.read_config()
+        self.assertEqual(['p0', 'p5', 'p2'], [config.get_account(n, decrypt=True).password
+                                              for n in ('b0', 'a1', 'a2')])
+
+    def test_concurrent(self):
+        c1 = cfg.read_config()
+        c2 = cfg.read_config()
+
+        c1.add_account(cfg.Account('b1', host='h5', password='p5'))
+        c1.remove_account('a0')
+        c2.update_account(c2.get_account('a1'), {'name': 'b2'})
+        c2.update_account(c2.get_account('a2'), {'host': 'h6'})
+        self.assertTrue(cfg.write_config(c1))
+        self.assertTrue(cfg.write_config(c2))
+
+        config = cfg.read_config()
+        self.assertEqual(['a2', 'b1', 'b2'], [a.name for a in config.get_accounts()])
+        self.assertEqual('h6', config.get_account('a2').host)
+        self.assertEqual('p1', config.get_account('b2', decrypt=True).password)
+        self.assertEqual('p5', config.get_account('b1', decrypt=True).password)
+
+        # the passphrase was changed by another process
+        c2.add_account(cfg.Account('b3'))
+        c1.reset_passphrase()
+        self.assertTrue(cfg.write_config(c1))
+        self.assertFalse(cfg.write_config(c2))
+
+    def _write_legacy(self, security, phrase):
+        key = phrase if security else 'k' * 32
+        utils.atomic_write(cfg.ACCOUNT_FILE, utils.json_dump({
+            'security': security,
+            'phrase': tokenizer.hash(phrase) if security else key,
+            'accounts': [{'name': f'a{i}', 'host': f'h{i}',
+                          'password': tokenizer._legacy_encrypt(f'p{i}', key)}
+                         for i in range(3)],
+        }))
+
+    def _load_file(self):
+        with open(cfg.ACCOUNT_FILE) as f:
+            return utils.json_load(f.read())
+
+    @unittest.skipUnless(tokenizer.has_aead(), 'cryptography is not installed')
+    def test_migrate(self):
+        self._write_legacy(False, '')
+        config = cfg.read_config()
+        self.assertEqual('p1', config.get_account('a1', decrypt=True).password)
+
+        config.remove_account('a2')
+        self.assertTrue(cfg.write_config(config))
+        d = self._load_file()
+        self.assertTrue(all(tokenizer.is_v2(a['password']) for a in d['accounts']))
+        self.assertEqual(['p0', 'p1'], [a.password for a in cfg.read_config().get_accounts(decrypt=True)])
+
+    def test_migrate_security(self):
+        self._write_legacy(True, 'phrase')
+
+        # removing doesn't ask for the passphrase only to migrate
+        config = cfg.read_config()
+        with mock.patch('sshx.utils.read_password') as m:
+            config.remove_account('a2')
+            self.assertTrue(cfg.write_config(config))
+            m.assert_not_called()
+        self.assertFalse(tokenizer.is_v2(self._load_file()['phrase']))
+
+        config = cfg.read_config()
+        with mock.patch('sshx.utils.read_password', return_value='phrase'):
+            config.add_account(cfg.Account('b1', host='h', password='pb'))
+            self.assertTrue(cfg.write_config(config))
+
+        d = self._load_file()
+        self.assertTrue(tokenizer.is_v2(d['phrase']))
+        if tokenizer.has_aead():
+            self.assertTrue(all(tokenizer.is_v2(a['password']) for a in d['accounts']))
+
+        config = cfg.read_config()
+        self.assertFalse(config.verify_passphrase('wrong'))
+        with mock.patch('sshx.utils.read_password', return_value='phrase'):
+            self.assertEqual(['p0', 'p1', 'pb'], [a.password for a in config.get_accounts(decrypt=True)])
+
+    def test_atomic(self):
+        config = cfg.read_config()
+        config.add_account(cfg.Account('b1'))
+
+        with mock.patch('os.replace', side_effect=OSError):
+            self.assertRaises(OSError, cfg.write_config, config)
+
+        self.assertEqual(3, len(cfg.read_config().get_accounts()))
+        self.assertEqual(['.accounts', '.accounts.lock'], sorted(os.listdir(self.TEST_DIR)))
+
+
 global_test_init()
 
 if __name__ == '__main__':
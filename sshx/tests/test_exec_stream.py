@@ -0,0 +1,116 @@
+from . import global_test_init
+import mock
+import shutil
+import subprocess
+import unittest
+
+import lazy_object_proxy as lazy
+
+from .. import cfg
+from .. import sshwrap
+from ..account import Account
+from ..const import STATUS_SUCCESS, STATUS_FAIL
+
+
+def _open_pipe(account, cmd, vias=None):
+    # run the remote command locally
+    return subprocess.Popen(['sh', '-c', cmd], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+@mock.patch('sshx.sshwrap.open_pipe', side_effect=_open_pipe)
+@mock.patch('sshx.sshwrap._start_master', return_value=mock.Mock(status=STATUS_SUCCESS))
+class ExecStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.account = Account('name1', host='host1', password='password1')
+
+    def test_chunks(self, m_master, m_pipe):
+        stream = sshwrap.exec_stream(self.account, 'echo out; echo err >&2; exit 3', vias='name2')
+        m_master.assert_called_with(self.account, 'true', 'name2')
+        output = {'stdout': b'', 'stderr': b''}
+        for name, data in stream:
+            output[name] += data
+        self.assertEqual({'stdout': b'out\n', 'stderr': b'err\n'}, output)
+        self.assertEqual(3, stream.returncode)
+
+    def test_lines(self, m_master, m_pipe):
+        cmd = "printf 'a\\nbb\\n'; printf 'ccc'; sleep 0.1; printf 'c\\nlast'"
+        stream = sshwrap.exec_stream(self.account, cmd, lines=True, encoding='utf-8')
+        self.assertEqual([('stdout', 'a\n'), ('stdout', 'bb\n'), ('stdout', 'cccc\n'),
+                          ('stdout', 'last')], list(stream))
+        self.assertEqual(0, stream.returncode)
+
+    def test_max_buffer(self, m_master, m_pipe):
+        cmd = "printf '1234567890\\n12\\n'"
+        stream = sshwrap.exec_stream(self.account, cmd, lines=True, max_buffer=4)
+        self.assertEqual([b'1234', b'5678', b'90\n', b'12\n'], [data for _, data in stream])
+
+    def test_large_output(self, m_master, m_pipe):
+        size = 8 * 1024 * 1024
+        stream = sshwrap.exec_stream(self.account, f'head -c {size} /dev/zero',
+                                     chunk_size=4096)
+        total = 0
+        for _, data in stream:
+            self.assertTrue(len(data) <= 4096)
+            total += len(data)
+        self.assertEqual(size, total)
+
+    def test_close(self, m_master, m_pipe):
+        # the command is killed once the consumer stops early
+        stream = sshwrap.exec_stream(self.account, 'yes', lines=True)
+        for i, (_, data) in enumerate(stream):
+            if i == 10:
+                break
+        stream.close()
+        self.assertIsNotNone(stream.p.poll())
+
+    def test_connect_failed(self, m_master, m_pipe):
+        m_master.return_value = mock.Mock(status=STATUS_FAIL)
+        with self.assertRaises(sshwrap.ExecError):
+            sshwrap.exec_stream(self.account, 'true')
+        m_pipe.assert_not_called()
+
+
+_popen = subprocess.Popen
+
+
+def _ssh(argv, **kwargs):
+    # run the remote part of the real ssh argv locally, as ssh does: the
+    # words after the destination joined by spaces, by the shell
+    return _popen(['sh', '-c', ' '.join(argv[argv.index('root@host1') + 1:])], **kwargs)
+
+
+@mock.patch('subprocess.Popen', side_effect=_ssh)
+@mock.patch('sshx.hostkeys._checking', 'accept-new')
+@mock.patch('sshx.sshwrap._start_master', return_value=mock.Mock(status=STATUS_SUCCESS))
+class ExecStreamArgvTest(unittest.TestCase):
+    TEST_DIR = '/tmp/sshx-test-exec-stream'
+
+    def setUp(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+        cfg.set_config_dir(self.TEST_DIR)
+        cfg.init_config()
+        config = cfg.read_config()
+        self.account = Account('name1', host='host1', password='password1')
+        config.add_account(self.account)
+        cfg.write_config(config)
+        cfg.config = lazy.Proxy(cfg.get_config)
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def test_quoted(self, m_master, m_popen):
+        cmd = "printf '%s|' 'a  b' \"c'd\""
+        stream = sshwrap.exec_stream(self.account, cmd)
+        argv = m_popen.call_args[0][0]
+        self.assertEqual('ssh', argv[0])
+        self.assertEqual(['root@host1', cmd], argv[-2:])
+        self.assertIn('BatchMode=yes', argv)
+        self.assertEqual(b"a  b|c'd|", b''.join(data for _, data in stream))
+        self.assertEqual(0, stream.returncode)
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
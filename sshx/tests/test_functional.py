@@ -1,5 +1,3 @@
-# -*- coding: future_fstrings -*-
-
 from . import global_test_init
 import os
 import mock
@@ -14,6 +12,8 @@ from .. import cfg
 from .. import sshx
 from .. import utils
 from .. import sshwrap
+from .. import hostkeys
+from .. import tokenizer
 from ..const import STATUS_SUCCESS, STATUS_FAIL
 
 
@@ -70,7 +70,7 @@ COMMAND1 = 'ls -al'
 TEST_DIR = '/tmp/sshx-test-tmp'
 
 _SSH_CONFIG_FILE = 'ssh-config-file'
-SSH_CONFIG_FILE = os.path.join(TEST_DIR, _SSH_CONFIG_FILE)
+SSH_CONFIG_FILE = os.path.join(TEST_DIR, sshwrap._CHAINS_DIR, _SSH_CONFIG_FILE)
 
 
 def _reset():
@@ -360,6 +360,132 @@ class FunctionalTest(unittest.TestCase):
         self.assertEqual(0, len(config.accounts))
         self.assertIsNone(cfg.find_by_name(config.accounts, NAME2))
 
+    def test_hostkeys(self):
+        # the keys are kept by the account name, so they follow the account
+        def keys():
+            return {name: [key for _, key in found] for name, found in hostkeys.load().items()}
+
+        hostkeys._append([(NAME1, 'ssh-ed25519', 'STALE1'), (NAME2, 'ssh-ed25519', 'STALE2')])
+        sshx.handle_add(NAME1, HOST1, port=PORT1, user=USER1, password=PASSWORD1)
+        self.assertEqual({NAME2: ['STALE2']}, keys())
+
+        hostkeys._append([(NAME1, 'ssh-ed25519', 'KEY1')])
+        self.assertEqual(STATUS_SUCCESS, sshx.handle_update(NAME1, update_fields={'name': NAME2}))
+        self.assertEqual({NAME2: ['KEY1']}, keys())
+
+        sshx.handle_update(NAME2, update_fields={'host': HOST1, 'user': USER2})
+        self.assertEqual({NAME2: ['KEY1']}, keys())
+        sshx.handle_update(NAME2, update_fields={'host': HOST2})
+        self.assertEqual({}, keys())
+
+        hostkeys._append([(NAME2, 'ssh-ed25519', 'KEY2')])
+        sshx.handle_del(NAME2)
+        self.assertEqual({}, keys())
+
+    def test_show(self):
+        ret = sshx.handle_add(NAME1, HOST1, port=PORT1,
+                              user=USER1, password=PASSWORD1, identity=NOIDENTITY)
+        self.assertEqual(STATUS_SUCCESS, ret)
+
+        for fmt in ['json', 'binary']:
+            cfg.convert_config(fmt)
+            with mock.patch('builtins.print') as m:
+                self.assertEqual(STATUS_SUCCESS, sshx.handle_show(NAME1))
+                fields = m.call_args[0][0]
+                self.assertEqual(HOST1, fields['host'])
+                self.assertNotIn('password', fields)
+
+                self.assertEqual(STATUS_SUCCESS, sshx.handle_show(NAME1, password=True))
+                self.assertEqual(PASSWORD1, m.call_args[0][0]['password'])
+
+            self.assertEqual(STATUS_FAIL, sshx.handle_show(NAME2))
+
+    def test_write_conflict(self):
+        ret = sshx.handle_add(NAME1, HOST1, port=PORT1,
+                              user=USER1, password=PASSWORD1, identity=NOIDENTITY)
+        self.assertEqual(STATUS_SUCCESS, ret)
+
+        # the phrase or security was changed by another process meanwhile
+        with mock.patch('sshx.cfg.write_config', return_value=False):
+            self.assertEqual(STATUS_FAIL, sshx.handle_add(NAME2, HOST2))
+            self.assertEqual(STATUS_FAIL, sshx.handle_update(NAME1, update_fields={'host': HOST2}))
+            self.assertEqual(STATUS_FAIL, sshx.handle_del(NAME1))
+            self.assertEqual(STATUS_FAIL, sshx.handle_config(security=False))
+            self.assertEqual(STATUS_FAIL, sshx.handle_config(chphrase=True))
+            self.addCleanup(tokenizer.set_kdf_cost, tokenizer.KDF_COST)
+            self.assertEqual(STATUS_FAIL, sshx.handle_config(kdf_cost=1))
+
+    def test_import(self):
+        ret = sshx.handle_add(NAME1, HOST1, port=PORT1,
+                              user=USER1, password=PASSWORD1, identity=NOIDENTITY)
+        self.assertEqual(STATUS_SUCCESS, ret)
+
+        filename = os.path.join(TEST_DIR, 'hosts.csv')
+        with open(filename, 'w') as f:
+            f.write('name,host,user,password,via\n')
+            f.write(f'{NAME1},{HOST2},{USER2},,\n')
+            f.write(f'{NAME2},{HOST2},{USER2},{PASSWORD2},{NAME1}\n')
+            f.write(f'{NAME3},{HOST3},{USER3},{PASSWORD3},{NAME2}\n')
+
+        with mock.patch('sshx.cfg.write_config', wraps=cfg.write_config) as m:
+            ret = sshx.handle_import(filename)
+            self.assertEqual(STATUS_SUCCESS, ret)
+            m.assert_called_once()
+
+        config = cfg.read_config()
+        self.assertEqual(3, len(config.accounts))
+        self.assertEqual(HOST1, config.get_account(NAME1).host)
+        self.assertEqual(PASSWORD3, config.get_account(NAME3, decrypt=True).password)
+
+        ret = sshx.handle_import(filename, update=True)
+        self.assertEqual(STATUS_SUCCESS, ret)
+        config = cfg.read_config()
+        account = config.get_account(NAME1, decrypt=True)
+        self.assertEqual(HOST2, account.host)
+        self.assertEqual(PASSWORD1, account.password)
+
+        # jump host not found, nothing is written
+        with open(filename, 'w') as f:
+            f.write(f'name,host,via\n{NAME4},{HOST4},{NAME5}\n')
+        ret = sshx.handle_import(filename)
+        self.assertEqual(STATUS_FAIL, ret)
+        self.assertEqual(3, len(cfg.read_config().accounts))
+
+        # a jump account leads to the next by its own via
+        with open(filename, 'w') as f:
+            f.write(f'name,host,via\n{NAME4},{HOST4},"{NAME1},{NAME2}"\n')
+        ret = sshx.handle_import(filename)
+        self.assertEqual(STATUS_FAIL, ret)
+        self.assertEqual(3, len(cfg.read_config().accounts))
+
+        ret = sshx.handle_import(filename + '.missing')
+        self.assertEqual(STATUS_FAIL, ret)
+
+    def test_export(self):
+        ret = sshx.handle_add(NAME1, HOST1, port=PORT1,
+                              user=USER1, password=PASSWORD1, identity=NOIDENTITY)
+        self.assertEqual(STATUS_SUCCESS, ret)
+        ret = sshx.handle_add(NAME2, HOST2, port=PORT2, via=NAME1,
+                              user=USER2, password=PASSWORD2, identity=IDENTITY2)
+        self.assertEqual(STATUS_SUCCESS, ret)
+
+        filename = os.path.join(TEST_DIR, 'config')
+        ret = sshx.handle_export(output=filename)
+        self.assertEqual(STATUS_SUCCESS, ret)
+        _assert_file_contains(self, filename, [
+            f'Host {NAME1}', f'HostName {HOST2}', f'IdentityFile {IDENTITY2}',
+            f'ProxyCommand ssh -F {filename} -W %h:%p {NAME1}'])
+
+        filename = os.path.join(TEST_DIR, 'hosts.csv')
+        ret = sshx.handle_export(fmt='csv', output=filename, password=True)
+        self.assertEqual(STATUS_SUCCESS, ret)
+        _assert_file_contains(self, filename, f'{NAME2},{USER2},{HOST2},{PORT2},{PASSWORD2}')
+        self.assertEqual(0o600, os.stat(filename).st_mode & 0o777)
+
+
+def _hostkeys(name):
+    return sshwrap.hostkeys.ssh_options(name)
+
 
 def _assert_called_with(m, command):
     m.assert_called_with(utils.format_command(command))
@@ -428,6 +554,7 @@ class SpawnCommandTest(unittest.TestCase):
         '''sshx connect <NAME1>'''
         sshx.handle_connect(NAME1)
         command = sshwrap._SSH_COMMAND_PASSWORD.format(
+            hostkeys=_hostkeys(NAME1),
             user=USER1, host=HOST1, port=PORT1, identity=NOIDENTITY,
             extras='-o ServerAliveInterval=15 -o ServerAliveCountMax=210240000', forwards='', jump='', cmd='',
         )
@@ -436,25 +563,41 @@ class SpawnCommandTest(unittest.TestCase):
         '''sshx connect <NAME2>'''
         sshx.handle_connect(NAME2)
         command = sshwrap._SSH_COMMAND_IDENTITY.format(
+            hostkeys=_hostkeys(NAME2),
             user=USER2, host=HOST2, port=PORT2, identity=IDENTITY2,
             extras='-o ServerAliveInterval=15 -o ServerAliveCountMax=210240000', forwards='', jump='', cmd='',
         )
         _assert_called_with(m, command)
 
-    # mock the __del__ to avoid deleting config file
-    # mock the uuid to set the config file
+    @mock.patch('pexpect.spawn', autospec=True)
+    def test_connect_no_known_hosts(self, m):
+        '''sshx --no-known-hosts connect <NAME1>'''
+        self.assertIn(f'-o UserKnownHostsFile={cfg.KNOWN_HOSTS_FILE}', _hostkeys(NAME1))
+        self.assertIn(f'-o HostKeyAlias={NAME1}', _hostkeys(NAME1))
+
+        with mock.patch('sshx.hostkeys.Enabled', False):
+            sshx.handle_connect(NAME1)
+        command = sshwrap._SSH_COMMAND_PASSWORD.format(
+            hostkeys='-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null',
+            user=USER1, host=HOST1, port=PORT1, identity=NOIDENTITY,
+            extras='-o ServerAliveInterval=15 -o ServerAliveCountMax=210240000', forwards='', jump='', cmd='',
+        )
+        _assert_called_with(m, command)
+
+    # mock the digest to set the config file
     # mock spawn to get the executed command
-    @mock.patch('sshx.utils.delete_file')
-    @mock.patch('sshx.sshwrap.uuid.uuid4', return_value=_SSH_CONFIG_FILE)
+    @mock.patch('sshx.sshwrap.config_digest', return_value=_SSH_CONFIG_FILE)
     @mock.patch('pexpect.spawn', autospec=True)
-    def test_connect_via(self, m, m_uuid, m_del):
+    def test_connect_via(self, m, m_digest):
         '''sshx connect <NAME1> -v <NAME2>'''
         sshx.handle_connect(NAME1, via=f'{NAME2}')
         command = sshwrap._SSH_COMMAND_CONFIG.format(
             name=NAME1, extras=f'-F {SSH_CONFIG_FILE}',
             forwards='', cmd='', jump='')
         _assert_called_with(m, command)
-        _assert_file_contains(self, SSH_CONFIG_FILE, f'Host {NAME2}')
+        _assert_file_contains(self, SSH_CONFIG_FILE,
+                              [f'Host {NAME2}', f'HostKeyAlias {NAME2}',
+                               f'UserKnownHostsFile "{cfg.KNOWN_HOSTS_FILE}"'])
 
         '''sshx connect <NAME1> -v <NAME3>,<NAME4>'''
         sshx.handle_connect(NAME1, via=f'{NAME3},{NAME4}')
@@ -467,12 +610,39 @@ class SpawnCommandTest(unittest.TestCase):
             [f'Host {NAME3}', f'Host {NAME4}',
              f'IdentityFile {IDENTITY3}'])
 
+    @mock.patch('pexpect.spawn', autospec=True)
+    def test_chain_config(self, m):
+        legacy = os.path.join(TEST_DIR, '9b2f8a1e-4c3d-4e5f-8a9b-0c1d2e3f4a5b')
+        open(legacy, 'w').close()
+
+        sshx.handle_connect(NAME1, via=NAME2)
+        config_file = m.call_args[0][0].split()[2]
+        self.assertTrue(config_file.startswith(sshwrap.chains_dir()))
+        self.assertFalse(os.path.exists(legacy))
+
+        # the same chain reuses the file
+        with mock.patch('sshx.utils.atomic_write') as m_write:
+            sshx.handle_connect(NAME1, via=NAME2)
+            m_write.assert_not_called()
+        self.assertEqual(config_file, m.call_args[0][0].split()[2])
+
+        # changed account in the chain gets a new file
+        sshx.handle_update(NAME2, {'host': HOST3})
+        sshx.handle_connect(NAME1, via=NAME2)
+        self.assertNotEqual(config_file, m.call_args[0][0].split()[2])
+        self.assertEqual(2, len(os.listdir(sshwrap.chains_dir())))
+
+        os.utime(config_file, (0, 0))
+        self.assertEqual(1, sshwrap.gc_chain_configs())
+        self.assertFalse(os.path.exists(config_file))
+
     @mock.patch('sshx.sshwrap.SSHPexpect.daemonize', return_value=False)
     @mock.patch('pexpect.spawn', autospec=True)
     def test_forward(self, m, m_daemon):
         '''sshx forward <NAME1> -f <FORWARD1>'''
         sshx.handle_forward(NAME1, maps=(FORWARD1,))
         command = sshwrap._SSH_COMMAND_PASSWORD.format(
+            hostkeys=_hostkeys(NAME1),
             user=USER1, host=HOST1, port=PORT1, identity=NOIDENTITY,
             extras='-NT -o ServerAliveInterval=15 -o ServerAliveCountMax=210240000',
             forwards=f'-L {FORWARD1}', jump='', cmd='',
@@ -483,6 +653,7 @@ class SpawnCommandTest(unittest.TestCase):
         '''sshx forward <NAME1> -b -f <FORWARD1>'''
         sshx.handle_forward(NAME1, maps=(FORWARD1,), background=True)
         command = sshwrap._SSH_COMMAND_PASSWORD.format(
+            hostkeys=_hostkeys(NAME1),
             user=USER1, host=HOST1, port=PORT1, identity=NOIDENTITY,
             extras='-NT -o ServerAliveInterval=15 -o ServerAliveCountMax=210240000',
             forwards=f'-L {FORWARD1}', jump='', cmd='',
@@ -490,10 +661,9 @@ class SpawnCommandTest(unittest.TestCase):
         _assert_called_with(m, command)
         m_daemon.assert_called_once()
 
-    @mock.patch('sshx.utils.delete_file')
-    @mock.patch('sshx.sshwrap.uuid.uuid4', return_value=_SSH_CONFIG_FILE)
+    @mock.patch('sshx.sshwrap.config_digest', return_value=_SSH_CONFIG_FILE)
     @mock.patch('pexpect.spawn', autospec=True)
-    def test_forward_via(self, m, m_uuid, m_del):
+    def test_forward_via(self, m, m_digest):
         '''sshx forward <NAME1> -v <NAME4> -f <FORWARD1>'''
         sshx.handle_forward(NAME1, maps=(FORWARD1,), via=NAME4)
         command = sshwrap._SSH_COMMAND_CONFIG.format(
@@ -516,15 +686,221 @@ class SpawnCommandTest(unittest.TestCase):
         '''sshx scp <DIR1> <NAME1>:<DIR2>'''
         sshx.handle_scp(DIR1, f'{NAME1}:{DIR2}')
         command = sshwrap._SCP_COMMAND_PASSWORD.format(
-            port=PORT1, jump='',
+            hostkeys=_hostkeys(NAME1),
+            port=PORT1, jump='', extras='',
             src=DIR1, dst=f'{USER1}@{HOST1}:{DIR2}',
         )
         _assert_called_with(m, command)
 
-    @mock.patch('sshx.utils.delete_file')
-    @mock.patch('sshx.sshwrap.uuid.uuid4', return_value=_SSH_CONFIG_FILE)
+    @mock.patch('sshx.sshwrap.SSHPexpect.auth', return_value=True)
+    def test_pscp(self, m_auth):
+        import pexpect
+        spawn = pexpect.spawn
+        commands = []
+
+        def _spawn(command):
+            commands.append(command)
+            return spawn('true')
+
+        src = os.path.join(TEST_DIR, 'src')
+        os.makedirs(os.path.join(src, 'sub'))
+        for f in ('f1', 'f2', 'sub/f3'):
+            with open(os.path.join(src, f), 'w') as fp:
+                fp.write(f)
+
+        with mock.patch('pexpect.spawn', side_effect=_spawn):
+            ret = sshx.handle_pscp([src], f'{NAME1}:{DIR2}', jobs=2)
+        self.assertEqual(STATUS_SUCCESS, ret)
+
+        # the first session creates the directories and the master connection
+        self.assertIn(f'mkdir -p {DIR2} {DIR2}/src {DIR2}/src/sub', commands[0])
+        self.assertIn(f'-o ControlPath={sshwrap.control_path(NAME1)}', commands[0])
+        scps = sorted(commands[1:])
+        self.assertEqual(3, len(scps))
+        self.assertTrue(all(c.startswith('scp -r') and ' -q ' in c and 'ControlPath' in c
+                            for c in scps))
+        self.assertTrue(scps[0].endswith(f"{src}/f1 {USER1}@{HOST1}:{DIR2}/src/"))
+        self.assertTrue(scps[2].endswith(f"{src}/sub/f3 {USER1}@{HOST1}:{DIR2}/src/sub/"))
+
+        commands.clear()
+        dst = os.path.join(TEST_DIR, 'dst')
+        with mock.patch('pexpect.spawn', side_effect=_spawn):
+            ret = sshx.handle_pscp([f'{NAME1}:/a', f'{NAME1}:/b'], dst, jobs=2)
+        self.assertEqual(STATUS_SUCCESS, ret)
+        self.assertTrue(os.path.isdir(dst))
+        self.assertEqual(3, len(commands))
+        self.assertTrue(commands[0].endswith(' true'))
+
+        ret = sshx.handle_pscp([f'{NAME1}:/a', src], dst)
+        self.assertEqual(STATUS_FAIL, ret)
+        ret = sshx.handle_pscp([f'{NAME1}:/a', f'{NAME2}:/b'], dst)
+        self.assertEqual(STATUS_FAIL, ret)
+
+        with mock.patch('pexpect.spawn', side_effect=lambda c: spawn('false')):
+            ret = sshx.handle_pscp([src], f'{NAME1}:{DIR2}', jobs=2)
+        self.assertEqual(STATUS_FAIL, ret)
+
+    @mock.patch('sshx.sshx_sync.Sync.connect')
+    def test_sync(self, m_connect):
+        import subprocess
+        popen = subprocess.Popen
+        commands = []
+
+        def _ssh(argv, **kwargs):
+            # run the remote helper locally, as ssh would: the words after
+            # the destination joined by spaces, by the shell
+            command = ' '.join(argv[argv.index(f'{USER1}@{HOST1}') + 1:])
+            commands.append(command)
+            return popen(['sh', '-c', command], **kwargs)
+
+        src = os.path.join(TEST_DIR, 'src')
+        os.makedirs(os.path.join(src, 'sub'))
+        with open(os.path.join(src, 'f1'), 'wb') as f:
+            f.write(b'a' * 8192 + b'b' * 8192)
+        with open(os.path.join(src, 'sub/f2'), 'wb') as f:
+            f.write(b'c' * 100)
+        remote = os.path.join(TEST_DIR, 'remote')
+        local = os.path.join(TEST_DIR, 'local')
+
+        with mock.patch('subprocess.Popen', side_effect=_ssh):
+            ret = sshx.handle_sync([src], f'{NAME1}:{remote}', chunk_size=4096)
+            self.assertEqual(STATUS_SUCCESS, ret)
+            m_connect.assert_called_with(mkdir=remote)
+            self.assertTrue(all(c.startswith('PY=$(command -v python3') for c in commands))
+            with open(os.path.join(remote, 'src/f1'), 'rb') as f:
+                self.assertEqual(b'a' * 8192 + b'b' * 8192, f.read())
+
+            # resume an interrupted copy, only the missing chunks are sent
+            with open(os.path.join(remote, 'src/f1'), 'r+b') as f:
+                f.truncate(4096)
+            with mock.patch('sshx.sshx_sync.SyncStats.add') as m_add:
+                ret = sshx.handle_sync([src], f'{NAME1}:{remote}', chunk_size=4096)
+            self.assertEqual(STATUS_SUCCESS, ret)
+            changes = m_add.call_args[0][1]
+            self.assertEqual([('f1', [[4096, 12288]])], [(c[0], c[2]) for c in changes])
+            with open(os.path.join(remote, 'src/f1'), 'rb') as f:
+                self.assertEqual(b'a' * 8192 + b'b' * 8192, f.read())
+
+            ret = sshx.handle_sync([f'{NAME1}:{remote}/src'], local, chunk_size=4096)
+            self.assertEqual(STATUS_SUCCESS, ret)
+            m_connect.assert_called_with(mkdir=None)
+            with open(os.path.join(local, 'src/sub/f2'), 'rb') as f:
+                self.assertEqual(b'c' * 100, f.read())
+
+            ret = sshx.handle_sync([f'{NAME1}:{remote}/nonexist'], local)
+            self.assertEqual(STATUS_FAIL, ret)
+
+        ret = sshx.handle_sync([f'{NAME1}:/a', src], local)
+        self.assertEqual(STATUS_FAIL, ret)
+
+    @mock.patch('time.sleep')
+    @mock.patch('sshx.sshx.RETRY', 'always')
+    def test_sync_retry(self, m_sleep):
+        import subprocess
+        popen = subprocess.Popen
+
+        def _ssh(argv, **kwargs):
+            return popen(['sh', '-c', ' '.join(argv[argv.index(f'{USER1}@{HOST1}') + 1:])], **kwargs)
+
+        src = os.path.join(TEST_DIR, 'src')
+        os.makedirs(src)
+        remote = os.path.join(TEST_DIR, 'remote')
+        connected = mock.Mock(status=STATUS_SUCCESS)
+        lost = mock.Mock(status=STATUS_FAIL, failure=None, exitstatus=255)
+        with mock.patch('subprocess.Popen', side_effect=_ssh), \
+                mock.patch('sshx.sshwrap._start_master', return_value=connected) as m_master:
+            # permanent failures are not retried
+            ret = sshx.handle_sync([f'{NAME1}:{remote}/nonexist'], TEST_DIR)
+            self.assertEqual(STATUS_FAIL, ret)
+            m_master.return_value = mock.Mock(status=STATUS_FAIL, failure=None, exitstatus=1)
+            ret = sshx.handle_sync([src], f'{NAME1}:{remote}')
+            self.assertEqual(STATUS_FAIL, ret)
+            m_sleep.assert_not_called()
+
+            # a lost connection is
+            m_master.side_effect = [lost, connected]
+            ret = sshx.handle_sync([src], f'{NAME1}:{remote}')
+            self.assertEqual(STATUS_SUCCESS, ret)
+            m_sleep.assert_called_once()
+            self.assertTrue(os.path.isdir(os.path.join(remote, 'src')))
+
+    @mock.patch('sshx.sshwrap.SSHPexpect.auth', return_value=True)
+    def test_relay(self, m_auth):
+        import pexpect
+        import subprocess
+        spawn = pexpect.spawn
+        commands, pipes = [], []
+
+        def _open_pipe(account, cmd, vias=None):
+            pipes.append((account.name, cmd, vias))
+            return subprocess.Popen(['sh', '-c', cmd], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def _spawn(command):
+            commands.append(command)
+            return spawn('true')
+
+        src = os.path.join(TEST_DIR, 'src')
+        os.makedirs(os.path.join(src, 'sub'))
+        data = os.urandom(3 * 1024 * 1024)
+        with open(os.path.join(src, 'sub/f1'), 'wb') as f:
+            f.write(data)
+        dst = os.path.join(TEST_DIR, 'dst')
+        os.makedirs(dst)
+
+        with mock.patch('pexpect.spawn', side_effect=_spawn), \
+                mock.patch('sshx.sshwrap.open_pipe', side_effect=_open_pipe):
+            ret = sshx.handle_scp(f'{NAME1}:{src}/', f'{NAME2}:{dst}', via=NAME4, dst_via=NAME3)
+        self.assertEqual(STATUS_SUCCESS, ret)
+        with open(os.path.join(dst, 'src/sub/f1'), 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        # both masters are started, and every side uses its own jump hosts
+        self.assertEqual(2, len(commands))
+        self.assertTrue(commands[1].endswith(f'mkdir -p {dst}'))
+        self.assertEqual((NAME1, f'tar -C {TEST_DIR} -cf - src', NAME4), pipes[0])
+        self.assertEqual((NAME2, f'tar -C {dst} -xf -', NAME3), pipes[1])
+
+        pipes.clear()
+        with mock.patch('pexpect.spawn', side_effect=_spawn), \
+                mock.patch('sshx.sshwrap.open_pipe', side_effect=_open_pipe):
+            ret = sshx.handle_scp(f'{NAME1}:{TEST_DIR}/nonexist', f'{NAME2}:{dst}')
+            self.assertEqual(STATUS_FAIL, ret)
+            self.assertFalse(pipes[0][2])
+
+            ret = sshx.handle_scp(f'nonexist:{src}', f'{NAME2}:{dst}')
+            self.assertEqual(STATUS_FAIL, ret)
+
+        # stderr is read along, more than a pipe holds doesn't block tar
+        def _noisy_pipe(account, cmd, vias=None):
+            return _open_pipe(account, f'head -c 1000000 /dev/zero >&2; {cmd}', vias)
+
+        os.remove(os.path.join(dst, 'src/sub/f1'))
+        with mock.patch('pexpect.spawn', side_effect=_spawn), \
+                mock.patch('sshx.sshwrap.open_pipe', side_effect=_noisy_pipe):
+            ret = sshx.handle_scp(f'{NAME1}:{src}/', f'{NAME2}:{dst}')
+        self.assertEqual(STATUS_SUCCESS, ret)
+        with open(os.path.join(dst, 'src/sub/f1'), 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        # a failed write fails the copy, instead of blocking the reader
+        def _failed_pipe(account, cmd, vias=None):
+            p = _open_pipe(account, cmd, vias)
+            if '-xf' in cmd:
+                p.stdin = mock.Mock(wraps=p.stdin)
+                p.stdin.write.side_effect = OSError('Input/output error')
+            return p
+
+        with mock.patch('pexpect.spawn', side_effect=_spawn), \
+                mock.patch('sshx.sshwrap.open_pipe', side_effect=_failed_pipe), \
+                mock.patch('sshx.logger.error') as m_error:
+            ret = sshx.handle_scp(f'{NAME1}:{src}/', f'{NAME2}:{dst}')
+        self.assertEqual(STATUS_FAIL, ret)
+        m_error.assert_any_call(f'{NAME2}: Input/output error')
+
+    @mock.patch('sshx.sshwrap.config_digest', return_value=_SSH_CONFIG_FILE)
     @mock.patch('pexpect.spawn', autospec=True)
-    def test_scp_via(self, m, m_uuid, m_del):
+    def test_scp_via(self, m, m_digest):
         '''sshx scp -v <NAME4> <DIR1> <NAME1>:<DIR2>'''
         sshx.handle_scp(DIR1, f'{NAME1}:{DIR2}', via=NAME4)
         command = sshwrap._SCP_COMMAND_CONFIG.format(
@@ -548,7 +924,8 @@ class SpawnCommandTest(unittest.TestCase):
         '''sshx scp2 <DIR1> <NAME1>:<DIR2>'''
         sshx.handle_scp(DIR1, f'{NAME1}:{DIR2}', with_forward=True)
         command = sshwrap._SCP_COMMAND_PASSWORD.format(
-            port=PORT1, jump='',
+            hostkeys=_hostkeys(NAME1),
+            port=PORT1, jump='', extras='',
             src=DIR1, dst=f'{USER1}@{HOST1}:{DIR2}',
         )
         _assert_called_with(m, command)
@@ -561,13 +938,15 @@ class SpawnCommandTest(unittest.TestCase):
         sshx.handle_scp(DIR1, f'{NAME1}:{DIR2}', via=NAME4, with_forward=True)
 
         command1 = sshwrap._SSH_COMMAND_PASSWORD.format(
+            hostkeys=_hostkeys(NAME4),
             user=USER4, host=HOST4, port=PORT4, identity=IDENTITY4,
             extras='-NT',
             forwards=f'-L {sshwrap.LOCALHOST}:{LOCALPORT}:{HOST1}:{PORT1}', jump='', cmd='',
         )
 
         command2 = sshwrap._SCP_COMMAND_PASSWORD.format(
-            port=LOCALPORT, jump='',
+            hostkeys=_hostkeys(NAME1),
+            port=LOCALPORT, jump='', extras='',
             src=DIR1, dst=f'{USER1}@{sshwrap.LOCALHOST}:{DIR2}',
         )
 
@@ -575,12 +954,11 @@ class SpawnCommandTest(unittest.TestCase):
 
     # mock interactive to pretend the forwarding was successfully established,
     # otherwise interactive would failed because there's no real ssh connection.
-    @mock.patch('sshx.utils.delete_file')
-    @mock.patch('sshx.sshwrap.uuid.uuid4', return_value=_SSH_CONFIG_FILE)
+    @mock.patch('sshx.sshwrap.config_digest', return_value=_SSH_CONFIG_FILE)
     @mock.patch('sshx.sshwrap.SSHPexpect.interactive', return_value=STATUS_SUCCESS)
     @mock.patch('sshx.sshwrap.find_available_port', return_value=LOCALPORT)
     @mock.patch('pexpect.spawn', autospec=True)
-    def test_scp2_via2(self, m, m_findport, m_interact, m_uuid, m_del):
+    def test_scp2_via2(self, m, m_findport, m_interact, m_digest):
         '''sshx scp2 -v <NAME4>,<NAME5> <DIR1> <NAME1>:<DIR2>'''
         sshx.handle_scp(DIR1, f'{NAME1}:{DIR2}',
                         via=f'{NAME4},{NAME5}', with_forward=True)
@@ -591,18 +969,53 @@ class SpawnCommandTest(unittest.TestCase):
         _assert_file_contains(self, SSH_CONFIG_FILE, f'Host {NAME4}')
 
         command2 = sshwrap._SCP_COMMAND_PASSWORD.format(
-            port=LOCALPORT, jump='',
+            hostkeys=_hostkeys(NAME1),
+            port=LOCALPORT, jump='', extras='',
             src=DIR1, dst=f'{USER1}@{sshwrap.LOCALHOST}:{DIR2}',
         )
 
         _assert_called_with_n(self, m, (command1, command2))
 
+    @mock.patch('sshx.sshwrap.find_available_port', return_value=LOCALPORT)
+    def test_chain_copies(self, m_findport):
+        # chains and forwardings change copies, the indexes of the config stay right
+        config = cfg.config
+
+        def fields():
+            return {a.name: (a.host, a.port, a.via) for a in config.get_accounts()}
+
+        before = fields()
+        account = config.get_account(NAME1, decrypt=True)
+        chain = sshwrap.AccountChain(account, vias=f'{NAME4},{NAME5}')
+        self.assertEqual([NAME4, NAME5, NAME1], [a.name for a in chain.accounts])
+        self.assertEqual(NAME5, chain.accounts[-1].via)
+
+        p = sshwrap.CmdWithForwarding(account, vias=NAME4, cmd='true')
+        self.assertEqual((sshwrap.LOCALHOST, LOCALPORT, ''), (p.account.host, p.account.port, p.account.via))
+        self.assertEqual(before, fields())
+        self.assertEqual([NAME1], [a.name for a in config.get_accounts_by_host(HOST1)])
+
+    @mock.patch('time.sleep')
+    @mock.patch('sshx.sshwrap.SSHPexpect.kill')
+    @mock.patch('sshx.sshwrap.SSHPexpect.start_process', return_value=STATUS_FAIL)
+    @mock.patch('sshx.ports.release')
+    @mock.patch('sshx.sshwrap.find_available_port', return_value=LOCALPORT)
+    def test_forwarding_port(self, m_findport, m_release, m_start, m_kill, m_sleep):
+        # every retry forwards the same port, which is released after the last
+        account = cfg.config.get_account(NAME1, decrypt=True)
+        p = sshwrap.CmdWithForwarding(account, vias=NAME4, cmd='true')
+        self.assertEqual(STATUS_FAIL, p.run(retry=2, retry_interval=0))
+        self.assertEqual(6, m_start.call_count)
+        m_findport.assert_called_once_with()
+        m_release.assert_called_once_with([LOCALPORT])
+
     @mock.patch('sshx.utils.read_passphrase', return_value=PASSPHRASE3)
     @mock.patch('pexpect.spawn', autospec=True)
     def test_socks(self, m, m_read):
         '''sshx socks <NAME1>'''
         sshx.handle_socks(NAME1)
         command = sshwrap._SSH_COMMAND_PASSWORD.format(
+            hostkeys=_hostkeys(NAME1),
             user=USER1, host=HOST1, port=PORT1, identity=NOIDENTITY,
             extras='-D 1080 -NT -o ServerAliveInterval=15 -o ServerAliveCountMax=210240000',
             forwards='', jump='', cmd='',
@@ -614,15 +1027,15 @@ class SpawnCommandTest(unittest.TestCase):
         '''sshx exec --tty <NAME1> -- <COMMAND1>'''
         sshx.handle_exec(NAME1, cmd=COMMAND1.split(), tty=True)
         command = sshwrap._SSH_COMMAND_PASSWORD.format(
+            hostkeys=_hostkeys(NAME1),
             user=USER1, host=HOST1, port=PORT1, identity=NOIDENTITY,
             extras='-t -o ServerAliveInterval=15 -o ServerAliveCountMax=210240000', forwards='', jump='', cmd=COMMAND1,
         )
         _assert_called_with(m, command)
 
-    @mock.patch('sshx.utils.delete_file')
-    @mock.patch('sshx.sshwrap.uuid.uuid4', return_value=_SSH_CONFIG_FILE)
+    @mock.patch('sshx.sshwrap.config_digest', return_value=_SSH_CONFIG_FILE)
     @mock.patch('pexpect.spawn', autospec=True)
-    def test_exec_via(self, m, m_uuid, m_del):
+    def test_exec_via(self, m, m_digest):
         '''sshx exec <NAME1> -v <NAME4>,<NAME5> -- <COMMAND1>'''
         sshx.handle_exec(NAME1, cmd=COMMAND1.split(), via=f'{NAME4},{NAME5}')
         command = sshwrap._SSH_COMMAND_CONFIG.format(
@@ -637,16 +1050,16 @@ class SpawnCommandTest(unittest.TestCase):
         '''sshx copyid <PUBKEY> <NAME1>'''
         sshx.handle_copyid(NAME1, PUBKEY)
         command = sshwrap._SSH_COPYID.format(
+            hostkeys=_hostkeys(NAME1),
             user=USER1, host=HOST1, port=PORT1,
             identity=PUBKEY, extras='')
         _assert_called_with(m, command)
 
-    @mock.patch('sshx.utils.delete_file')
-    @mock.patch('sshx.sshwrap.uuid.uuid4', return_value=_SSH_CONFIG_FILE)
+    @mock.patch('sshx.sshwrap.config_digest', return_value=_SSH_CONFIG_FILE)
     @mock.patch('sshx.sshwrap.SSHPexpect.interactive', return_value=STATUS_SUCCESS)
     @mock.patch('sshx.sshwrap.find_available_port', return_value=LOCALPORT)
     @mock.patch('pexpect.spawn', autospec=True)
-    def test_copyid_via(self, m, m_find, m_interact, m_uuid, m_del):
+    def test_copyid_via(self, m, m_find, m_interact, m_digest):
         '''sshx copyid <PUBKEY> <NAME1> -v <NAME4>,<NAME5>'''
         sshx.handle_copyid(NAME1, PUBKEY, via=f'{NAME4},{NAME5}')
 
@@ -656,10 +1069,156 @@ class SpawnCommandTest(unittest.TestCase):
         _assert_file_contains(self, SSH_CONFIG_FILE, f'Host {NAME4}')
 
         command2 = sshwrap._SSH_COPYID.format(
+            hostkeys=_hostkeys(NAME1),
             user=USER1, host=sshwrap.LOCALHOST, port=LOCALPORT,
             identity=PUBKEY, extras='')
         _assert_called_with_n(self, m, (command1, command2))
 
+    @mock.patch('sshx.sshwrap.SSHPexpect.auth', return_value=True)
+    def test_pexec(self, m_auth):
+        import pexpect
+        spawn = pexpect.spawn
+        commands = []
+
+        def _spawn(status):
+            def _wrapped(command):
+                commands.append(command)
+                dest = command.split()[-2]
+                return spawn('sh', ['-c', f'echo out; echo {dest}; exit {status}'])
+            return _wrapped
+
+        with mock.patch('pexpect.spawn', side_effect=_spawn(0)):
+            ret = sshx.handle_pexec(f'{NAME1},name[45]', jobs=2, cmd=['true'])
+        self.assertEqual(STATUS_SUCCESS, ret)
+        self.assertEqual(3, len(commands))
+        self.assertTrue(all(c.endswith(' true') for c in commands))
+
+        lines = []
+        with mock.patch('pexpect.spawn', side_effect=_spawn(3)):
+            sessions = sshwrap.pexec(
+                [cfg.config.get_account(NAME1, decrypt=True)], 'true',
+                output=lambda a, line: lines.append((a.name, line)))
+        self.assertEqual([(NAME1, 'out'), (NAME1, f'{USER1}@{HOST1}')], lines)
+        self.assertEqual(3, sessions[0].exitstatus)
+        self.assertEqual(STATUS_FAIL, sessions[0].status)
+
+        with mock.patch('pexpect.spawn', side_effect=lambda c: spawn('sleep 5')):
+            sessions = sshwrap.pexec(
+                [cfg.config.get_account(NAME1, decrypt=True)], 'true', timeout=1)
+        self.assertTrue(sessions[0].timed_out)
+        self.assertEqual(STATUS_FAIL, sessions[0].status)
+
+        ret = sshx.handle_pexec('nomatch*', cmd=['true'])
+        self.assertEqual(STATUS_FAIL, ret)
+
+    def test_decrypt_jump_hosts(self):
+        # the whole chain of jump hosts is decrypted, every host once
+        config = cfg.config
+        config.update_account(config.get_account(NAME4), {'via': NAME5})
+        accounts = [cfg.Account('x1', host=HOST1, via=NAME4), cfg.Account('x2', host=HOST2, via=NAME4)]
+        with mock.patch.object(config, 'get_account', wraps=config.get_account) as m:
+            sshx._decrypt_jump_hosts(accounts)
+            self.assertEqual([call(NAME4, decrypt=True), call(NAME5, decrypt=True)], m.call_args_list)
+
+            m.reset_mock()
+            sshx._decrypt_jump_hosts(accounts, via=f'{NAME2},{NAME3}')
+            self.assertEqual([call(NAME2, decrypt=True), call(NAME3, decrypt=True)], m.call_args_list)
+
+    def test_trace(self):
+        import json
+        import pexpect
+        from .. import trace
+
+        spawn = pexpect.spawn
+        # asks for the passwords of NAME4 and NAME1
+        script = "stty -echo; printf 'Password:'; read p; printf 'Password:'; read p; sleep 0.1; echo out"
+
+        filename = os.path.join(TEST_DIR, 'trace.json')
+        trace.set_trace(filename)
+        try:
+            with mock.patch('pexpect.spawn', side_effect=lambda c: spawn('sh', ['-c', script])):
+                sessions = sshwrap.pexec(
+                    [cfg.config.get_account(NAME1, decrypt=True)], 'true', vias=NAME4,
+                    output=lambda a, line: None)
+        finally:
+            trace.set_trace(None)
+        self.assertEqual(STATUS_SUCCESS, sessions[0].status)
+
+        with open(filename) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(['compile', 'spawn', 'auth.hop', 'auth.hop', 'auth', 'first_byte', 'session'],
+                         [s['span'] for s in spans])
+        self.assertEqual([NAME4, NAME1], [s['hop_account'] for s in spans if s['span'] == 'auth.hop'])
+        self.assertTrue(all(s['session'] == spans[0]['session'] for s in spans))
+        self.assertTrue(all(s['account'] == NAME1 and s['ok'] for s in spans))
+        self.assertGreaterEqual(spans[5]['ms'], 100)
+
+    @mock.patch('sshx.sshwrap.mux_stop')
+    @mock.patch('sshx.sshwrap.ExecPexpect')
+    def test_own_master(self, m_exec, m_stop):
+        m_exec.return_value.run.return_value = STATUS_SUCCESS
+        m_exec.return_value.exitstatus = 0
+        account = cfg.config.get_account(NAME1)
+        self.addCleanup(sshwrap._own_masters.clear)
+
+        # started for the command, stopped when it exits
+        self.assertEqual(STATUS_SUCCESS, sshwrap._start_master(account, 'true').status)
+        self.assertEqual({NAME1}, sshwrap._own_masters)
+        sshwrap.stop_own_masters()
+        m_stop.assert_called_once_with(NAME1)
+        self.assertEqual(set(), sshwrap._own_masters)
+
+        # shared by --mux, or running before
+        sshwrap.set_multiplex(True)
+        try:
+            sshwrap.claim_master(NAME1)
+        finally:
+            sshwrap.set_multiplex(False)
+        with mock.patch('sshx.sshwrap.mux_check', return_value=True):
+            sshwrap.claim_master(NAME1)
+        self.assertEqual(set(), sshwrap._own_masters)
+
+    @mock.patch('sshx.sshwrap.SSHPexpect.interactive', return_value=STATUS_SUCCESS)
+    @mock.patch('pexpect.spawn', autospec=True)
+    def test_mux(self, m, m_interact):
+        sshwrap.set_multiplex(True, persist=60)
+        try:
+            mux = f' -o ControlMaster=auto -o ControlPath={sshwrap.control_path(NAME1)} -o ControlPersist=60'
+
+            '''sshx --mux exec <NAME1> -- <COMMAND1>'''
+            with mock.patch('sshx.sshwrap.SSHPexpect.auth', return_value=True) as m_auth:
+                with mock.patch('sshx.sshwrap.mux_check', return_value=False):
+                    sshx.handle_exec(NAME1, cmd=COMMAND1.split())
+                command = sshwrap._SSH_COMMAND_PASSWORD.format(
+                    hostkeys=_hostkeys(NAME1),
+                    user=USER1, host=HOST1, port=PORT1, identity=NOIDENTITY,
+                    extras='-o ServerAliveInterval=15 -o ServerAliveCountMax=210240000' + mux,
+                    forwards='', jump='', cmd=COMMAND1,
+                )
+                _assert_called_with(m, command)
+                m_auth.assert_called_once()
+
+            '''sshx --mux scp <DIR1> <NAME1>:<DIR2>'''
+            sshx.handle_scp(DIR1, f'{NAME1}:{DIR2}')
+            command = sshwrap._SCP_COMMAND_PASSWORD.format(
+                hostkeys=_hostkeys(NAME1),
+                port=PORT1, jump='', extras=mux,
+                src=DIR1, dst=f'{USER1}@{HOST1}:{DIR2}',
+            )
+            _assert_called_with(m, command)
+
+            # master alive, no password prompt expected
+            with mock.patch('sshx.sshwrap.mux_check', return_value=True):
+                p = sshwrap.SSHPexpect(cfg.config.get_account(NAME1), cmd=COMMAND1)
+                self.assertEqual(STATUS_SUCCESS, p.run())
+                self.assertTrue(p.reuse_master)
+
+            # forwardings are never multiplexed
+            sshx.handle_forward(NAME1, maps=(FORWARD1,))
+            self.assertNotIn('ControlMaster', m.call_args[0][0])
+        finally:
+            sshwrap.set_multiplex(False)
+
 
 global_test_init()
 
@@ -0,0 +1,122 @@
+from . import global_test_init
+import os
+import mock
+import shutil
+import unittest
+
+from .. import cfg
+from .. import hostkeys
+
+
+TEST_DIR = '/tmp/sshx-test-hostkeys'
+
+KEY1 = ('ssh-ed25519', 'AAAAC3NzaC1lZDI1NTE5AAAAIKey1')
+KEY2 = ('ssh-rsa', 'AAAAB3NzaC1yc2EAAAADAQABAAABAQKey2')
+KEY3 = ('ssh-ed25519', 'AAAAC3NzaC1lZDI1NTE5AAAAIKey3')
+
+
+class HostKeysTest(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        os.makedirs(TEST_DIR)
+        cfg.set_config_dir(TEST_DIR)
+        self.accounts = [cfg.Account('a1', host='h1', port='2222', password='p1'),
+                         cfg.Account('a2', host='h2', password='p2'),
+                         cfg.Account('a3', host='h3', password='p3', via='a1')]
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_load(self):
+        with open(cfg.KNOWN_HOSTS_FILE, 'w') as f:
+            f.write('# comment\n')
+            f.write(f'a1,a2 {KEY1[0]} {KEY1[1]}\n')
+            f.write(f'a1 {KEY2[0]} {KEY2[1]} comment\n')
+        self.assertEqual({'a1': [KEY1, KEY2], 'a2': [KEY1]}, hostkeys.load())
+
+    def test_keyscan(self):
+        output = f'# h1:2222 SSH-2.0-OpenSSH_9.2\n[h1]:2222 {KEY1[0]} {KEY1[1]}\n'.encode()
+        with mock.patch('subprocess.run') as m:
+            m.return_value = mock.Mock(stdout=output, stderr=b'')
+            self.assertEqual([KEY1], hostkeys.keyscan(self.accounts[0], timeout=1))
+            self.assertEqual(['ssh-keyscan', '-T', '1', '-p', '2222', 'h1'], m.call_args[0][0])
+
+            m.return_value = mock.Mock(stdout=b'', stderr=b'h1: Connection refused\n')
+            with self.assertRaises(hostkeys.HostKeyError):
+                hostkeys.keyscan(self.accounts[0])
+
+    def test_scan(self):
+        offered = {'h1': [KEY1], 'h2': [KEY2]}
+
+        def keyscan(account, timeout):
+            if account.host not in offered:
+                raise hostkeys.HostKeyError('Connection refused')
+            return offered[account.host]
+
+        with mock.patch('sshx.hostkeys.keyscan', side_effect=keyscan) as m:
+            results = hostkeys.scan(self.accounts)
+            self.assertEqual(2, m.call_count)
+        self.assertEqual([('a1', 'added', 'ssh-ed25519'), ('a2', 'added', 'ssh-rsa'),
+                          ('a3', 'skipped', 'via a1')], results)
+        self.assertEqual({'a1': [KEY1], 'a2': [KEY2]}, hostkeys.load())
+
+        # new key types are added, a different key is only reported
+        offered = {'h1': [KEY1, KEY2], 'h2': [KEY3]}
+        with mock.patch('sshx.hostkeys.keyscan', side_effect=keyscan):
+            results = hostkeys.scan(self.accounts[:2])
+        self.assertEqual(['added', 'added'],
+                         [r[1] for r in results])
+        self.assertEqual({'a1': [KEY1, KEY2], 'a2': [KEY2, KEY3]}, hostkeys.load())
+
+        offered = {'h1': [KEY1, KEY2], 'h2': [(KEY2[0], 'AAAAChanged')]}
+        with mock.patch('sshx.hostkeys.keyscan', side_effect=keyscan):
+            results = hostkeys.scan(self.accounts[:2])
+        self.assertEqual(['unchanged', 'changed'], [r[1] for r in results])
+        self.assertEqual([KEY2, KEY3], hostkeys.load()['a2'])
+
+        self.assertTrue(hostkeys.remove('a2'))
+        self.assertFalse(hostkeys.remove('a2'))
+        self.assertEqual(['a1'], list(hostkeys.load()))
+
+    def test_concurrent_ssh(self):
+        def keyscan(account, timeout):
+            # ssh accepts a key meanwhile, without the lock of sshx
+            with open(cfg.KNOWN_HOSTS_FILE, 'a') as f:
+                f.write(f'{account.name}-ssh {KEY3[0]} {KEY3[1]}\n')
+            return [KEY1]
+
+        with open(cfg.KNOWN_HOSTS_FILE, 'w') as f:
+            f.write(f'# comment\nother,a1 {KEY2[0]} {KEY2[1]}\n')
+        with mock.patch('sshx.hostkeys.keyscan', side_effect=keyscan):
+            hostkeys.scan(self.accounts[:2])
+        self.assertEqual({'other': [KEY2], 'a1-ssh': [KEY3], 'a2-ssh': [KEY3],
+                          'a1': [KEY2, KEY1], 'a2': [KEY1]}, hostkeys.load())
+
+        self.assertTrue(hostkeys.remove('a1'))
+        with open(cfg.KNOWN_HOSTS_FILE) as f:
+            self.assertTrue(f.read().startswith('# comment\n'))
+        self.assertEqual(['a1-ssh', 'a2', 'a2-ssh', 'other'], sorted(hostkeys.load()))
+
+    def test_disabled(self):
+        with mock.patch('sshx.hostkeys.Enabled', False):
+            self.assertNotIn('HostKeyAlias', hostkeys.ssh_options('a1'))
+            self.assertIn('UserKnownHostsFile /dev/null', hostkeys.ssh_config())
+        with mock.patch('sshx.hostkeys._checking', 'accept-new'):
+            self.assertIn('StrictHostKeyChecking accept-new', hostkeys.ssh_config())
+
+    def test_strict_checking(self):
+        for output, checking in [(b'OpenSSH_9.2p1 Debian-2, OpenSSL 3.0.17', 'accept-new'),
+                                 (b'OpenSSH_7.6p1 Ubuntu-4', 'accept-new'),
+                                 (b'OpenSSH_7.4p1, OpenSSL 1.0.2k-fips', 'yes'),
+                                 (b'unknown', 'yes')]:
+            with mock.patch('sshx.hostkeys._checking', None), mock.patch('subprocess.run') as m:
+                m.return_value = mock.Mock(stdout=output)
+                self.assertIn(f'StrictHostKeyChecking={checking} ', hostkeys.ssh_options('a1'))
+                hostkeys.ssh_options('a2')
+                m.assert_called_once()
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
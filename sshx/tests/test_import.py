@@ -0,0 +1,115 @@
+from . import global_test_init
+import os
+import unittest
+
+from .. import sshx_import
+from ..account import Account
+
+
+SSH_CONFIG = '''
+# comment
+Host bastion
+    HostName 10.0.0.1
+    User admin
+    Port 2222
+
+Host web1 web2
+    ProxyJump admin@bastion:2222
+    IdentityFile ~/.ssh/id_web
+
+Host db1
+    HostName=10.0.1.1
+    ProxyCommand ssh -F /tmp/config -W %h:%p bastion
+
+Host chained
+    ProxyJump bastion,web1
+
+Host inner
+    HostName 10.0.2.1
+    ProxyJump ops@bastion,db1:2200,other
+
+Host web*
+    User www
+    Port 22
+
+Match host db1
+    User nobody
+
+Host *
+    User root
+'''
+
+
+class ParseTest(unittest.TestCase):
+    def test_ssh_config(self):
+        accounts = {a.name: a for a in sshx_import.parse_ssh_config(SSH_CONFIG)}
+        self.assertEqual(['bastion', 'web1', 'web2', 'db1', 'chained', 'inner',
+                          'ops@bastion', 'db1:2200', 'other'], list(accounts))
+
+        self.assertEqual(Account('bastion', user='admin', host='10.0.0.1', port='2222'),
+                         accounts['bastion'])
+        self.assertEqual(Account('web1', user='www', host='web1', port='22', via='bastion',
+                                 identity=os.path.expanduser('~/.ssh/id_web')),
+                         accounts['web1'])
+        self.assertEqual('web2', accounts['web2'].host)
+        self.assertEqual(Account('db1', host='10.0.1.1', via='bastion'), accounts['db1'])
+        self.assertEqual('web1', accounts['chained'].via)
+
+        # hops of other users or ports are accounts of their own, chained by via
+        self.assertEqual('other', accounts['inner'].via)
+        self.assertEqual(Account('other', host='other', via='db1:2200'), accounts['other'])
+        self.assertEqual(Account('db1:2200', host='10.0.1.1', port='2200', via='ops@bastion'),
+                         accounts['db1:2200'])
+        self.assertEqual(Account('ops@bastion', user='ops', host='10.0.0.1', port='2222'),
+                         accounts['ops@bastion'])
+
+    def test_proxy_jump(self):
+        s = 'Host a\n  HostName 10.0.0.1\nHost b\n  ProxyJump a\nHost c\n  ProxyJump b,a\n'
+        accounts = {a.name: a for a in sshx_import.parse_ssh_config(s)}
+        # a is reached by b here, but directly by its Host
+        self.assertEqual(Account('a-via-b', host='10.0.0.1', via='b'), accounts['a-via-b'])
+        self.assertEqual('a-via-b', accounts['c'].via)
+
+        with self.assertRaises(ValueError):
+            sshx_import.parse_ssh_config('Host a\n  ProxyJump b\nHost b\n  ProxyJump a\n')
+
+    def test_ssh_config_roundtrip(self):
+        accounts = [
+            Account('a1', user='u1', host='h1', port='2222', identity='/tmp/id'),
+            Account('a2', host='h2', password='p2', via='a1'),
+            Account('a3', host='h3', via='a2'),
+        ]
+        s = sshx_import.dump_ssh_config(accounts, config='/tmp/config')
+        self.assertIn('ProxyCommand ssh -F /tmp/config -W %h:%p a1\n', s)
+        self.assertNotIn('p2', s)
+
+        parsed = sshx_import.parse_ssh_config(s)
+        for a in accounts:
+            a.password = ''
+        self.assertEqual(accounts, parsed)
+
+    def test_csv(self):
+        accounts = [
+            Account('a1', user='u1', host='h1', password='p1'),
+            Account('a2', host='h2', via='a1'),
+        ]
+        s = sshx_import.dump_csv(accounts)
+        self.assertEqual('name,user,host,port,identity,via', s.splitlines()[0])
+        self.assertNotIn('p1', s)
+
+        s = sshx_import.dump_csv(accounts, secrets=True)
+        self.assertEqual(accounts, sshx_import.parse_csv(s))
+
+        self.assertEqual([Account('a1', host='h1')], sshx_import.parse_csv('name,host\na1,h1\n'))
+        self.assertRaises(ValueError, sshx_import.parse_csv, 'name,hostname\na1,h1\n')
+
+    def test_guess_format(self):
+        self.assertEqual('csv', sshx_import.guess_format('hosts.CSV'))
+        self.assertEqual('yaml', sshx_import.guess_format('hosts.yml'))
+        self.assertEqual('ssh', sshx_import.guess_format('/home/user/.ssh/config'))
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
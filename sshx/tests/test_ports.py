@@ -0,0 +1,83 @@
+from . import global_test_init
+import os
+import mock
+import socket
+import shutil
+import unittest
+
+from .. import cfg
+from .. import ports
+
+
+TEST_DIR = '/tmp/sshx-test-ports'
+
+
+def _free_range(n):
+    '''Return a range of n ports, which are free at the moment.'''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        low = sock.getsockname()[1]
+    low = min(low, 65535 - n)
+    return low, low + n - 1
+
+
+class PortsTest(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        os.makedirs(TEST_DIR)
+        cfg.set_config_dir(TEST_DIR)
+
+    def tearDown(self):
+        ports.set_port_range(None)
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_allocate(self):
+        allocated = ports.allocate(5)
+        self.assertEqual(5, len(set(allocated)))
+        for port in allocated:
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', port))
+
+        # reserved ports are never handed out again until released
+        self.assertEqual(set(allocated), set(ports._load()))
+        with mock.patch('sshx.ports._bind', side_effect=[allocated[0], None, allocated[1], 50001]):
+            self.assertEqual([50001], ports.allocate())
+        ports.release(allocated)
+        self.assertEqual({50001}, set(ports._load()))
+        self.assertEqual([], ports.allocate(0))
+
+    def test_range(self):
+        low, high = _free_range(4)
+        ports.set_port_range((low, high))
+
+        # a listening port of the range is skipped
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', low + 1))
+            sock.listen(1)
+            self.assertEqual([low, low + 2], ports.allocate(2))
+            self.assertEqual([low + 3], ports.allocate())
+            with self.assertRaises(ports.PortError):
+                ports.allocate()
+
+        ports.release([low])
+        self.assertEqual([low], ports.allocate())
+
+    def test_dead_process(self):
+        with mock.patch('os.getpid', return_value=2 ** 22 + 1):
+            port = ports.allocate()[0]
+        self.assertEqual({}, ports._load())
+
+        ports.set_port_range((port, port))
+        self.assertEqual([port], ports.allocate())
+
+    def test_parse_port_range(self):
+        self.assertEqual((50000, 50100), ports.parse_port_range('50000-50100'))
+        for s in ('50000', '0-10', '10-5', '60000-70000', 'a-b'):
+            with self.assertRaises(ports.PortError):
+                ports.parse_port_range(s)
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
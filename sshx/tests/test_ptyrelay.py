@@ -0,0 +1,68 @@
+from . import global_test_init
+import os
+import mock
+import tempfile
+import unittest
+
+import pexpect
+
+from .. import ptyrelay
+
+
+class RelayTest(unittest.TestCase):
+    def setUp(self):
+        self.stdin_r, self.stdin_w = os.pipe()
+        self.stdout = tempfile.TemporaryFile()
+
+    def tearDown(self):
+        for fd in (self.stdin_r, self.stdin_w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.stdout.close()
+
+    def _relay(self, cmd, **kwargs):
+        p = pexpect.spawn('sh', ['-c', cmd])
+        ptyrelay.interact(p, stdin=self.stdin_r, stdout=self.stdout.fileno(), **kwargs)
+        p.close()
+        self.stdout.seek(0)
+        return self.stdout.read()
+
+    def test_skip_blank(self):
+        on_first_byte = mock.Mock()
+        output = self._relay("printf '\\n  \\n\\thello\\n'", skip_blank=True,
+                             on_first_byte=on_first_byte)
+        self.assertEqual(b'hello\r\n', output)
+        on_first_byte.assert_called_once_with()
+
+        self.stdout = tempfile.TemporaryFile()
+        self.assertEqual(b'\r\n hi\r\n', self._relay("printf '\\n hi\\n'"))
+
+    def test_pending(self):
+        # the output read by expect beyond its match is relayed first
+        p = pexpect.spawn('sh', ['-c', "printf 'password: \\n\\nwelcome\\n'; sleep 0.2"])
+        p.expect('password: ')
+        p.expect(r'\n')
+        ptyrelay.interact(p, skip_blank=True, stdin=self.stdin_r, stdout=self.stdout.fileno())
+        p.close()
+        self.stdout.seek(0)
+        self.assertEqual(b'welcome\r\n', self.stdout.read())
+
+    def test_large_output(self):
+        size = 4 * 1024 * 1024
+        output = self._relay(f'head -c {size} /dev/zero | tr "\\0" x')
+        self.assertEqual(size, len(output))
+        self.assertEqual(b'x' * size, output)
+
+    def test_input(self):
+        os.write(self.stdin_w, b'abc\n')
+        os.close(self.stdin_w)
+        output = self._relay('read line; echo "got:$line"')
+        self.assertIn(b'got:abc', output)
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
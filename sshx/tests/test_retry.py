@@ -0,0 +1,180 @@
+from . import global_test_init
+import time
+import mock
+import unittest
+
+from .. import retry
+from .. import sshwrap
+from .. import const as c
+from ..account import Account
+from ..const import STATUS_SUCCESS, STATUS_FAIL
+
+
+class PolicyTest(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(retry.TIMEOUT, retry.classify(c.MSG_CONNECTION_TIMED_OUT))
+        self.assertEqual(retry.CONNECTION_ERROR, retry.classify(c.MSG_CONNECTION_ERROR))
+        self.assertEqual(retry.AUTH_DENIED, retry.classify(c.MSG_AUTH_FAILED))
+        self.assertEqual(retry.HOST_KEY_CHANGED, retry.classify(c.MSG_HOST_KEY_VERIFICATION_FAILED))
+        self.assertEqual(retry.CONNECTION_ERROR, retry.classify('unknown'))
+
+    def test_should_retry(self):
+        policy = retry.RetryPolicy(2)
+        self.assertTrue(policy.should_retry(0, retry.TIMEOUT))
+        self.assertTrue(policy.should_retry(1, retry.CONNECTION_ERROR))
+        self.assertFalse(policy.should_retry(2, retry.TIMEOUT))
+        self.assertFalse(policy.should_retry(0, retry.AUTH_DENIED))
+
+        policy = retry.RetryPolicy('always')
+        self.assertTrue(policy.should_retry(1000, retry.TIMEOUT))
+        self.assertFalse(policy.should_retry(0, retry.AUTH_DENIED))
+        self.assertFalse(retry.RetryPolicy(0).should_retry(0, retry.TIMEOUT))
+
+    def test_delay(self):
+        policy = retry.RetryPolicy('always', interval=5, max_interval=60)
+        for attempt, delay in ((0, 5), (1, 10), (2, 20), (3, 40), (4, 60), (10, 60)):
+            for _ in range(20):
+                d = policy.delay(attempt)
+                self.assertTrue(delay / 2 <= d <= delay, (attempt, d))
+        self.assertEqual(0, retry.RetryPolicy('always', interval=0).delay(3))
+
+    def test_breaker(self):
+        breaker = retry.CircuitBreaker(threshold=3, cooldown=60)
+        for _ in range(2):
+            breaker.failure()
+        self.assertEqual(0, breaker.remaining())
+        breaker.failure()
+        self.assertTrue(59 < breaker.remaining() <= 60)
+        breaker.success()
+        self.assertEqual(0, breaker.remaining())
+
+        self.assertIs(retry.breaker('host1'), retry.breaker('host1'))
+        self.assertIsNot(retry.breaker('host1'), retry.breaker('host2'))
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        retry._breakers.clear()
+        self.account = Account('name1', host='host1', password='password1')
+        self.p = sshwrap.SSHPexpect(self.account)
+        self.p.compile_command = mock.Mock(return_value='ssh')
+
+    def tearDown(self):
+        retry._breakers.clear()
+
+    def _fail(self, error, hop_name='name1'):
+        def _start_process():
+            self.p.failure = (retry.classify(error), hop_name)
+            return STATUS_FAIL
+        return _start_process
+
+    @mock.patch('time.sleep')
+    def test_auth_denied(self, m_sleep):
+        self.p.start_process = mock.Mock(side_effect=self._fail(c.MSG_AUTH_FAILED))
+        self.assertEqual(STATUS_FAIL, self.p.run(retry='always'))
+        self.assertEqual(1, self.p.start_process.call_count)
+        m_sleep.assert_not_called()
+
+    @mock.patch('time.sleep')
+    def test_backoff(self, m_sleep):
+        self.p.start_process = mock.Mock(side_effect=self._fail(c.MSG_CONNECTION_TIMED_OUT))
+        self.assertEqual(STATUS_FAIL, self.p.run(retry=3, retry_interval=4))
+        self.assertEqual(4, self.p.start_process.call_count)
+        delays = [call[0][0] for call in m_sleep.call_args_list]
+        for delay, expected in zip(delays, (4, 8, 16)):
+            self.assertTrue(expected / 2 <= delay <= expected, delays)
+
+        # succeeds after retries
+        outcomes = [self._fail(c.MSG_CONNECTION_ERROR), lambda: STATUS_SUCCESS]
+        self.p.start_process = mock.Mock(side_effect=lambda: outcomes.pop(0)())
+        self.assertEqual(STATUS_SUCCESS, self.p.run(retry='always', retry_interval=1))
+        self.assertEqual(0, retry.breaker('name1').failures)
+
+    @mock.patch('time.sleep')
+    def test_breaker(self, m_sleep):
+        # the jump host keeps failing, so its breaker opens
+        self.p.start_process = mock.Mock(side_effect=self._fail(c.MSG_CONNECTION_ERROR, 'bastion'))
+        self.assertEqual(STATUS_FAIL, self.p.run(retry=retry.BREAKER_THRESHOLD, retry_interval=1))
+        last = m_sleep.call_args_list[-1][0][0]
+        self.assertTrue(retry.BREAKER_COOLDOWN - 1 < last <= retry.BREAKER_COOLDOWN)
+        self.assertTrue(retry.breaker('bastion').remaining() > 0)
+        self.assertEqual(0, retry.breaker('name1').remaining())
+
+
+class AuthTest(unittest.TestCase):
+    '''auth() against a child asking passwords like ssh.'''
+
+    def setUp(self):
+        retry._breakers.clear()
+        self.accounts = [Account('name1', host='host1', password='password1'),
+                         Account('name2', host='host2', password='password2')]
+        self.p = sshwrap.SSHPexpect(self.accounts[1], tty=False)
+        self.p.compile_command = mock.Mock(return_value='ssh')
+        self.p.auth_accounts = self.accounts
+        self.p.passwords = ['password1', 'password2']
+
+    def tearDown(self):
+        retry._breakers.clear()
+
+    def _spawn(self, script):
+        import pexpect
+        self.p.p = pexpect.spawn('sh', ['-c', 'stty -echo; ' + script])
+        self.addCleanup(self.p.p.close, force=True)
+
+    def test_reprompt(self):
+        self._spawn("printf 'Password:'; read p; printf 'Password:'; read p; printf 'Password:'; read p")
+        self.assertFalse(self.p.auth())
+        self.assertEqual((retry.AUTH_DENIED, 'name2'), self.p.failure)
+
+    def test_denied(self):
+        self._spawn("printf 'Password:'; read p; echo 'Permission denied, please try again.'; "
+                    "printf 'Password:'; read p")
+        self.assertFalse(self.p.auth())
+        self.assertEqual((retry.AUTH_DENIED, 'name1'), self.p.failure)
+
+    @mock.patch('sshx.sshwrap.AUTH_RESULT_TIMEOUT', 0.2)
+    def test_accepted(self):
+        import pexpect
+
+        self._spawn("printf 'Password:'; read p; printf 'Password:'; read p; echo; echo out")
+        self.assertTrue(self.p.auth())
+        self.p.p.expect(pexpect.EOF)
+        self.assertEqual(b'\r\nout\r\n', self.p.p.before)
+
+        # prints nothing, like a tunnel
+        self._spawn("printf 'Password:'; read p; printf 'Password:'; read p; sleep 1")
+        self.assertTrue(self.p.auth())
+
+    def test_budget(self):
+        import pexpect
+
+        # auth of an execution waits no longer than the rest of its timeout
+        p = sshwrap.ExecPexpect(self.accounts[0], 'true', timeout=1)
+        p.auth_accounts = self.accounts[:1]
+        p.passwords = ['password1']
+        for script in ('sleep 5', "stty -echo; printf 'Password:'; read p; sleep 5"):
+            p._start = time.time()
+            p.p = pexpect.spawn('sh', ['-c', script])
+            self.addCleanup(p.p.close, force=True)
+            p.auth()
+            self.assertLess(time.time() - p._start, 2)
+
+    def test_tunnel(self):
+        import pexpect
+
+        spawn = pexpect.spawn
+        script = "stty -echo; printf 'Password:'; read p; printf 'Password:'; read p; printf 'Password:'; read p"
+        p = sshwrap.SSHPexpect(self.accounts[0], tty=False, background=True, execute=False)
+        p.compile_command = mock.Mock(return_value='ssh')
+        p.passwords = ['password1']
+        with mock.patch('pexpect.spawn', side_effect=lambda c: spawn('sh', ['-c', script])), \
+                mock.patch.object(p, 'start_process', wraps=p.start_process) as m:
+            self.assertEqual(STATUS_FAIL, p.run(retry='always'))
+        self.assertEqual(1, m.call_count)
+        self.assertEqual((retry.AUTH_DENIED, 'name1'), p.failure)
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+from . import global_test_init
+import os
+import shutil
+import unittest
+
+from .. import sshwrap
+from ..sshx_scp import plan_upload, plan_download, written_size, TransferUnit
+
+
+TEST_DIR = '/tmp/sshx-test-scp'
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        for d in ('tree/a/b', 'tree/empty'):
+            os.makedirs(os.path.join(TEST_DIR, d))
+        for f, size in (('tree/1', 10), ('tree/a/2', 20), ('tree/a/b/3', 30),
+                        ('tree/a/b/4', 40), ('file 5', 50)):
+            with open(os.path.join(TEST_DIR, f), 'wb') as fp:
+                fp.write(b'x' * size)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_plan_upload(self):
+        tree = os.path.join(TEST_DIR, 'tree')
+        file5 = os.path.join(TEST_DIR, 'file 5')
+
+        dirs, units, total = plan_upload([tree, file5], 'host1', '/dst', jobs=4)
+        self.assertEqual(150, total)
+        self.assertEqual(['/dst', '/dst/tree', '/dst/tree/a', '/dst/tree/a/b', '/dst/tree/empty'],
+                         sorted(dirs))
+        self.assertEqual([50, 40, 30, 20, 10], [u.size for u in units])
+        self.assertEqual('host1:/dst/', units[0].dst)
+        self.assertEqual('host1:/dst/tree/a/b/', units[1].dst)
+        self.assertEqual(f"'{file5}'", units[0].targets().src.raw)
+
+        # files of a directory go together when there are few jobs
+        dirs, units, total = plan_upload([tree], 'host1', '/dst', jobs=1)
+        self.assertEqual([[os.path.join(tree, 'a/b/3'), os.path.join(tree, 'a/b/4')]],
+                         [u.sources for u in units if u.dst == 'host1:/dst/tree/a/b/'])
+
+        self.assertRaises(FileNotFoundError, plan_upload, [tree + 'x'], 'host1', '/dst')
+
+    def test_plan_download(self):
+        units = plan_download(['host1:/a b', 'host1:/c'], '/tmp')
+        self.assertEqual(2, len(units))
+        self.assertEqual('host1:/a b', units[0].targets().src.raw)
+        self.assertEqual('/tmp', units[0].targets().dst.raw)
+
+    def test_written_size(self):
+        tree = os.path.join(TEST_DIR, 'tree')
+        # there before the download
+        os.utime(os.path.join(tree, 'a/2'), (0, 0))
+        os.utime(os.path.join(TEST_DIR, 'file 5'), (0, 0))
+        self.assertEqual(80, written_size(TransferUnit(['host1:/src/tree/'], TEST_DIR), 1))
+        self.assertEqual(0, written_size(TransferUnit(['host1:/file 5'], TEST_DIR), 1))
+        self.assertEqual(0, written_size(TransferUnit(['host1:/nonexist'], TEST_DIR), 1))
+
+    def test_mkdir_commands(self):
+        self.assertEqual([], sshwrap.mkdir_commands([]))
+        self.assertEqual(["mkdir -p /a '/b c'"], sshwrap.mkdir_commands(['/a', '/b c']))
+
+        dirs = [f'/dst/{i:04d}/' + 'd' * 100 for i in range(5000)]
+        commands = sshwrap.mkdir_commands(dirs)
+        self.assertTrue(all(len(c.encode('utf-8')) < 128 * 1024 for c in commands))
+        self.assertEqual(dirs, [d for c in commands for d in c.split()[2:]])
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
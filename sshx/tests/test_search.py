@@ -0,0 +1,105 @@
+from . import global_test_init
+import io
+import json
+import mock
+import shutil
+import unittest
+import contextlib
+
+from .. import cfg
+from .. import search
+from .. import sshx
+from ..const import STATUS_SUCCESS, STATUS_FAIL
+
+
+ACCOUNTS = [
+    ('web-1', '10.0.0.1', 'root', 'jump'),
+    ('Web-2', '10.0.0.2', 'deploy', 'jump'),
+    ('db-1', '10.0.1.1', 'postgres', ''),
+    ('jump', 'bastion.example.com', 'root', ''),
+    ('wordpress', '10.0.2.1', 'www', 'jump'),
+]
+
+
+class SearchTest(unittest.TestCase):
+    TEST_DIR = '/tmp/sshx-test-search'
+
+    def setUp(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+        cfg.set_config_dir(self.TEST_DIR)
+        cfg.init_config()
+        config = cfg.read_config()
+        for name, host, user, via in ACCOUNTS:
+            config.add_account(cfg.Account(name, host=host, user=user, via=via))
+        cfg.write_config(config)
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def _names(self, query=(), mode=search.SUBSTRING, **kwargs):
+        return [row[0] for row in search.find(cfg.read_config(), query, mode=mode, **kwargs)]
+
+    def test_substring(self):
+        self.assertEqual(['db-1', 'jump', 'web-1', 'Web-2', 'wordpress'], self._names())
+        self.assertEqual(['web-1', 'Web-2'], self._names(['WEB']))
+        self.assertEqual(['db-1', 'web-1'], self._names(['-1']))
+        self.assertEqual(['jump', 'web-1'], self._names(['root']))
+        self.assertEqual(['web-1', 'Web-2', 'wordpress'], self._names(['via:jump']))
+        self.assertEqual(['web-1'], self._names(['via:jump', 'user:root']))
+        self.assertEqual([], self._names(['name:10.0']))
+        self.assertEqual(['wordpress', 'Web-2', 'web-1'], self._names(['via:jump'], reverse=True))
+        self.assertEqual(['10.0.0.1', '10.0.0.2', '10.0.1.1', '10.0.2.1'],
+                         [row[1] for row in search.find(cfg.read_config(), ['10.0'], key='host')])
+
+    def test_glob(self):
+        self.assertEqual(['web-1', 'Web-2'], self._names(['web-*'], search.GLOB))
+        self.assertEqual(['db-1', 'jump'], self._names(['via:'], search.GLOB))
+        self.assertEqual(['db-1'], self._names(['host:10.0.1.*'], search.GLOB))
+
+    def test_regex(self):
+        self.assertEqual(['web-1', 'Web-2'], self._names([r'^W\S+-\d$'], search.REGEX))
+        self.assertEqual(['jump'], self._names([r'host:\.com$'], search.REGEX))
+        self.assertRaises(search.QueryError, self._names, ['(web'], search.REGEX)
+
+    def test_fuzzy(self):
+        self.assertEqual(['wordpress'], self._names(['wp'], search.FUZZY))
+        self.assertEqual(['web-1', 'Web-2'], self._names(['wb'], search.FUZZY))
+        # closer matches first: root, then postgres
+        self.assertEqual(['jump', 'web-1', 'db-1'], self._names(['ot'], search.FUZZY))
+        self.assertEqual(['web-1'], self._names(['wb', 'user:rt'], search.FUZZY))
+        self.assertEqual([], self._names(['pw'], search.FUZZY))
+
+    def test_index(self):
+        config = cfg.read_config()
+        search.find(config)
+        with mock.patch.object(config, 'get_accounts') as m:
+            self.assertEqual(5, len(search.find(config)))
+            m.assert_not_called()
+
+        config.add_account(cfg.Account('web-3', host='10.0.0.3'))
+        cfg.write_config(config)
+        self.assertEqual(['web-1', 'Web-2', 'web-3'], self._names(['web']))
+
+    def test_handle_list(self):
+        def run(**kwargs):
+            out = io.StringIO()
+            with mock.patch('sshx.cfg.config', cfg.read_config()), contextlib.redirect_stdout(out):
+                self.assertEqual(STATUS_SUCCESS, sshx.handle_list(**kwargs))
+            return out.getvalue()
+
+        lines = run(query=['via:jump']).splitlines()
+        self.assertEqual(5, len(lines))
+        self.assertTrue(lines[2].startswith('web-1 '))
+
+        self.assertEqual([{'name': 'Web-2', 'host': '10.0.0.2', 'user': 'deploy', 'via': 'jump'}],
+                         json.loads(run(query=['web'], json_output=True, limit=1, page=2)))
+        self.assertEqual([], json.loads(run(json_output=True, limit=10, page=2)))
+
+        with mock.patch('sshx.cfg.config', cfg.read_config()):
+            self.assertEqual(STATUS_FAIL, sshx.handle_list(query=['['], mode=search.REGEX))
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
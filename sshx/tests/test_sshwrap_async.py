@@ -0,0 +1,87 @@
+from . import global_test_init
+import mock
+import asyncio
+import unittest
+
+from ..account import Account
+from ..sshwrap_async import AsyncSSHSession
+from ..const import STATUS_SUCCESS, STATUS_FAIL
+
+
+PASSWORD = 'password1'
+
+# A fake ssh which asks for the password without echo.
+_PROMPT = "stty -echo; printf 'Password:'; read p; stty echo; "
+
+
+def _session(script, passwords=(PASSWORD,), timeout=5):
+    session = AsyncSSHSession(Account('name1'), timeout=timeout)
+    session.command = f"sh -c \"{script}\""
+    session.passwords = list(passwords)
+    return session
+
+
+def _strip(result):
+    status, output = result
+    return status, output.strip()
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class AsyncSSHSessionTest(unittest.TestCase):
+    def test_exec(self):
+        session = _session(_PROMPT + 'echo got $p; exit 3')
+        status, output = _run(session.exec())
+        self.assertEqual(3, status)
+        self.assertEqual(b'got password1', output.strip())
+
+    def test_run(self):
+        chunks = []
+        session = _session(_PROMPT + 'echo a; echo b', passwords=[PASSWORD])
+        session.output = chunks.append
+        self.assertEqual(STATUS_SUCCESS, _run(session.run()))
+        self.assertEqual(b'a\r\nb', b''.join(chunks).strip())
+
+    def test_auth_failed(self):
+        session = _session("printf 'Permission denied'; sleep 5")
+        self.assertEqual(STATUS_FAIL, _run(session.run()))
+
+        session = _session('sleep 5', timeout=0.5)
+        self.assertFalse(_run(session.start()))
+
+    def test_wait(self):
+        # the pty is closed long before the child exits
+        session = _session(_PROMPT + 'exec </dev/null >/dev/null 2>&1; sleep 0.3; exit 4')
+        with mock.patch('asyncio.sleep', side_effect=AssertionError('busy wait')):
+            status, output = _run(session.exec())
+        self.assertEqual(4, status)
+
+    def test_exec_commands(self):
+        session = _session('')
+        with mock.patch.object(session, 'compile_command',
+                               side_effect=lambda: f"sh -c \"{_PROMPT}{session.cmd}\"") as m:
+            self.assertEqual((0, b'1'), tuple(_strip(_run(session.exec('echo 1')))))
+            self.assertEqual((2, b'2'), tuple(_strip(_run(session.exec('echo 2; exit 2')))))
+            self.assertEqual((2, b'2'), tuple(_strip(_run(session.exec()))))
+        self.assertEqual(2, m.call_count)
+
+    def test_many_sessions(self):
+        async def _main():
+            sessions = [_session(_PROMPT + f'echo {i}') for i in range(10)]
+            return await asyncio.gather(*[s.exec() for s in sessions])
+
+        results = _run(_main())
+        self.assertEqual([(0, str(i).encode()) for i in range(10)],
+                         [(s, o.strip()) for s, o in results])
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+from . import global_test_init
+import mock
+import shutil
+import unittest
+
+from .. import cfg
+from .. import store
+
+
+class StoreTest(unittest.TestCase):
+    FILE = '/tmp/sshx-test-store'
+
+    def setUp(self):
+        self.config_dict = {'security': False, 'phrase': 'ph', 'accounts': [
+            {'name': f'a{i}', 'host': f'h{i}', 'port': '22'} for i in range(20)]}
+
+    def _store(self, config_dict):
+        with open(self.FILE, 'wb') as f:
+            f.write(store.dumps(config_dict))
+        s = store.Store(self.FILE)
+        self.addCleanup(s.close)
+        return s
+
+    def test_get(self):
+        s = self._store(self.config_dict)
+        self.assertEqual({'security': False, 'phrase': 'ph'}, s.header)
+        self.assertEqual(20, s.count)
+        for i in range(20):
+            self.assertEqual(f'h{i}', s.get(f'a{i}')['host'])
+        self.assertIsNone(s.get('a20'))
+        self.assertEqual(self.config_dict, s.to_dict())
+
+    def test_empty(self):
+        s = self._store({'phrase': 'ph', 'accounts': []})
+        self.assertIsNone(s.get('a0'))
+        self.assertEqual([], s.accounts())
+
+    def test_collision(self):
+        with mock.patch('sshx.store.name_hash', return_value=1):
+            s = self._store(self.config_dict)
+            self.assertEqual('h7', s.get('a7')['host'])
+            self.assertEqual('h19', s.get('a19')['host'])
+            self.assertIsNone(s.get('b0'))
+
+    def test_not_binary(self):
+        with open(self.FILE, 'w') as f:
+            f.write('{}')
+        self.assertRaises(ValueError, store.Store, self.FILE)
+
+
+class BinaryConfigTest(unittest.TestCase):
+    TEST_DIR = '/tmp/sshx-test-binary'
+
+    def setUp(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+        cfg.set_config_dir(self.TEST_DIR)
+        cfg.init_config()
+        config = cfg.read_config()
+        for i in range(3):
+            config.add_account(cfg.Account(f'a{i}', host=f'h{i}', password=f'p{i}'))
+        cfg.write_config(config)
+        self.assertTrue(cfg.convert_config(store.BINARY))
+        self.assertFalse(cfg.convert_config(store.BINARY))
+
+    def tearDown(self):
+        shutil.rmtree(self.TEST_DIR, ignore_errors=True)
+
+    def test_read(self):
+        config = cfg.read_config()
+        self.assertIsInstance(config, cfg.BinaryConfig)
+        with mock.patch.object(config._store, '_decode', wraps=config._store._decode) as m:
+            self.assertEqual('p1', config.get_account('a1', decrypt=True).password)
+            m.assert_called_once()
+        self.assertEqual(['a0', 'a1', 'a2'], [a.name for a in config.get_accounts()])
+
+    def test_broken_record(self):
+        config_dict = cfg._read_config_file()[0]
+        config_dict['accounts'][1]['port'] = 22
+        with open(cfg.ACCOUNT_FILE, 'wb') as f:
+            f.write(store.dumps(config_dict))
+
+        config = cfg.read_config()
+        self.assertEqual('h0', config.get_account('a0').host)
+        self.assertRaises(ValueError, config.get_account, 'a1')
+        self.assertRaises(ValueError, cfg.read_config().get_accounts)
+
+    def test_write(self):
+        config = cfg.read_config()
+        config.update_account(config.get_account('a1'), {'password': 'p5'})
+        config.add_account(cfg.Account('a3', host='h3', password='p3'))
+        self.assertTrue(config.remove_account('a0'))
+        self.assertTrue(cfg.write_config(config))
+
+        config = cfg.read_config()
+        self.assertIsInstance(config, cfg.BinaryConfig)
+        self.assertEqual([('a1', 'p5'), ('a2', 'p2'), ('a3', 'p3')],
+                         [(a.name, a.password) for a in config.get_accounts(decrypt=True)])
+
+        self.assertTrue(cfg.convert_config(store.JSON))
+        config = cfg.read_config()
+        self.assertNotIsInstance(config, cfg.BinaryConfig)
+        self.assertEqual(['p5', 'p2', 'p3'], [a.password for a in config.get_accounts(decrypt=True)])
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
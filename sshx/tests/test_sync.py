@@ -0,0 +1,125 @@
+from . import global_test_init
+import io
+import os
+import json
+import shutil
+import unittest
+
+from .. import sync_helper as helper
+
+
+TEST_DIR = '/tmp/sshx-test-sync'
+CHUNK = 4
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class SyncHelperTest(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        self.src = os.path.join(TEST_DIR, 'src')
+        self.dst = os.path.join(TEST_DIR, 'dst')
+        _write(os.path.join(self.src, 'f1'), b'aaaabbbbcccc')
+        _write(os.path.join(self.src, 'sub/f2'), b'xyz')
+        os.makedirs(os.path.join(self.src, 'empty'))
+        os.makedirs(self.dst)
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def _sync(self):
+        '''Sync src to dst by frames, return the bytes sent.'''
+        changes = helper.diff(helper.sums(self.src, CHUNK), helper.sums(self.dst, CHUNK), CHUNK)
+        stream = io.BytesIO()
+        for rel, info, chunks in changes:
+            header = dict(info, path=rel, chunks=chunks)
+            stream.write(json.dumps(header).encode('utf-8') + b'\n')
+            if not info.get('dir'):
+                for data in helper.read_chunks(helper._path(self.src, rel), chunks):
+                    stream.write(data)
+        stream.seek(0)
+        return helper.write(self.dst, stream)
+
+    def test_sums(self):
+        sums = helper.sums(self.src, CHUNK)
+        self.assertEqual(['empty', 'f1', 'sub', 'sub/f2'], sorted(sums))
+        self.assertEqual({'dir': True}, sums['empty'])
+        self.assertEqual(12, sums['f1']['size'])
+        self.assertEqual(3, len(sums['f1']['sums']))
+
+        sums = helper.sums(os.path.join(self.src, 'f1'), CHUNK)
+        self.assertEqual([''], list(sums))
+        self.assertEqual({}, helper.sums(os.path.join(TEST_DIR, 'nonexist'), CHUNK))
+
+    def test_diff(self):
+        src = helper.sums(self.src, CHUNK)
+        changes = helper.diff(src, {}, CHUNK)
+        self.assertEqual([('empty', []), ('f1', [[0, 12]]), ('sub', []), ('sub/f2', [[0, 3]])],
+                         [(rel, chunks) for rel, _, chunks in changes])
+        self.assertEqual([], helper.diff(src, src, CHUNK))
+
+        _write(os.path.join(self.dst, 'f1'), b'aaaaBBBBcc')
+        changes = helper.diff(src, helper.sums(self.dst, CHUNK), CHUNK)
+        self.assertIn(('f1', [[4, 8]]), [(rel, chunks) for rel, _, chunks in changes])
+
+    def test_write(self):
+        self.assertEqual(15, self._sync())
+        self.assertEqual(b'aaaabbbbcccc', _read(os.path.join(self.dst, 'f1')))
+        self.assertEqual(b'xyz', _read(os.path.join(self.dst, 'sub/f2')))
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, 'empty')))
+        self.assertEqual(0, self._sync())
+
+        # only the changed chunk is sent, and longer files are truncated
+        _write(os.path.join(self.src, 'f1'), b'aaaaBBBB')
+        self.assertEqual(4, self._sync())
+        self.assertEqual(b'aaaaBBBB', _read(os.path.join(self.dst, 'f1')))
+
+        os.chmod(os.path.join(self.src, 'sub/f2'), 0o640)
+        self.assertEqual(0, self._sync())
+        self.assertEqual(0o640, os.stat(os.path.join(self.dst, 'sub/f2')).st_mode & 0o777)
+
+    def test_resume(self):
+        # a copy interrupted after the first chunk
+        _write(os.path.join(self.dst, 'f1'), b'aaaa')
+        self.assertEqual(8 + 3, self._sync())
+        self.assertEqual(b'aaaabbbbcccc', _read(os.path.join(self.dst, 'f1')))
+
+    def test_read(self):
+        request = json.dumps({'path': 'f1', 'chunks': [[0, 2], [8, 4]]}).encode('utf-8')
+        out = io.BytesIO()
+        helper.read(self.src, io.BytesIO(request + b'\n'), out)
+        self.assertEqual(b'aacccc', out.getvalue())
+
+        with self.assertRaises(IOError):
+            list(helper.read_chunks(os.path.join(self.src, 'f1'), [[10, 4]]))
+        with self.assertRaises(IOError):
+            helper.write(self.dst, io.BytesIO(b'{"path": "f", "size": 4, "mode": 420, '
+                                              b'"chunks": [[0, 4]]}\nab'))
+
+    def test_unsafe_path(self):
+        for rel in ['../f', 'sub/../../f', '/tmp/f', 'sub//f', './f', 'sub/']:
+            frame = json.dumps({'path': rel, 'size': 1, 'mode': 420, 'chunks': [[0, 1]]})
+            with self.assertRaises(IOError):
+                helper.write(self.dst, io.BytesIO(frame.encode('utf-8') + b'\na'))
+            request = json.dumps({'path': rel, 'chunks': [[0, 1]]})
+            with self.assertRaises(IOError):
+                helper.read(self.src, io.BytesIO(request.encode('utf-8') + b'\n'), io.BytesIO())
+        # nothing was written out of dst
+        self.assertFalse(os.path.exists(os.path.join(TEST_DIR, 'f')))
+        self.assertEqual([], os.listdir(self.dst))
+        self.assertEqual(['sub', 'f2'], helper.check_rel('sub/f2'))
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 from . import global_test_init
+import mock
 import unittest
 
 from sshx import tokenizer
@@ -29,6 +30,64 @@ class TokenizerTest(unittest.TestCase):
             self.assertNotEqual(s, t)
             self.assertEqual(s, tokenizer.decrypt(t, k))
 
+    @unittest.skipUnless(tokenizer.has_aead(), 'cryptography is not installed')
+    def test_v2(self):
+        t1 = tokenizer.encrypt('hello', 'key')
+        t2 = tokenizer.encrypt('world', 'key')
+        self.assertTrue(tokenizer.is_v2(t1))
+        self.assertEqual('hello', tokenizer.decrypt(t1, 'key'))
+        # one salt per key, a random nonce per token
+        self.assertEqual(t1.split('$')[:3], t2.split('$')[:3])
+        self.assertNotEqual(t1, tokenizer.encrypt('hello', 'key'))
+
+        with self.assertRaises(tokenizer.TokenError):
+            tokenizer.decrypt(t1, 'wrong')
+        broken = t1[:-2] + ('AA' if t1[-2:] != 'AA' else 'BB')
+        with self.assertRaises(tokenizer.TokenError):
+            tokenizer.decrypt(broken, 'key')
+        # a cost of the file is not trusted to size the memory of scrypt
+        fields = t1.split('$')
+        with self.assertRaises(tokenizer.TokenError):
+            tokenizer.decrypt('$'.join([fields[0], '30'] + fields[2:]), 'key')
+
+        # derived once
+        tokenizer._derive.cache_clear()
+        for _ in range(10):
+            tokenizer.decrypt(tokenizer.encrypt('hello', 'key'), 'key')
+        self.assertEqual(1, tokenizer._derive.cache_info().misses)
+
+    @unittest.skipUnless(tokenizer.has_aead(), 'cryptography is not installed')
+    def test_upgrade(self):
+        legacy = tokenizer._legacy_encrypt('hello', 'key')
+        self.assertEqual('hello', tokenizer.decrypt(legacy, 'key'))
+        t = tokenizer.upgrade(legacy, 'key')
+        self.assertTrue(tokenizer.is_v2(t))
+        self.assertEqual('hello', tokenizer.decrypt(t, 'key'))
+        self.assertEqual(t, tokenizer.upgrade(t, 'key'))
+        self.assertEqual('', tokenizer.upgrade('', 'key'))
+
+    def test_without_aead(self):
+        with mock.patch('sshx.tokenizer.has_aead', return_value=False):
+            t = tokenizer.encrypt('hello', 'key')
+            self.assertFalse(tokenizer.is_v2(t))
+            self.assertEqual('hello', tokenizer.decrypt(t, 'key'))
+            self.assertEqual(t, tokenizer.upgrade(t, 'key'))
+            with self.assertRaises(tokenizer.TokenError):
+                tokenizer.decrypt('v2$14$c2FsdA$ZGF0YQ', 'key')
+
+    def test_verifier(self):
+        v = tokenizer.make_verifier('passphrase')
+        self.assertTrue(tokenizer.is_v2(v))
+        self.assertNotIn('passphrase', v)
+        self.assertTrue(tokenizer.verify('passphrase', v))
+        self.assertFalse(tokenizer.verify('wrong', v))
+        self.assertNotEqual(v, tokenizer.make_verifier('passphrase'))
+
+        # legacy
+        self.assertTrue(tokenizer.verify('passphrase', tokenizer.hash('passphrase')))
+        self.assertFalse(tokenizer.verify('wrong', tokenizer.hash('passphrase')))
+        self.assertFalse(tokenizer.verify('passphrase', None))
+
     def test_hash(self):
         a = 'hello world'
         b = 'hello world'
@@ -0,0 +1,236 @@
+from . import global_test_init
+import time
+import mock
+import socket
+import shutil
+import threading
+import unittest
+
+import lazy_object_proxy as lazy
+
+from .. import cfg
+from .. import tunnels
+from ..const import STATUS_SUCCESS
+
+
+TEST_DIR = '/tmp/sshx-test-tunnels'
+
+SPEC1 = {'name': 'db', 'account': 'a1', 'forwards': ['5432:127.0.0.1:5432']}
+SPEC2 = {'name': 'proxy', 'account': 'a2', 'via': 'a1', 'socks': '127.0.0.1:1080'}
+
+
+def _reset():
+    cfg.config = lazy.Proxy(cfg.get_config)
+
+
+class _SSHPexpect(object):
+    '''Stands for a tunnel process, which is spawned by run and alive until killed.'''
+
+    instances = []
+
+    def __init__(self, account, **kwargs):
+        self.account = account
+        self.kwargs = kwargs
+        self.p = None
+        self.instances.append(self)
+
+    def run(self):
+        self.p = mock.Mock(pid=1000 + self.instances.index(self))
+        self.p.isalive.return_value = True
+        return STATUS_SUCCESS
+
+    def kill(self):
+        self.p.isalive.return_value = False
+
+
+class _Supervisor(tunnels.Supervisor):
+    '''Start tunnels synchronously.'''
+
+    def _start(self, tunnel):
+        tunnel.start(self.config, tunnel.begin())
+
+
+class SpecTest(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        cfg.set_config_dir(TEST_DIR)
+        cfg.init_config()
+
+    def tearDown(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_specs(self):
+        self.assertEqual({}, tunnels.load_specs())
+
+        tunnels.add_spec(SPEC1)
+        tunnels.add_spec(SPEC2)
+        specs = tunnels.load_specs()
+        self.assertEqual(['db', 'proxy'], list(specs))
+        self.assertEqual('a1', specs['proxy']['via'])
+        self.assertEqual([], specs['db']['rforwards'])
+
+        tunnels.add_spec(dict(SPEC1, forwards=['15432:127.0.0.1:5432']))
+        self.assertEqual(['15432:127.0.0.1:5432'], tunnels.load_specs()['db']['forwards'])
+
+        self.assertTrue(tunnels.remove_spec('db'))
+        self.assertFalse(tunnels.remove_spec('db'))
+        self.assertEqual(['proxy'], list(tunnels.load_specs()))
+
+        with self.assertRaises(tunnels.TunnelError):
+            tunnels.add_spec({'name': 'empty', 'account': 'a1'})
+        with self.assertRaises(tunnels.TunnelError):
+            tunnels.add_spec({'name': 'noaccount', 'socks': '1080'})
+
+    def test_probe_addresses(self):
+        spec = tunnels.normalize({'name': 't', 'account': 'a', 'socks': '1080',
+                                  'forwards': ['8080:host:80', '0.0.0.0:8081:host:80',
+                                               '10.0.0.1:8082:host:80'],
+                                  'rforwards': ['9000:127.0.0.1:9000']})
+        self.assertEqual([('127.0.0.1', 8080), ('127.0.0.1', 8081), ('10.0.0.1', 8082),
+                          ('127.0.0.1', 1080)], tunnels.probe_addresses(spec))
+
+
+class SupervisorTest(unittest.TestCase):
+    def setUp(self):
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+        cfg.set_config_dir(TEST_DIR)
+        cfg.init_config()
+        config = cfg.read_config()
+        config.add_account(cfg.Account('a1', host='h1', password='p1'))
+        config.add_account(cfg.Account('a2', host='h2', password='p2'))
+        cfg.write_config(config)
+
+        # a local port for the db tunnel to probe
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(8)
+        self.spec = dict(SPEC1, forwards=[f'{self.server.getsockname()[1]}:127.0.0.1:5432'])
+        tunnels.add_spec(self.spec)
+
+        _SSHPexpect.instances = []
+        patcher = mock.patch('sshx.sshwrap.SSHPexpect', _SSHPexpect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.close()
+        _reset()
+        shutil.rmtree(TEST_DIR, ignore_errors=True)
+
+    def test_restart(self):
+        supervisor = _Supervisor(cfg.read_config(), tunnels.load_specs())
+        tunnel = supervisor.tunnels['db']
+        self.assertTrue(supervisor.tick())
+        self.assertEqual('running', tunnel.state)
+        self.assertEqual(1, len(_SSHPexpect.instances))
+        self.assertEqual('h1', _SSHPexpect.instances[0].account.host)
+
+        # a probe failure kills the tunnel, which is restarted after backoff
+        self.server.close()
+        tunnel.last_probe = 0
+        supervisor.tick()
+        self.assertEqual('failed', tunnel.state)
+        self.assertEqual(1, tunnel.restarts)
+        self.assertFalse(_SSHPexpect.instances[0].p.isalive())
+
+        supervisor.tick()
+        self.assertEqual(1, len(_SSHPexpect.instances))
+        tunnel.next_start = 0
+        supervisor.tick()
+        self.assertEqual(2, len(_SSHPexpect.instances))
+
+        # backoff grows until the tunnel is up long enough
+        with mock.patch('time.time', return_value=time.time() + 1000):
+            supervisor.tick()
+        self.assertEqual('failed', tunnel.state)
+        self.assertEqual(tunnels.BACKOFF_BASE * 2, round(tunnel.next_start - time.time() - 1000))
+
+    def test_reload_while_starting(self):
+        supervisor = _Supervisor(cfg.read_config(), tunnels.load_specs())
+        tunnel = supervisor.tunnels['db']
+        run = _SSHPexpect.run
+        restarted = []
+
+        def reload_meanwhile(p):
+            if not restarted:
+                tunnels.add_spec(dict(self.spec, rforwards=['9000:127.0.0.1:9000']))
+                self.assertEqual(['db'], supervisor.op_reload()['restarted'])
+                # started again by the next tick, which is still connecting
+                restarted.append(tunnel.begin())
+            return run(p)
+
+        with mock.patch.object(_SSHPexpect, 'run', reload_meanwhile):
+            supervisor.tick()
+        stale = _SSHPexpect.instances[0]
+        self.assertEqual('starting', tunnel.state)
+        self.assertIsNone(tunnel.p)
+        self.assertFalse(stale.p.isalive())
+
+        tunnel.start(supervisor.config, restarted[0])
+        self.assertEqual('running', tunnel.state)
+        self.assertIs(_SSHPexpect.instances[1], tunnel.p)
+
+        # a stopped tunnel isn't started by the start in flight
+        generation = tunnel.begin()
+        tunnel.stop()
+        tunnel.start(supervisor.config, generation)
+        self.assertEqual('stopped', tunnel.state)
+        self.assertIsNone(_SSHPexpect.instances[-1].p)
+
+    def test_ops(self):
+        supervisor = _Supervisor(cfg.read_config(), tunnels.load_specs())
+        supervisor.tick()
+        info = supervisor.op_list()['tunnels'][0]
+        self.assertEqual('running', info['state'])
+        self.assertEqual(1000, info['pid'])
+
+        supervisor.op_stop(name='db')
+        supervisor.tick()
+        self.assertEqual('stopped', supervisor.tunnels['db'].state)
+        with self.assertRaises(tunnels.ipc.IPCError):
+            supervisor.op_stop(name='nonexist')
+
+        tunnels.add_spec(SPEC2)
+        result = supervisor.op_reload()
+        self.assertEqual({'added': ['proxy'], 'removed': [], 'restarted': ['db']}, result)
+        with mock.patch('sshx.sshwrap.ServerAliveInterval', 0):
+            supervisor.tick()
+        self.assertEqual(['running', 'running'], [t.state for t in supervisor.tunnels.values()])
+        self.assertEqual('-D 127.0.0.1:1080 -o ServerAliveInterval=30',
+                         _SSHPexpect.instances[-1].kwargs['extras'])
+        self.assertEqual('a1', _SSHPexpect.instances[-1].kwargs['vias'])
+
+        tunnels.remove_spec('db')
+        self.assertEqual(['db'], supervisor.op_reload()['removed'])
+        self.assertEqual(['proxy'], list(supervisor.tunnels))
+
+        supervisor.op_stop()
+        self.assertFalse(supervisor.tick())
+        self.assertFalse(_SSHPexpect.instances[-1].p.isalive())
+
+    def test_serve(self):
+        thread = threading.Thread(target=tunnels.start, kwargs={'foreground': True})
+        thread.start()
+        for _ in range(100):
+            if tunnels.request('ping'):
+                break
+            time.sleep(0.05)
+
+        try:
+            self.assertFalse(tunnels.start())
+            for _ in range(100):
+                infos = tunnels.request('list')['tunnels']
+                if infos[0]['state'] == 'running':
+                    break
+                time.sleep(0.05)
+            self.assertEqual('running', infos[0]['state'])
+        finally:
+            tunnels.request('stop')
+            thread.join()
+        self.assertIsNone(tunnels.request('ping'))
+
+
+global_test_init()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,22 +1,210 @@
-import hashlib
-from itsdangerous import URLSafeSerializer, SignatureExpired, BadData
+'''
+Secrets of the accounts and the passphrase verifier.
 
-def _salt(s):
+Tokens of the v2 format are encrypted with AES-256-GCM by a key derived
+from the passphrase by scrypt:
+
+    v2$<cost>$<salt>$<nonce + ciphertext + tag>
+
+The key is derived once per process for every (passphrase, salt), and a
+process encrypts all fields with the salt it has seen first, which is the
+one of the verifier in security mode, so a config costs a single
+derivation. cost is log2 of the scrypt N, KDF_COST for new salts.
+
+The verifier of the passphrase has the same shape, its last field is the
+second half of the derived bytes.
+
+AES-GCM needs the `cryptography` package, a dependency of sshx. Where it's
+missing anyway, tokens are written in the legacy format (signed by
+itsdangerous), which is still read in any case, so existing configs are
+migrated as they are written.
+'''
+
+import os
+import base64
+import functools
+
+# hashlib, itsdangerous and cryptography are imported on demand, most commands never decrypt.
+
+V2 = 'v2'
+
+KDF_COST = 14
+# scrypt takes 128 * r * N bytes, 1 GiB at 20
+MAX_KDF_COST = 20
+# For keys which are random already, like the phrase out of security mode.
+RANDOM_KEY_COST = 1
+_KDF_R = 8
+_KDF_P = 1
+_SALT_SIZE = 16
+_NONCE_SIZE = 12
+_AAD = b'sshx-v2'
+
+# passphrase -> (cost, salt) to encrypt with
+_salts = {}
+
+
+class TokenError(ValueError):
+    pass
+
+
+def set_kdf_cost(cost):
+    global KDF_COST
+    KDF_COST = cost
+    _salts.clear()
+
+
+def set_key_cost(key, cost):
+    '''Encrypt with `cost` for key, unless a salt of the key was seen.'''
+    if key not in _salts:
+        reset_salt(key, cost)
+
+
+def reset_salt(key, cost):
+    '''Encrypt with a new salt for key from now on.'''
+    _salts[key] = (cost, os.urandom(_SALT_SIZE))
+    return _salts[key]
+
+
+@functools.lru_cache(maxsize=None)
+def has_aead():
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _b64encode(b):
+    return base64.urlsafe_b64encode(b).decode('ascii').rstrip('=')
+
+
+def _b64decode(s):
+    try:
+        return base64.urlsafe_b64decode(s + '=' * (-len(s) % 4))
+    except ValueError as e:
+        raise TokenError(f'Broken token: {e}')
+
+
+@functools.lru_cache(maxsize=16)
+def _derive(key, cost, salt):
+    '''Return (encryption key, verifier) of 32 bytes each.'''
+    import hashlib
+    n = 2 ** cost
+    derived = hashlib.scrypt(key.encode('utf-8'), salt=salt, n=n, r=_KDF_R, p=_KDF_P,
+                             maxmem=128 * _KDF_R * (n + _KDF_P + 2) + 1024 * 1024, dklen=64)
+    return derived[:32], derived[32:]
+
+
+def _parse(token):
+    fields = token.split('$')
+    if len(fields) != 4 or fields[0] != V2:
+        raise TokenError('Not a v2 token.')
+    try:
+        cost = int(fields[1])
+    except ValueError:
+        raise TokenError(f'Broken token cost: {fields[1]}')
+    if not 1 <= cost <= MAX_KDF_COST:
+        raise TokenError(f'Token cost out of range: {cost}')
+    return cost, _b64decode(fields[2]), _b64decode(fields[3])
+
+
+def _salt(key):
+    set_key_cost(key, KDF_COST)
+    return _salts[key]
+
+
+def is_v2(token):
+    return token.startswith(V2 + '$')
+
+
+def is_current(token):
+    '''Whether the token is of the format encrypt() writes.'''
+    return is_v2(token) or not has_aead()
+
+
+def encrypt(string, key):
+    if not has_aead():
+        return _legacy_encrypt(string, key)
+
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    cost, salt = _salt(key)
+    nonce = os.urandom(_NONCE_SIZE)
+    data = AESGCM(_derive(key, cost, salt)[0]).encrypt(nonce, string.encode('utf-8'), _AAD)
+    return '$'.join([V2, str(cost), _b64encode(salt), _b64encode(nonce + data)])
+
+
+def decrypt(token, key):
+    if not is_v2(token):
+        return _legacy_decrypt(token, key)
+    if not has_aead():
+        raise TokenError('The cryptography package is required to decrypt the config, please install it.')
+
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    cost, salt, data = _parse(token)
+    _salts.setdefault(key, (cost, salt))
+    try:
+        plain = AESGCM(_derive(key, cost, salt)[0]).decrypt(
+            data[:_NONCE_SIZE], data[_NONCE_SIZE:], _AAD)
+    except InvalidTag:
+        raise TokenError('Wrong key or broken token.')
+    return plain.decode('utf-8')
+
+
+def upgrade(token, key):
+    '''Return the token in the v2 format, if it can be written.'''
+    if not token or is_v2(token) or not has_aead():
+        return token
+    return encrypt(_legacy_decrypt(token, key), key)
+
+
+def make_verifier(passphrase):
+    cost, salt = reset_salt(passphrase, KDF_COST)
+    check = _derive(passphrase, cost, salt)[1]
+    return '$'.join([V2, str(cost), _b64encode(salt), _b64encode(check)])
+
+
+def verify(passphrase, verifier):
+    '''Check the passphrase against a verifier of make_verifier(), or a legacy hash.'''
+    import hmac
+
+    if not is_v2(verifier or ''):
+        return verifier == hash(passphrase)
+
+    cost, salt, check = _parse(verifier)
+    if not hmac.compare_digest(check, _derive(passphrase, cost, salt)[1]):
+        return False
+    # encrypt with the salt of the verifier, derived already
+    _salts[passphrase] = (cost, salt)
+    return True
+
+
+@functools.lru_cache(maxsize=16)
+def _serializer(key):
+    from itsdangerous import URLSafeSerializer
+    return URLSafeSerializer(key), _legacy_salt(key)
+
+
+def _legacy_salt(s):
+    import hashlib
     m = hashlib.md5()
     m.update(s.encode('utf-8'))
     return m.hexdigest()
 
-def encrypt(string, key):
-    salt = _salt(key)
-    s = URLSafeSerializer(key)
+
+def _legacy_encrypt(string, key):
+    s, salt = _serializer(key)
     return s.dumps(string, salt)
 
-def decrypt(token, key):
-    salt = _salt(key)    
-    s = URLSafeSerializer(key)
+
+def _legacy_decrypt(token, key):
+    s, salt = _serializer(key)
     return s.loads(token, salt=salt)
 
+
 def hash(s):
+    '''The legacy verifier, an unsalted sha1.'''
+    import hashlib
     sha1 = hashlib.sha1()
     sha1.update(bytearray(s, 'utf-8'))
     return sha1.hexdigest()
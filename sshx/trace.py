@@ -0,0 +1,103 @@
+'''
+Timing spans of connection stages, written as json lines.
+
+    {"span": "auth.hop", "session": "1234-1", "account": "host1", "hop": 0,
+     "hop_account": "bastion", "start": 1700000000.123, "ms": 812.4, "ok": true}
+
+Spans of a connection share the same "session". Tracing is disabled until
+set_trace() was called, spans cost almost nothing then.
+'''
+
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+import contextlib
+
+
+_output = None
+_lock = threading.Lock()
+_counter = itertools.count(1)
+
+
+def set_trace(filename):
+    '''Write spans to filename, "-" for stderr, None to disable.'''
+    global _output
+    if _output not in (None, sys.stderr):
+        _output.close()
+
+    if not filename:
+        _output = None
+    elif filename == '-':
+        _output = sys.stderr
+    else:
+        _output = open(filename, 'a', buffering=1, encoding='utf-8')
+
+
+def enabled():
+    return _output is not None
+
+
+def new_session():
+    '''Return an id to correlate the spans of a connection.'''
+    return f'{os.getpid()}-{next(_counter)}'
+
+
+def emit(record):
+    if _output is None:
+        return
+    line = json.dumps(record, default=str)
+    with _lock:
+        _output.write(line + '\n')
+        _output.flush()
+
+
+class Span(object):
+    '''A span ended explicitly, for stages which don't fit in a block.'''
+
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self._t = time.perf_counter()
+        self.ended = False
+
+    def end(self, **attrs):
+        '''Emit the span, only the first call counts.'''
+        if self.ended:
+            return
+        self.ended = True
+        if _output is None:
+            return
+
+        record = {'span': self.name, 'start': round(self.start, 6),
+                  'ms': round((time.perf_counter() - self._t) * 1000, 3)}
+        record.update(self.attrs)
+        record.update(attrs)
+        record.setdefault('ok', True)
+        emit(record)
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    '''
+    Time the block. Attributes can be added to the yielded dict, "ok" is
+    False if the block raised, unless set explicitly.
+    '''
+    record = dict(attrs)
+    if _output is None:
+        yield record
+        return
+
+    s = Span(name)
+    ok = True
+    try:
+        yield record
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        record.setdefault('ok', ok)
+        s.end(**record)
@@ -0,0 +1,331 @@
+'''
+sshx tunnels runs a declarative set of forwards in one long-lived process.
+
+The tunnels are kept in cfg.TUNNELS_FILE:
+
+    {"tunnels": [{"name": "db", "account": "host1", "via": "",
+                  "forwards": ["5432:127.0.0.1:5432"], "rforwards": [], "socks": ""}]}
+
+The supervisor starts an ssh process for every tunnel, probes the local
+ports they bind (-L and -D) and whether ssh is still alive, and restarts
+dead tunnels with exponential backoff. It listens on an unix socket
+(cfg.TUNNELS_SOCKET) for list, stop and reload requests.
+'''
+
+import os
+import json
+import time
+import socket
+import threading
+from collections import OrderedDict
+
+from . import cfg, ipc, utils, logger, sshwrap
+from .sshx_forward import Forwards
+from .const import STATUS_SUCCESS
+
+
+# Restart delay is BACKOFF_BASE * 2 ** failures, up to BACKOFF_MAX seconds.
+BACKOFF_BASE = 1
+BACKOFF_MAX = 300
+# Failures are forgotten after running for so long.
+STABLE_TIME = 60
+PROBE_INTERVAL = 10
+PROBE_TIMEOUT = 2
+# Used when --interval was not given, so that ssh notices dead connections.
+KEEPALIVE_INTERVAL = 30
+
+
+class TunnelError(Exception):
+    pass
+
+
+def load_specs(filename=None):
+    '''Return the tunnels of the file as {name: spec}.'''
+    filename = filename or cfg.TUNNELS_FILE
+    if not os.path.exists(filename):
+        return OrderedDict()
+
+    with open(filename) as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise TunnelError(f'{filename}: {e}')
+
+    specs = OrderedDict()
+    for spec in data.get('tunnels', []):
+        spec = normalize(spec)
+        specs[spec['name']] = spec
+    return specs
+
+
+def save_specs(specs, filename=None):
+    s = json.dumps({'tunnels': list(specs.values())}, indent=2)
+    utils.atomic_write(filename or cfg.TUNNELS_FILE, s + '\n')
+
+
+def normalize(spec):
+    if not spec.get('name') or not spec.get('account'):
+        raise TunnelError(f'Tunnel requires name and account: {spec}')
+    spec = {
+        'name': spec['name'],
+        'account': spec['account'],
+        'via': spec.get('via') or '',
+        'forwards': list(spec.get('forwards') or []),
+        'rforwards': list(spec.get('rforwards') or []),
+        'socks': str(spec.get('socks') or ''),
+    }
+    if not (spec['forwards'] or spec['rforwards'] or spec['socks']):
+        raise TunnelError(f"Tunnel {spec['name']} forwards nothing.")
+    return spec
+
+
+def add_spec(spec):
+    spec = normalize(spec)
+    with utils.file_lock(cfg.LOCK_FILE):
+        specs = load_specs()
+        specs[spec['name']] = spec
+        save_specs(specs)
+
+
+def remove_spec(name):
+    with utils.file_lock(cfg.LOCK_FILE):
+        specs = load_specs()
+        if specs.pop(name, None) is None:
+            return False
+        save_specs(specs)
+    return True
+
+
+def probe_addresses(spec):
+    '''Return the local (host, port) bound by the tunnel.'''
+    addresses = []
+    binds = [m.rsplit(':', 2)[0] for m in spec['forwards']]
+    if spec['socks']:
+        binds.append(spec['socks'])
+    for bind in binds:
+        host, _, port = bind.rpartition(':')
+        if host in ('', '*', '0.0.0.0', 'localhost'):
+            host = sshwrap.LOCALHOST
+        addresses.append((host.strip('[]'), int(port)))
+    return addresses
+
+
+def probe(host, port, timeout=PROBE_TIMEOUT):
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class Tunnel(object):
+    def __init__(self, spec):
+        self.spec = spec
+        self.name = spec['name']
+        self.state = 'pending'
+        self.p = None
+        self.restarts = 0
+        self.failures = 0
+        self.started = None
+        self.next_start = 0
+        self.last_probe = 0
+        self.error = ''
+        # bumped by every start and stop, a start thread of an older one is stale
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def begin(self):
+        '''Mark the tunnel starting, return the generation of this start.'''
+        with self.lock:
+            self.generation += 1
+            self.state = 'starting'
+            return self.generation
+
+    def start(self, config, generation):
+        '''
+        Connect and authenticate, blocks until ssh is up or failed.
+
+        If the tunnel was stopped or started again meanwhile, the start is
+        stale and kills its own ssh, which would hold the ports otherwise.
+        '''
+        spec = self.spec
+        account = config.get_account(spec['account'], decrypt=True)
+        if not account:
+            with self.lock:
+                if generation == self.generation:
+                    self.fail(f"Account {spec['account']} not found.")
+            return
+
+        extras = f"-D {spec['socks']}" if spec['socks'] else ''
+        if not sshwrap.ServerAliveInterval:
+            # ssh takes the first value, which is before the one of the global option
+            extras += f' -o ServerAliveInterval={KEEPALIVE_INTERVAL}'
+        p = sshwrap.SSHPexpect(account, vias=spec['via'] or account.via,
+                               forwards=Forwards(spec['forwards'], spec['rforwards']),
+                               extras=extras, tty=False, background=True, execute=False)
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.p = p
+
+        ok = p.run() == STATUS_SUCCESS and p.p and p.p.isalive()
+        with self.lock:
+            if generation != self.generation:
+                if p.p and p.p.isalive():
+                    p.kill()
+            elif ok:
+                self.state = 'running'
+                self.started = self.last_probe = time.time()
+                self.error = ''
+                logger.info(f'tunnel {self.name} started')
+            else:
+                self.fail('ssh exited.')
+
+    def fail(self, error):
+        self.kill()
+        self.state = 'failed'
+        self.error = error
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** self.failures)
+        self.failures += 1
+        self.next_start = time.time() + delay
+        logger.info(f'tunnel {self.name}: {error} restart in {delay}s')
+
+    def kill(self):
+        p, self.p = self.p, None
+        if p and p.p and p.p.isalive():
+            p.kill()
+
+    def stop(self):
+        with self.lock:
+            self.generation += 1
+            self.kill()
+            self.state = 'stopped'
+            self.started = None
+
+    def alive(self):
+        if not (self.p and self.p.p and self.p.p.isalive()):
+            return False
+        return all(probe(host, port) for host, port in probe_addresses(self.spec))
+
+    def check(self, now):
+        '''Probe a running tunnel, return False if it died.'''
+        if now - self.last_probe < PROBE_INTERVAL:
+            return True
+        self.last_probe = now
+        if self.alive():
+            if self.failures and now - self.started > STABLE_TIME:
+                self.failures = 0
+            return True
+        self.restarts += 1
+        self.fail('tunnel is dead.')
+        return False
+
+    def info(self):
+        info = dict(self.spec)
+        info.update(state=self.state, restarts=self.restarts, error=self.error,
+                    pid=self.p.p.pid if self.p and self.p.p else None,
+                    uptime=int(time.time() - self.started) if self.state == 'running' else 0)
+        return info
+
+
+class Supervisor(object):
+    def __init__(self, config, specs):
+        self.config = config
+        self.tunnels = OrderedDict((name, Tunnel(spec)) for name, spec in specs.items())
+        self.stopped = False
+        self.started = time.time()
+
+    def _start(self, tunnel):
+        generation = tunnel.begin()
+        threading.Thread(target=tunnel.start, args=(self.config, generation), daemon=True).start()
+
+    def tick(self):
+        if self.stopped:
+            for tunnel in self.tunnels.values():
+                tunnel.stop()
+            return False
+
+        now = time.time()
+        for tunnel in self.tunnels.values():
+            if tunnel.state == 'running':
+                tunnel.check(now)
+            elif tunnel.state == 'pending' or (tunnel.state == 'failed' and now >= tunnel.next_start):
+                self._start(tunnel)
+        return True
+
+    def op_ping(self):
+        return {'pid': os.getpid(), 'started': self.started}
+
+    def op_list(self):
+        return {'tunnels': [t.info() for t in self.tunnels.values()]}
+
+    def op_stop(self, name=None):
+        if name is None:
+            self.stopped = True
+            return
+        tunnel = self.tunnels.get(name)
+        if tunnel is None:
+            raise ipc.IPCError(f'Tunnel {name} not found.')
+        tunnel.stop()
+
+    def op_reload(self):
+        '''Apply the tunnels file, restart changed and stopped tunnels.'''
+        specs = load_specs()
+
+        config = cfg.read_config()
+        if config.security:
+            if not config.verify_passphrase(self.config._phrase):
+                raise ipc.IPCError('Passphrase was changed, please restart the supervisor.')
+            config._phrase = self.config._phrase
+        self.config = config
+
+        result = {'added': [], 'removed': [], 'restarted': []}
+        for name in list(self.tunnels):
+            if name not in specs:
+                self.tunnels.pop(name).stop()
+                result['removed'].append(name)
+
+        for name, spec in specs.items():
+            tunnel = self.tunnels.get(name)
+            if tunnel is None:
+                tunnel = self.tunnels[name] = Tunnel(spec)
+                result['added'].append(name)
+            elif tunnel.spec != spec or tunnel.state == 'stopped':
+                tunnel.stop()
+                tunnel.spec = spec
+                tunnel.failures = 0
+                result['restarted'].append(name)
+                tunnel.state = 'pending'
+        return result
+
+
+def request(op, **kwargs):
+    '''Send a request to the running supervisor, return None if it's not running.'''
+    client = ipc.connect(cfg.TUNNELS_SOCKET)
+    if client is None:
+        return None
+
+    try:
+        return client.request(op, **kwargs)
+    except OSError as e:
+        logger.debug(f'supervisor unavailable: {e}')
+        return None
+    finally:
+        client.close()
+
+
+def start(foreground=False):
+    '''Start the supervisor, see agent.start.'''
+    if request('ping'):
+        logger.error('Supervisor is already running.')
+        return False
+
+    specs = load_specs()
+    config = cfg.read_config()
+    if config.security and config.get_passphrase() is None:
+        logger.error('Wrong passphrase.')
+        return False
+
+    supervisor = Supervisor(config, specs)
+    server = ipc.Server(cfg.TUNNELS_SOCKET, supervisor)
+    return server.start(foreground=foreground)
@@ -1,11 +1,6 @@
-# -*- coding: future_fstrings -*-
-
 import os
 import json
-import string
-import random
-
-from getpass import getpass
+import contextlib
 
 from . import const as c
 from . import logger
@@ -13,10 +8,15 @@ from . import logger
 
 class ClsDictEncoder(json.JSONEncoder):
     def default(self, o):
-        return o.__dict__
+        try:
+            return o.to_dict()
+        except AttributeError:
+            return o.__dict__
 
 
 def random_str(length):
+    import string
+    import random
     return ''.join([random.choice(string.ascii_letters + string.digits) for _ in range(15)])
 
 
@@ -32,8 +32,50 @@ def json_load(s):
     return json.loads(s)
 
 
+def atomic_write(filename, s, mode=0o600):
+    '''
+    Write s to filename through a temporary file in the same directory,
+    so that readers see either the old content or the new one.
+    '''
+    import tempfile
+
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=dirname)
+    try:
+        binary = isinstance(s, bytes)
+        with os.fdopen(fd, 'wb' if binary else 'w', encoding=None if binary else 'utf-8') as f:
+            f.write(s)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    '''Hold an exclusive lock of filename, which is created if not exists.'''
+    try:
+        import fcntl
+    except ImportError:
+        # no advisory lock on Windows
+        yield
+        return
+
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
 def read_password(prompt='Password:'):
     '''Read password from PTY'''
+    from getpass import getpass
     return getpass(prompt=prompt)
 
 